@@ -6,6 +6,7 @@ import sqlite3
 import psycopg2
 from psycopg2 import extras
 import json
+import base64
 import csv
 import io
 import os
@@ -13,12 +14,54 @@ import sys
 import uuid
 import shutil
 import email.message
-import email.parser
-import email.policy
+import threading
+import multiprocessing
+import signal
+import queue
+import time
+import re
+import bisect
+import heapq
+import functools
+import itertools
+import hashlib
+import mimetypes
+import cProfile
+import pstats
+import tracemalloc
+import asyncio
+import tempfile
+import zipfile
+import zlib
+import html
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from collections import defaultdict, OrderedDict, deque
 import unicodedata
+import logging
+import logging.handlers
+import atexit
+import contextlib
+try:
+    import fcntl # POSIX file locks, shared by pre-forked workers
+except ImportError:
+    fcntl = None
+    import msvcrt # Windows: single process, byte-range locks instead
+import random
+import secrets
 import pandas as pd
+import openpyxl
+try:
+    import pypdf # Optional: PDF attachments are only searchable when installed
+except ImportError:
+    pypdf = None
+try:
+    import pyarrow # Optional: needed only for the Parquet archive of old bus_lines months
+    import pyarrow.dataset as pa_dataset
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    pyarrow = None
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente do arquivo .env (se existir)
@@ -28,20 +71,1129 @@ PORT = int(os.environ.get('PORT', 8000))
 DATABASE_URL = os.environ.get('DATABASE_URL') # Neon.tech Connection String
 DB_FILE = "bus_analysis.db"
 UPLOAD_DIR = "uploads/analysis"
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 256)) # Max cached read results (0 disables)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10)) # Max open Postgres connections
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10)) # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800)) # Reconnect after this many seconds
+DB_POOL_PING_AFTER = int(os.environ.get('DB_POOL_PING_AFTER', 30)) # Health-check connections idle longer than this
+# Optional local SQLite copy of the read-heavy tables (only meaningful with DATABASE_URL)
+READ_MIRROR = bool(DATABASE_URL) and os.environ.get('READ_MIRROR', '0') == '1'
+READ_MIRROR_FILE = os.environ.get('READ_MIRROR_FILE', 'read_mirror.db')
+READ_MIRROR_MAX_STALENESS = float(os.environ.get('READ_MIRROR_MAX_STALENESS', 5)) # Seconds a pending sync may lag before reads go to Postgres
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 16)) # Threads handling connections
+SERVER_QUEUE_SIZE = int(os.environ.get('SERVER_QUEUE_SIZE', 64)) # Accepted connections waiting for a worker
+HEAVY_ROUTE_LIMIT = int(os.environ.get('HEAVY_ROUTE_LIMIT', 2)) # Concurrent imports/exports/global impact
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 5))
+HTTP_IDLE_TIMEOUT = float(os.environ.get('HTTP_IDLE_TIMEOUT', 15)) # Seconds a keep-alive connection may sit idle
+SERVER_PROCESSES = os.environ.get('SERVER_PROCESSES', '1') # Pre-forked worker processes ('auto' = one per CPU core)
+SERVER_FRONTEND = os.environ.get('SERVER_FRONTEND', 'threads').lower() # 'threads' (socketserver) or 'asyncio'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 250)) # Statements slower than this are logged
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10)) # Same query shape run more often than this in one request is flagged
+SQL_LOG_PARAMS = os.environ.get('SQL_LOG_PARAMS', '0') == '1' # Log parameter values (default: only their types)
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50)) # Newest profile files kept on disk
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005)) # Seconds between stack samples
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 50 * 1024 * 1024)) # Largest /api/line-events request (attachment + fields)
+MAX_FORM_FIELD_BYTES = int(os.environ.get('MAX_FORM_FIELD_BYTES', 1024 * 1024)) # Largest single text field in a multipart form
+STATIC_DIR = "static"
+STATIC_MEMORY_MAX = int(os.environ.get('STATIC_MEMORY_MAX', 256 * 1024)) # Static files up to this size are served from memory
+STATIC_CHECK_INTERVAL = float(os.environ.get('STATIC_CHECK_INTERVAL', 2)) # Seconds between checks for edited static files
+SEARCH_INDEX_INTERVAL = float(os.environ.get('SEARCH_INDEX_INTERVAL', 30)) # Seconds between scans for attachments whose text is not indexed yet
+ATTACHMENT_TEXT_MAX = int(os.environ.get('ATTACHMENT_TEXT_MAX', 2 * 1024 * 1024)) # Characters of extracted text kept per attachment
+EXPORT_TRACE_MEMORY = os.environ.get('EXPORT_TRACE_MEMORY', '1') == '1' # Measure peak memory of exports with tracemalloc (slows allocations while an export runs)
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000)) # Rows read from the database per batch while exporting
+CLEAR_BATCH_SIZE = int(os.environ.get('CLEAR_BATCH_SIZE', 5000)) # bus_lines rows changed per transaction by /api/clear-data
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive/bus_lines') # Parquet archive of closed bus_lines months (year=YYYY/month=MM/)
+ARCHIVE_KEEP_MONTHS = int(os.environ.get('ARCHIVE_KEEP_MONTHS', 12)) # Default for POST /api/archive: months kept live before the current one
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', 'export_cache') # Finished exports, reused while their data is unchanged
+EXPORT_CACHE_MAX_MB = float(os.environ.get('EXPORT_CACHE_MAX_MB', 512)) # Disk budget of the export cache; least recently used files go first (0 disables)
+EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', 2)) # Background export jobs built at once per process
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', 12 * 3600)) # Lifetime of a login token
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000)) # Validated sessions kept in memory per process
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE') # Default: stderr
+LOG_REQUEST_SAMPLE = float(os.environ.get('LOG_REQUEST_SAMPLE', 1.0)) # Share of successful requests written to the access log
+LOG_REQUEST_SAMPLE_ROUTES = os.environ.get('LOG_REQUEST_SAMPLE_ROUTES', '/metrics=0,static=0.1') # Per-route overrides: "route=rate,..."
+LOG_RATE_LIMIT_SECONDS = float(os.environ.get('LOG_RATE_LIMIT_SECONDS', 60)) # Identical warnings are written at most once per window
+
+log = logging.getLogger('bus_analysis')
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets a repeated WARNING/ERROR through at most once per `interval` seconds.
+    Repeats are keyed by the message template (or extra={'rate_key': ...}), so
+    "row 10 failed" and "row 11 failed" count as the same warning. The next one
+    that gets through says how many were dropped in between.
+    """
+    MAX_KEYS = 10000
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._seen = {} # key -> [last emitted (monotonic), suppressed since]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.levelno, getattr(record, 'rate_key', None) or record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._seen.get(key)
+            if state and now - state[0] < self.interval:
+                state[1] += 1
+                return False
+            if len(self._seen) >= self.MAX_KEYS:
+                self._seen.clear()
+            self._seen[key] = [now, 0]
+        if state and state[1]:
+            record.msg = f"{record.msg} (+{state[1]} similar suppressed)"
+        return True
+
+class RequestLogSampler:
+    """Decides which requests reach the access log: all errors, a per-route share of the rest."""
+    def __init__(self, default_rate, route_rates):
+        self.default_rate = default_rate
+        self.route_rates = {}
+        for item in route_rates.split(','):
+            if '=' in item:
+                route, rate = item.rsplit('=', 1)
+                self.route_rates[route.strip()] = float(rate)
+
+    def should_log(self, route, status):
+        if status is None or status >= 400:
+            return True
+        rate = self.route_rates.get(route, self.default_rate)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+request_log_sampler = RequestLogSampler(LOG_REQUEST_SAMPLE, LOG_REQUEST_SAMPLE_ROUTES)
+
+_log_listener = None
+_log_pid = None
+
+def setup_logging():
+    """
+    Non-blocking logging for this process: callers only enqueue records,
+    a QueueListener thread formats and writes them.
+    Call again in a forked worker (the parent's writer thread doesn't survive fork).
+    """
+    global _log_listener, _log_pid
+    if _log_pid == os.getpid():
+        return
+    target = logging.FileHandler(LOG_FILE, encoding='utf-8') if LOG_FILE else logging.StreamHandler(sys.stderr)
+    target.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s [%(process)d] %(message)s'))
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT_SECONDS))
+    log.handlers = [handler]
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    _log_listener = logging.handlers.QueueListener(records, target)
+    _log_listener.start()
+    _log_pid = os.getpid()
+    atexit.register(_log_listener.stop)
+
+# bus_lines.date is a DATE on Postgres (the partition key, see BusLinePartitions); the code
+# works with the 'YYYY-MM-DD' text it always had, so DATE values are returned unparsed
+psycopg2.extensions.register_type(psycopg2.extensions.new_type((1082,), 'DATE_AS_TEXT', lambda value, cursor: value))
+
+class PoolTimeoutError(Exception):
+    pass
+
+class PooledConnection:
+    """
+    Thin proxy handed out by get_db_connection().
+    Behaves like the real connection, but close() gives it back to the pool.
+    """
+    def __init__(self, pool, raw, created_at, overflow=False):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._overflow = overflow
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self)
+
+class _ConnectionPool:
+    """Tracks which connections each thread holds so a request can't leak them."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = threading.local()
+        self.reclaimed = 0
+
+    def _held_list(self):
+        if not hasattr(self._held, 'conns'):
+            self._held.conns = []
+        return self._held.conns
+
+    def _wrap(self, raw, created_at, overflow=False):
+        pc = PooledConnection(self, raw, created_at, overflow)
+        # Remember the owning thread's list: close() may happen on another thread
+        pc._held_by = self._held_list()
+        pc._held_by.append(pc)
+        return pc
+
+    def _untrack(self, pc):
+        if pc in pc._held_by:
+            pc._held_by.remove(pc)
+
+    def release_thread_connections(self):
+        """Returns every connection still held by the current thread (error paths that skipped close())."""
+        held = self._held_list()
+        while held:
+            pc = held.pop()
+            with self._lock:
+                self.reclaimed += 1
+            pc.close()
+
+class PostgresPool(_ConnectionPool):
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+    - Reuses idle connections (LIFO keeps the warm ones hot)
+    - Pings connections that sat idle too long, recycles old ones
+    - Callers wait up to DB_POOL_TIMEOUT for a free slot
+    """
+    def __init__(self, dsn, max_size, timeout, recycle, ping_after):
+        super().__init__()
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._cond = threading.Condition(self._lock)
+        self._idle = [] # (raw, created_at, last_used)
+        self._total = 0
+        self.created = 0
+        self.recycled = 0
+        self.discarded = 0
+        self.acquired = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _connect(self):
+        raw = psycopg2.connect(self.dsn)
+        with self._lock:
+            self.created += 1
+        return raw, time.time()
+
+    def _is_usable(self, raw, created_at, last_used):
+        if raw.closed:
+            return False
+        if time.time() - created_at > self.recycle:
+            with self._lock:
+                self.recycled += 1
+            return False
+        if time.time() - last_used > self.ping_after:
+            try:
+                with raw.cursor() as cur:
+                    cur.execute("SELECT 1")
+                raw.rollback()
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    raw, created_at, last_used = self._idle.pop()
+                    break
+                if self._total < self.max_size:
+                    self._total += 1
+                    raw = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError(f"No database connection available after {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+
+        try:
+            if raw is not None and not self._is_usable(raw, created_at, last_used):
+                self._discard_raw(raw)
+                raw = None
+            if raw is None:
+                raw, created_at = self._connect()
+        except Exception:
+            # Give the slot back so a failed connect doesn't shrink the pool forever
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+            self.wait_time_total += elapsed
+            self.wait_time_max = max(self.wait_time_max, elapsed)
+        return self._wrap(raw, created_at)
+
+    def _discard_raw(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._lock:
+            self.discarded += 1
+
+    def release(self, pc):
+        self._untrack(pc)
+        raw = pc._raw
+        healthy = not raw.closed
+        if healthy:
+            try:
+                # End whatever transaction the caller left open (SELECTs open one too)
+                raw.rollback()
+            except Exception:
+                healthy = False
+
+        with self._cond:
+            if healthy:
+                self._idle.append((raw, pc._created_at, time.time()))
+            else:
+                self._total -= 1
+            self._cond.notify()
+        if not healthy:
+            self._discard_raw(raw)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+        for raw, _, _ in idle:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "postgres",
+                "max_size": self.max_size,
+                "open": self._total,
+                "idle": len(self._idle),
+                "in_use": self._total - len(self._idle),
+                "acquired": self.acquired,
+                "created": self.created,
+                "recycled": self.recycled,
+                "discarded": self.discarded,
+                "reclaimed": self.reclaimed,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.wait_time_total / self.acquired * 1000, 3) if self.acquired else 0,
+                "max_wait_ms": round(self.wait_time_max * 1000, 3)
+            }
+
+class _SQLiteSlot:
+    """A thread's reusable sqlite3 connection and whether it is handed out."""
+    __slots__ = ('conn', 'busy')
+
+    def __init__(self):
+        self.conn = None
+        self.busy = False
+
+class SQLitePool(_ConnectionPool):
+    """
+    One reusable sqlite3 connection per thread.
+    If a thread asks for a second connection while holding the first,
+    it gets a temporary one that is really closed on release.
+    The owning thread's slot travels with the PooledConnection, so a close()
+    from another thread (executors, export jobs, reclaim) frees the right one.
+    """
+    def __init__(self, db_file):
+        super().__init__()
+        self.db_file = db_file
+        self._local = threading.local()
+        self.opened = 0
+        self.reused = 0
+        self.overflow = 0
+        self.acquired = 0
+
+    def _connect(self):
+        raw = sqlite3.connect(self.db_file)
+        raw.row_factory = sqlite3.Row
+        with self._lock:
+            self.opened += 1
+        return raw
+
+    def _slot(self):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            slot = self._local.slot = _SQLiteSlot()
+        return slot
+
+    def acquire(self):
+        slot = self._slot()
+        with self._lock:
+            self.acquired += 1
+        if slot.conn is not None and not slot.busy:
+            slot.busy = True
+            if slot.conn.in_transaction:
+                slot.conn.rollback() # Released from another thread, which could not roll it back
+            with self._lock:
+                self.reused += 1
+            pc = self._wrap(slot.conn, 0)
+        elif slot.conn is None:
+            slot.conn = self._connect()
+            slot.busy = True
+            pc = self._wrap(slot.conn, time.time())
+        else:
+            with self._lock:
+                self.overflow += 1
+            return self._wrap(self._connect(), time.time(), overflow=True)
+        pc._slot = slot
+        return pc
+
+    def release(self, pc):
+        self._untrack(pc)
+        try:
+            pc._raw.rollback()
+        except Exception:
+            pass
+        if pc._overflow:
+            pc._raw.close()
+        else:
+            pc._slot.busy = False
+
+    def close_all(self):
+        slot = self._slot()
+        if slot.conn is not None:
+            slot.conn.close()
+            slot.conn = None
+            slot.busy = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "acquired": self.acquired,
+                "opened": self.opened,
+                "reused": self.reused,
+                "overflow": self.overflow,
+                "reclaimed": self.reclaimed
+            }
+
+if DATABASE_URL:
+    db_pool = PostgresPool(DATABASE_URL, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_AFTER)
+else:
+    db_pool = SQLitePool(DB_FILE)
 
 def get_db_connection():
-    """Returns a connection and a cursor (DictCursor for Postgres, Row for SQLite)"""
+    """
+    Returns a pooled connection and a cursor (DictCursor for Postgres, Row for SQLite).
+    conn.close() returns the connection to the pool instead of closing it.
+    """
+    conn = db_pool.acquire()
     if DATABASE_URL:
-        # Connect to Postgres
-        conn = psycopg2.connect(DATABASE_URL)
         # We use DictCursor to mimic sqlite3.Row behavior (access by column name)
         cursor = conn.cursor(cursor_factory=extras.DictCursor)
-        return conn, cursor
+        return conn, InstrumentedCursor(cursor, 'postgres')
     else:
-        # Fallback to local SQLite
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        return conn, conn.cursor()
+        return conn, InstrumentedCursor(conn.cursor(), 'sqlite')
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_PLACEHOLDER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@functools.lru_cache(maxsize=1024)
+def sql_shape(sql):
+    """Statement with literals/placeholders as '?', placeholder lists collapsed and whitespace squeezed."""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace') # psycopg2's execute_batch sends pre-mogrified bytes
+    shape = _SQL_LITERALS.sub('?', sql.replace('%s', '?'))
+    shape = _SQL_PLACEHOLDER_LISTS.sub('(?, ...)', shape)
+    return ' '.join(shape.split())
+
+def redact_params(params):
+    """Parameters as they may appear in logs: only their types unless SQL_LOG_PARAMS=1."""
+    if params is None:
+        return '[]'
+    if SQL_LOG_PARAMS:
+        text = repr(params)
+        return text if len(text) <= 200 else text[:200] + '...'
+    values = params.values() if isinstance(params, dict) else params
+    return '[' + ', '.join(type(v).__name__ for v in values) + ']'
+
+class SQLTrace:
+    """Statements executed while handling one request."""
+    SLOWEST_KEPT = 5
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.shapes = defaultdict(int) # shape -> executions
+        self.slowest = [] # (seconds, shape), slowest first
+
+    def record(self, shape, seconds):
+        self.statements += 1
+        self.seconds += seconds
+        self.shapes[shape] += 1
+        if len(self.slowest) < self.SLOWEST_KEPT or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, shape))
+            self.slowest.sort(reverse=True)
+            del self.slowest[self.SLOWEST_KEPT:]
+
+    def repeated(self, threshold):
+        return sorted(((n, shape) for shape, n in self.shapes.items() if n > threshold), reverse=True)
+
+class SQLMonitor:
+    """
+    Per-request SQL accounting (thread-local trace) plus the slow-query log.
+    - Every statement is timed and attributed to the request running on this thread
+    - At the end of a request, query shapes repeated more than N_PLUS_ONE_THRESHOLD times are flagged
+    - Statements over SLOW_QUERY_MS are logged with redacted parameters
+    Statements run outside a request (init, background sync) only reach the slow-query log.
+    """
+    def __init__(self, slow_ms, repeat_threshold, keep=20):
+        self.slow_ms = slow_ms
+        self.repeat_threshold = repeat_threshold
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.statements = 0
+        self.slow_queries = 0
+        self.n_plus_one = 0
+        self.recent_slow = deque(maxlen=keep)
+        self.recent_n_plus_one = deque(maxlen=keep)
+
+    def begin_request(self):
+        self._local.trace = SQLTrace()
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    def end_request(self, method, route):
+        trace = self.current()
+        self._local.trace = None
+        if trace is None:
+            return None
+        for count, shape in trace.repeated(self.repeat_threshold):
+            log.warning("[N+1] %s %s: %sx %s", method, route, count, shape, extra={'rate_key': f"n+1 {method} {route} {shape}"})
+            with self._lock:
+                self.n_plus_one += 1
+                self.recent_n_plus_one.append({"at": datetime.now().isoformat(timespec='seconds'), "route": f"{method} {route}",
+                                               "count": count, "shape": shape})
+        return trace
+
+    def record(self, source, sql, params, seconds):
+        shape = sql_shape(sql)
+        trace = self.current()
+        if trace is not None:
+            trace.record(shape, seconds)
+        with self._lock:
+            self.statements += 1
+        if seconds * 1000 >= self.slow_ms:
+            log.warning("[SLOW SQL] %.1fms (%s) %s params=%s", seconds * 1000, source, shape, redact_params(params),
+                        extra={'rate_key': f"slow {shape}"})
+            with self._lock:
+                self.slow_queries += 1
+                self.recent_slow.append({"at": datetime.now().isoformat(timespec='seconds'), "ms": round(seconds * 1000, 1),
+                                         "source": source, "shape": shape})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "statements": self.statements,
+                "slow_query_ms": self.slow_ms,
+                "slow_queries": self.slow_queries,
+                "n_plus_one_threshold": self.repeat_threshold,
+                "n_plus_one": self.n_plus_one,
+                "recent_slow": list(self.recent_slow),
+                "recent_n_plus_one": list(self.recent_n_plus_one)
+            }
+
+sql_monitor = SQLMonitor(SLOW_QUERY_MS, N_PLUS_ONE_THRESHOLD)
+
+class InstrumentedCursor:
+    """Cursor proxy that times every statement and reports it to sql_monitor."""
+    def __init__(self, cursor, source):
+        self._cursor = cursor
+        self._source = source
+
+    def execute(self, sql, params=None):
+        started = time.perf_counter()
+        try:
+            if params is None:
+                return self._cursor.execute(sql)
+            return self._cursor.execute(sql, params)
+        finally:
+            sql_monitor.record(self._source, sql, params, time.perf_counter() - started)
+
+    def executemany(self, sql, seq):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, seq)
+        finally:
+            sql_monitor.record(self._source, sql, None, time.perf_counter() - started)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class SharedCounters:
+    """
+    Fixed set of named numeric slots.
+    Plain process memory until share() is called; after that the values live
+    in shared memory, so forked worker processes all see the same numbers.
+    """
+    def __init__(self, names, typecode='q', initial=0):
+        self._index = {name: i for i, name in enumerate(names)}
+        self._typecode = typecode
+        self._values = [initial] * len(names)
+        self._lock = threading.Lock()
+
+    def share(self):
+        """Call in the parent before forking."""
+        self._values = multiprocessing.RawArray(self._typecode, list(self._values))
+        self._lock = multiprocessing.Lock()
+
+    def get(self, name):
+        with self._lock:
+            return self._values[self._index[name]]
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[self._index[name]] = value
+
+    def add(self, names, delta=1):
+        with self._lock:
+            for name in names:
+                self._values[self._index[name]] += delta
+
+    def snapshot(self, names):
+        with self._lock:
+            return tuple(self._values[self._index[name]] for name in names)
+
+    def add_many(self, deltas):
+        """Applies several (name, delta) updates under one lock acquisition."""
+        with self._lock:
+            for name, delta in deltas:
+                self._values[self._index[name]] += delta
+
+class TableVersions(SharedCounters):
+    """
+    Per-table write counters. Every write path bumps the tables it touched,
+    so anything derived from a table can tell whether it is still current
+    (in this process or, once shared, in any worker process).
+    """
+    TABLES = ('users', 'bus_lines', 'occurrences', 'line_groups', 'line_group_members', 'line_events', 'operational_options', 'attachments', 'sessions', 'attachment_texts', 'line_stats')
+
+    def __init__(self):
+        super().__init__(self.TABLES)
+
+    def bump(self, *tables):
+        self.add(tables)
+
+class QueryCache:
+    """
+    Bounded LRU cache for read-endpoint results.
+    - Keyed by endpoint name + normalized parameters
+    - Each entry remembers the tables it was built from and their versions,
+      so a write to any of those tables makes it stale immediately
+    """
+    def __init__(self, max_entries, version_of):
+        self.max_entries = max_entries
+        self.version_of = version_of # tables -> hashable version snapshot
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (tables, versions, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(name, params):
+        return name + ':' + json.dumps(params, sort_keys=True, default=str)
+
+    def get_or_load(self, name, params, tables, loader):
+        if self.max_entries <= 0:
+            return loader()
+
+        key = self.make_key(name, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] == self.version_of(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # Snapshot BEFORE loading: a write that lands mid-query leaves the entry stale
+        current = self.version_of(tables)
+        value = loader()
+
+        with self._lock:
+            self._entries[key] = (tuple(tables), current, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, *tables):
+        with self._lock:
+            stale = [k for k, (deps, _, _) in self._entries.items() if any(t in deps for t in tables)]
+            for k in stale:
+                del self._entries[k]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+def data_version(tables):
+    """Version of everything a cached read over these tables depends on (primary writes + mirror syncs)."""
+    version = table_versions.snapshot(tables)
+    if read_mirror:
+        version += read_mirror.synced.snapshot([t for t in tables if t in ReadMirror.TABLES])
+    return version
+
+table_versions = TableVersions()
+query_cache = QueryCache(QUERY_CACHE_SIZE, data_version)
+
+class _PlaceholderCursor:
+    """sqlite3 cursor that accepts the Postgres '%s' placeholders built by the handlers."""
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self._cursor.execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, sql, seq):
+        return self._cursor.executemany(sql.replace('%s', '?'), seq)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class ReadMirror:
+    """
+    Local SQLite copy of the tables dashboards read the most.
+    - Fully synced once at startup, then incrementally after each write
+      (bus_lines by touched dates, the small tables by full copy)
+    - Reads use it only when every table involved is synced or its pending
+      sync is younger than READ_MIRROR_MAX_STALENESS; otherwise Postgres
+    - Sync state is kept in SharedCounters, so with several worker processes
+      any of them can use a sync another one performed
+    """
+    TABLES = {
+        'bus_lines': ['id', 'date', 'line_code', 'line_name', 'company', 'predicted_passengers', 'realized_passengers'],
+        'line_groups': ['id', 'name', 'color'],
+        'line_group_members': ['group_id', 'line_code'],
+        'operational_options': ['id', 'type', 'label'],
+    }
+    DATE_BATCH = 200
+    FETCH_BATCH = 5000
+
+    def __init__(self, db_file, max_staleness):
+        self.db_file = db_file
+        self.max_staleness = max_staleness
+        self.pool = SQLitePool(db_file)
+        self._cond = threading.Condition()
+        self._pending = {} # table -> set of dates, or None for a full copy (this process's queue)
+        # Table version the mirror copy reflects (-1 = never synced) and time of the oldest unsynced write
+        self.synced = SharedCounters(self.TABLES, 'q', initial=-1)
+        self.dirty_since = SharedCounters(self.TABLES, 'd', initial=0.0)
+        self._thread = None
+        self.syncs = 0
+        self.rows_synced = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_sync = {} # table -> unix time
+        self.hits = 0
+        self.fallbacks = 0
+
+    def _init_schema(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("PRAGMA journal_mode=WAL") # Readers keep going while a sync writes
+        for table, cols in self.TABLES.items():
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(cols)})")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_mirror_bus_lines_date ON bus_lines(date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_mirror_bus_lines_line ON bus_lines(line_code, date)")
+        conn.commit()
+        conn.close()
+
+    def share(self):
+        self.synced.share()
+        self.dirty_since.share()
+
+    def start(self, initial_sync=True):
+        """initial_sync=False lets other worker processes rely on the copy one worker makes."""
+        self._init_schema()
+        if initial_sync:
+            self.request_sync(list(self.TABLES))
+        self._thread = threading.Thread(target=self._run, name='read-mirror', daemon=True)
+        self._thread.start()
+
+    def request_sync(self, tables, dates=None):
+        """Queues a sync. dates limits a bus_lines sync to those days; None means a full copy."""
+        now = time.time()
+        with self._cond:
+            for t in tables:
+                if t not in self.TABLES:
+                    continue
+                if t == 'bus_lines' and dates is not None and self._pending.get(t, set()) is not None:
+                    self._pending.setdefault(t, set()).update(dates)
+                else:
+                    self._pending[t] = None
+                if not self.dirty_since.get(t):
+                    self.dirty_since.set(t, now)
+            self._cond.notify()
+
+    def _is_fresh(self, table, now):
+        synced = self.synced.get(table)
+        if synced < 0:
+            return False
+        if synced >= table_versions.get(table):
+            return True
+        since = self.dirty_since.get(table)
+        return bool(since) and now - since <= self.max_staleness
+
+    def can_serve(self, tables):
+        now = time.time()
+        ok = all(self._is_fresh(t, now) for t in tables)
+        with self._cond:
+            if ok:
+                self.hits += 1
+            else:
+                self.fallbacks += 1
+        return ok
+
+    def connect(self):
+        conn = self.pool.acquire()
+        return conn, _PlaceholderCursor(conn.cursor())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                table, dates = next(iter(self._pending.items()))
+                del self._pending[table]
+                started = time.time()
+            try:
+                # Version read BEFORE copying: writes landing mid-copy keep the table dirty
+                version = table_versions.get(table)
+                copied = self._sync_table(table, dates)
+                # Moving 'synced' also changes data_version(), dropping cache entries built from the old copy
+                self.synced.set(table, max(version, self.synced.get(table)))
+                if table_versions.get(table) <= version:
+                    self.dirty_since.set(table, 0.0)
+                with self._cond:
+                    self.syncs += 1
+                    self.rows_synced += copied
+                    self.last_sync[table] = time.time()
+            except Exception as e:
+                log.error("Read mirror sync error (%s): %s", table, e)
+                with self._cond:
+                    self.errors += 1
+                    self.last_error = str(e)
+                    # Retry later as a full copy; the dirty clock keeps running so reads fall back
+                    self._pending[table] = None
+                time.sleep(min(30, max(1, time.time() - started)))
+
+    def _sync_table(self, table, dates):
+        cols = self.TABLES[table]
+        col_list = ', '.join(cols)
+        insert_sql = f"INSERT INTO {table} ({col_list}) VALUES ({', '.join(['?'] * len(cols))})"
+        src_conn, _ = get_db_connection()
+        dst = sqlite3.connect(self.db_file)
+        copied = 0
+        try:
+            if dates is None:
+                # Server-side cursor: a full bus_lines copy never sits in memory at once
+                src = src_conn.cursor(name=f"mirror_{table}")
+                src.itersize = self.FETCH_BATCH
+                src.execute(f"SELECT {col_list} FROM {table}")
+                dst.execute(f"DELETE FROM {table}")
+                while True:
+                    rows = src.fetchmany(self.FETCH_BATCH)
+                    if not rows:
+                        break
+                    dst.executemany(insert_sql, [tuple(r) for r in rows])
+                    copied += len(rows)
+                src.close()
+            else:
+                src = src_conn.cursor()
+                dates = sorted(dates)
+                for i in range(0, len(dates), self.DATE_BATCH):
+                    chunk = dates[i:i + self.DATE_BATCH]
+                    src.execute(f"SELECT {col_list} FROM {table} WHERE date IN ({','.join(['%s'] * len(chunk))})", chunk)
+                    rows = src.fetchall()
+                    dst.execute(f"DELETE FROM {table} WHERE date IN ({','.join(['?'] * len(chunk))})", chunk)
+                    dst.executemany(insert_sql, [tuple(r) for r in rows])
+                    copied += len(rows)
+            dst.commit()
+        except Exception:
+            dst.rollback()
+            raise
+        finally:
+            dst.close()
+            src_conn.close()
+        return copied
+
+    def stats(self):
+        now = time.time()
+        dirty = {t: self.dirty_since.get(t) for t in self.TABLES}
+        ready = [t for t in self.TABLES if self.synced.get(t) >= 0]
+        with self._cond:
+            return {
+                "file": self.db_file,
+                "max_staleness_s": self.max_staleness,
+                "ready": ready,
+                "pending": {t: ('full' if d is None else len(d)) for t, d in self._pending.items()},
+                "lag_s": {t: round(now - since, 3) for t, since in dirty.items() if since},
+                "last_sync": {t: datetime.fromtimestamp(ts).isoformat(timespec='seconds') for t, ts in self.last_sync.items()},
+                "syncs": self.syncs,
+                "rows_synced": self.rows_synced,
+                "reads_served": self.hits,
+                "reads_fallback": self.fallbacks,
+                "errors": self.errors,
+                "last_error": self.last_error
+            }
+
+read_mirror = ReadMirror(READ_MIRROR_FILE, READ_MIRROR_MAX_STALENESS) if READ_MIRROR else None
+
+def get_read_connection(*tables):
+    """
+    Connection for read-only queries over the given tables.
+    Served by the local mirror when it is fresh enough, else by get_db_connection().
+    SQL should be written with the primary's placeholder style.
+    """
+    if read_mirror and read_mirror.can_serve(tables):
+        conn, cursor = read_mirror.connect()
+        return conn, InstrumentedCursor(cursor, 'mirror')
+    return get_db_connection()
+
+def mark_tables_changed(*tables, dates=None):
+    """
+    Must be called after every committed write so cached reads are dropped.
+    dates optionally narrows a bus_lines change to the days it touched.
+    """
+    table_versions.bump(*tables)
+    query_cache.invalidate(*tables)
+    if read_mirror:
+        read_mirror.request_sync(tables, dates)
+
+class SessionStore:
+    """
+    Login sessions: opaque bearer tokens that expire after `ttl` seconds.
+    - Only the SHA-256 of a token is stored (sessions table)
+    - Validated sessions are kept in an in-memory LRU of max_entries, so checking
+      a known token is an expiry comparison with no query
+    - A miss (token issued by another worker process, or evicted) costs one lookup
+    - Logout or any write to users bumps the table versions, which empties the
+      cache of every process on its next use
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # token hash -> {'user_id', 'username', 'role', 'expires'}
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _current_version():
+        return table_versions.snapshot(('sessions', 'users'))
+
+    def _sync_version(self):
+        """Caller holds the lock."""
+        version = self._current_version()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def _remember(self, key, session, version):
+        with self._lock:
+            self._sync_version()
+            if version != self._version:
+                return # logout or user change landed while we were loading
+            self._entries[key] = session
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def create(self, user):
+        """Issues a token for a users row; returns (token, session)."""
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        session = {"user_id": user['id'], "username": user['username'], "role": user['role'], "expires": now + self.ttl}
+        version = self._current_version()
+        conn, c = get_db_connection()
+        try:
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"DELETE FROM sessions WHERE expires_at < {ph}", (now,))
+            c.execute(f"INSERT INTO sessions (token_hash, user_id, expires_at) VALUES ({ph}, {ph}, {ph})",
+                      (self.digest(token), user['id'], session["expires"]))
+            conn.commit()
+        finally:
+            conn.close()
+        self._remember(self.digest(token), session, version)
+        return token, session
+
+    def get(self, token):
+        """Session for a token, or None if unknown or expired."""
+        if not token:
+            return None
+        key = self.digest(token)
+        now = time.time()
+        with self._lock:
+            self._sync_version()
+            session = self._entries.get(key)
+            if session:
+                if session["expires"] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return session
+                del self._entries[key]
+                return None
+            self.misses += 1
+            version = self._version
+
+        conn, c = get_db_connection()
+        try:
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"""SELECT s.user_id, s.expires_at, u.username, u.role
+                          FROM sessions s JOIN users u ON u.id = s.user_id
+                          WHERE s.token_hash = {ph}""", (key,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+        if not row or row['expires_at'] <= now:
+            return None
+        session = {"user_id": row['user_id'], "username": row['username'], "role": row['role'], "expires": row['expires_at']}
+        self._remember(key, session, version)
+        return session
+
+    def revoke(self, token):
+        conn, c = get_db_connection()
+        try:
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"DELETE FROM sessions WHERE token_hash = {ph}", (self.digest(token),))
+            conn.commit()
+        finally:
+            conn.close()
+        mark_tables_changed('sessions')
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+session_store = SessionStore(SESSION_TTL_SECONDS, SESSION_CACHE_SIZE)
+
+class GroupIndex:
+    """
+    In-memory copy of line_groups + line_group_members.
+    - groups: the /api/groups payload ({'id', 'name', 'color', 'lines'})
+    - by_id: group id -> group; by_line: line_code -> group (a line is in at most one group)
+    - Loaded from the primary with one joined query and rebuilt only after a write to either table
+    """
+    TABLES = ('line_groups', 'line_group_members')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._groups = []
+        self._by_id = {}
+        self._by_line = {}
+        self.rebuilds = 0
+
+    def _load(self):
+        # Always the primary: the index is keyed by table_versions, which a lagging read mirror
+        # would not match (a stale copy would be cached as current until the next write)
+        conn, c = get_db_connection()
+        try:
+            c.execute("""SELECT g.id, g.name, g.color, m.line_code
+                         FROM line_groups g LEFT JOIN line_group_members m ON m.group_id = g.id
+                         ORDER BY g.id, m.line_code""")
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        groups, by_id, by_line = [], {}, {}
+        for row in rows:
+            group = by_id.get(row['id'])
+            if group is None:
+                group = {"id": row['id'], "name": row['name'], "color": row['color'], "lines": []}
+                by_id[row['id']] = group
+                groups.append(group)
+            if row['line_code'] is not None:
+                group["lines"].append(row['line_code'])
+                by_line[row['line_code']] = group
+        return groups, by_id, by_line
+
+    def _current(self):
+        version = table_versions.snapshot(self.TABLES)
+        with self._lock:
+            if version != self._version:
+                # Snapshot taken before loading: a write landing mid-load triggers another rebuild
+                self._groups, self._by_id, self._by_line = self._load()
+                self._version = version
+                self.rebuilds += 1
+            return self._groups, self._by_id, self._by_line
+
+    def groups(self):
+        return self._current()[0]
+
+    def get(self, group_id):
+        try:
+            return self._current()[1].get(int(group_id))
+        except (TypeError, ValueError):
+            return None
+
+    def group_of(self, line_code):
+        return self._current()[2].get(line_code)
+
+    def annotate(self, rows, key='line_code'):
+        """Adds group_id / group_name to each row dict (None when the line has no group)."""
+        by_line = self._current()[2]
+        for row in rows:
+            group = by_line.get(row.get(key))
+            row['group_id'] = group["id"] if group else None
+            row['group_name'] = group["name"] if group else None
+        return rows
+
+group_index = GroupIndex()
 
 def init_db():
     if not os.path.exists(UPLOAD_DIR):
@@ -61,17 +1213,20 @@ def init_db():
         role TEXT NOT NULL DEFAULT 'COMMON'
     )''')
 
-    # Bus Lines Daily Data Table
-    c.execute(f'''CREATE TABLE IF NOT EXISTS bus_lines (
-        id {'SERIAL PRIMARY KEY' if DATABASE_URL else 'INTEGER PRIMARY KEY AUTOINCREMENT'},
-        date TEXT NOT NULL,
-        line_code TEXT NOT NULL,
-        line_name TEXT,
-        company TEXT NOT NULL,
-        predicted_passengers REAL DEFAULT 0,
-        realized_passengers REAL DEFAULT 0,
-        UNIQUE(date, line_code, company)
-    )''')
+    # Bus Lines Daily Data Table (on Postgres: partitioned by month, see BusLinePartitions)
+    if DATABASE_URL:
+        bus_line_partitions.setup(c)
+    else:
+        c.execute('''CREATE TABLE IF NOT EXISTS bus_lines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            line_code TEXT NOT NULL,
+            line_name TEXT,
+            company TEXT NOT NULL,
+            predicted_passengers REAL DEFAULT 0,
+            realized_passengers REAL DEFAULT 0,
+            UNIQUE(date, line_code, company)
+        )''')
 
     # Occurrences / Analysis Table (Legacy)
     c.execute(f'''CREATE TABLE IF NOT EXISTS occurrences (
@@ -123,6 +1278,34 @@ def init_db():
         UNIQUE(type, label)
     )''')
 
+    # Login tokens (see SessionStore); only the token's hash is kept
+    c.execute(f'''CREATE TABLE IF NOT EXISTS sessions (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        expires_at {'DOUBLE PRECISION' if DATABASE_URL else 'REAL'} NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Attachment files, stored once per content hash (see AttachmentStore)
+    c.execute('''CREATE TABLE IF NOT EXISTS attachments (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Text extracted from attachment files, one row per stored file (see SearchIndex)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS attachment_texts (
+        id {'SERIAL PRIMARY KEY' if DATABASE_URL else 'INTEGER PRIMARY KEY AUTOINCREMENT'},
+        name TEXT UNIQUE NOT NULL,
+        status TEXT NOT NULL, -- ok, unsupported, error
+        content TEXT,
+        extracted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    search_index.setup(c)
+    line_stats.setup(c)
+
     # SQLite-specific migrations (skip if using PostgreSQL as migrate_to_postgres handles it)
     if not DATABASE_URL:
         # (Inside init_db, original migration code for SQLite follows...)
@@ -134,17 +1317,17 @@ def init_db():
     ph = "%s" if DATABASE_URL else "?"
     c.execute(f"SELECT * FROM users WHERE username = {ph}", ('master',))
     if not c.fetchone():
-        print("Seeding 'master' user...")
+        log.info("Seeding 'master' user...")
         c.execute(f"INSERT INTO users (username, password, role) VALUES ({ph}, {ph}, {ph})", ('master', 'admin123', 'MASTER'))
         c.execute(f"INSERT INTO users (username, password, role) VALUES ({ph}, {ph}, {ph})", ('user', 'user123', 'COMMON'))
     else:
-        print("Ensuring 'master' password is 'admin123'...")
+        log.info("Ensuring 'master' password is 'admin123'...")
         c.execute(f"UPDATE users SET password = {ph} WHERE username = {ph}", ('admin123', 'master'))
 
     # Seed operational options if empty
     c.execute("SELECT COUNT(*) FROM operational_options")
     if c.fetchone()[0] == 0:
-        print("Seeding operational options...")
+        log.info("Seeding operational options...")
         facts = ["Não atingiu a meta", "Pouca oferta na area", "Desvio na via", "Chuva", "Greve/paralização", "Mudança de tarifa"]
         causes = [
             "Acidente", "Ajuste da quilometragem morta", "Áreas não cobertas pelo transporte urbano", 
@@ -185,8 +1368,502 @@ def init_db():
     conn.commit()
     conn.close()
 
-class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    daemon_threads = True
+class WorkerPoolTCPServer(socketserver.TCPServer):
+    """
+    TCP server with a fixed number of worker threads fed by a bounded queue.
+    When every worker is busy and the queue is full, new connections get an
+    immediate 503 instead of spawning yet another thread.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers, queue_size, listen_socket=None):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.busy = 0
+        super().__init__(server_address, handler_class, bind_and_activate=listen_socket is None)
+        if listen_socket is not None:
+            # Pre-fork mode: the parent bound and listens; every worker process accepts on that socket
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+            with self._lock:
+                self.accepted += 1
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            self.reject_request(request)
+
+    @staticmethod
+    def busy_response():
+        body = b"Servidor ocupado, tente novamente em instantes."
+        head = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            f"Retry-After: {RETRY_AFTER_SECONDS}\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('ascii')
+        return head + body
+
+    def reject_request(self, request):
+        try:
+            request.sendall(self.busy_response())
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._lock:
+                    self.busy -= 1
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "frontend": "threads",
+                "pid": os.getpid(),
+                "workers": self.workers,
+                "busy": self.busy,
+                "queued": self._queue.qsize(),
+                "queue_size": self._queue.maxsize,
+                "accepted": self.accepted,
+                "rejected": self.rejected
+            }
+
+class AdmissionClass:
+    """Caps how many requests of one kind run at once; extra ones are turned away, not queued."""
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def try_acquire(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self.in_flight, "admitted": self.admitted, "rejected": self.rejected}
+
+# Routes that hold a worker (and a DB connection) for seconds to minutes
+HEAVY_ROUTES = {
+    '/api/import-csv', '/api/import-predicted',
+    '/api/export-group', '/api/export-actions', '/api/export-lines',
+    '/api/global-actions-impact', '/api/archive', '/api/archive/restore'
+}
+heavy_admission = AdmissionClass('heavy', HEAVY_ROUTE_LIMIT)
+
+ROUTES = {} # (method, path) -> handler function
+PREFIX_ROUTES = [] # (method, path prefix, handler function), checked in registration order
+
+def route(method, path, prefix=False):
+    """Registers a RequestHandler method as the handler for method + path (or path prefix)."""
+    def register(func):
+        if prefix:
+            PREFIX_ROUTES.append((method, path, func))
+        else:
+            ROUTES[(method, path)] = func
+        return func
+    return register
+
+def find_route(method, path):
+    """Returns (handler, route label) or (None, None)."""
+    func = ROUTES.get((method, path))
+    if func:
+        return func, path
+    for m, prefix, func in PREFIX_ROUTES:
+        if m == method and path.startswith(prefix):
+            return func, prefix
+    return None, None
+
+def route_labels():
+    """Every (method, label) a request can be recorded under."""
+    labels = list(ROUTES) + [(m, p) for m, p, _ in PREFIX_ROUTES]
+    labels += [('GET', 'static'), ('HEAD', 'static'), ('OPTIONS', '*')]
+    labels += [(m, 'unmatched') for m in RouteMetrics.METHODS]
+    return labels
+
+class RouteMetrics(SharedCounters):
+    """
+    Per-route latency histograms, status code counts and bytes in/out.
+    The slots are fixed from the route table up front, so they can live in
+    shared memory and pre-forked workers report into the same numbers.
+    """
+    METHODS = ('GET', 'POST', 'DELETE', 'HEAD', 'OPTIONS', 'OTHER')
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    STATUS_CODES = (200, 201, 202, 204, 206, 301, 304, 400, 401, 403, 404, 405, 413, 416, 431, 500, 501, 503)
+
+    def __init__(self, labels):
+        self.labels = labels
+        names = []
+        for key in labels:
+            names += [(key, 'count'), (key, 'sum'), (key, 'bytes_in'), (key, 'bytes_out'), (key, 'db_statements'), (key, 'db_seconds')]
+            names += [(key, 'bucket', i) for i in range(len(self.BUCKETS) + 1)]
+            names += [(key, 'status', code) for code in self.STATUS_CODES + ('other',)]
+        super().__init__(names, typecode='d')
+
+    def observe(self, method, label, status, seconds, bytes_in, bytes_out, db_statements=0, db_seconds=0.0):
+        method = method if method in self.METHODS else 'OTHER'
+        key = (method, label)
+        if (key, 'count') not in self._index:
+            key = (method, 'unmatched')
+        code = status if status in self.STATUS_CODES else 'other'
+        self.add_many([
+            ((key, 'count'), 1), ((key, 'sum'), seconds),
+            ((key, 'bytes_in'), bytes_in), ((key, 'bytes_out'), bytes_out),
+            ((key, 'db_statements'), db_statements), ((key, 'db_seconds'), db_seconds),
+            ((key, 'bucket', bisect.bisect_left(self.BUCKETS, seconds)), 1),
+            ((key, 'status', code), 1)
+        ])
+
+    def render(self):
+        """Prometheus text exposition of every route that has seen traffic."""
+        values = dict(zip(self._index, self.snapshot(list(self._index))))
+        seen = [key for key in self.labels if values[(key, 'count')]]
+        out = [
+            "# HELP http_request_duration_seconds Request handling time by route.",
+            "# TYPE http_request_duration_seconds histogram"
+        ]
+        for key in seen:
+            labels = f'method="{key[0]}",route="{key[1]}"'
+            cumulative = 0
+            for i, le in enumerate(self.BUCKETS + ('+Inf',)):
+                cumulative += values[(key, 'bucket', i)]
+                out.append(f'http_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative:.0f}')
+            out.append(f'http_request_duration_seconds_sum{{{labels}}} {values[(key, "sum")]:.6f}')
+            out.append(f'http_request_duration_seconds_count{{{labels}}} {values[(key, "count")]:.0f}')
+
+        out += ["# HELP http_responses_total Responses by route and status code.", "# TYPE http_responses_total counter"]
+        for key in seen:
+            for code in self.STATUS_CODES + ('other',):
+                n = values[(key, 'status', code)]
+                if n:
+                    out.append(f'http_responses_total{{method="{key[0]}",route="{key[1]}",code="{code}"}} {n:.0f}')
+
+        counters = (
+            ('bytes_in', 'http_request_bytes_total', 'Request body bytes received'),
+            ('bytes_out', 'http_response_bytes_total', 'Response bytes sent'),
+            ('db_statements', 'http_request_db_statements_total', 'SQL statements executed'),
+            ('db_seconds', 'http_request_db_seconds_total', 'Time spent in SQL statements')
+        )
+        for field, name, help_text in counters:
+            out += [f"# HELP {name} {help_text} by route.", f"# TYPE {name} counter"]
+            for key in seen:
+                out.append(f'{name}{{method="{key[0]}",route="{key[1]}"}} {values[(key, field)]:g}')
+        return out
+
+class _CountingWriter:
+    """Wraps a handler's wfile to count response bytes."""
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self._wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._wfile, name)
+
+class StackSampler:
+    """
+    Minimal sampling profiler for one thread.
+    A background thread snapshots the target thread's stack every `interval`
+    seconds and counts identical stacks (collapsed-stack / flamegraph format).
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = defaultdict(int) # "outer;...;inner" -> samples
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {n}\n")
+
+class ProfileStore:
+    """
+    Runs single requests under a profiler and keeps the newest results on disk.
+    - mode 'cprofile': deterministic, saved as .prof (pstats / snakeviz)
+    - mode 'sample': StackSampler, saved as .collapsed (flamegraph.pl / speedscope)
+    File names carry time, method, route and duration, so listing needs no index.
+    """
+    MODES = {'cprofile': 'prof', 'sample': 'collapsed'}
+
+    def __init__(self, directory, keep, sample_interval):
+        self.directory = directory
+        self.keep = keep
+        self.sample_interval = sample_interval
+        # One profile at a time: concurrent profiled requests would skew each other
+        self._busy = threading.Lock()
+
+    def run(self, mode, method, route, func):
+        """Calls func() under the profiler; runs it plainly if another profile is in progress."""
+        if not self._busy.acquire(blocking=False):
+            log.info("Profiler busy, running %s %s without profiling", method, route)
+            return func()
+        try:
+            if mode == 'sample':
+                profiler = StackSampler(threading.get_ident(), self.sample_interval)
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            started = time.perf_counter()
+            try:
+                return func()
+            finally:
+                elapsed_ms = int((time.perf_counter() - started) * 1000)
+                if mode == 'sample':
+                    profiler.stop()
+                else:
+                    profiler.disable()
+                self._save(profiler, mode, method, route, elapsed_ms)
+        finally:
+            self._busy.release()
+
+    def _save(self, profiler, mode, method, route, elapsed_ms):
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r'[^a-zA-Z0-9]+', '-', route).strip('-') or 'root'
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]
+        name = f"{stamp}_{method}_{slug}_{elapsed_ms}ms.{self.MODES[mode]}"
+        path = os.path.join(self.directory, name)
+        if mode == 'sample':
+            profiler.write(path)
+        else:
+            profiler.dump_stats(path)
+        log.info("Profile saved: %s", path)
+        for old in self._files()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def _files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        exts = tuple('.' + ext for ext in self.MODES.values())
+        return sorted((f for f in os.listdir(self.directory) if f.endswith(exts)), reverse=True)
+
+    def path_for(self, name):
+        """Full path of a listed profile file, or None (also rejects anything path-like)."""
+        return os.path.join(self.directory, name) if name in self._files() else None
+
+    def top_functions(self, name, limit=8):
+        path = os.path.join(self.directory, name)
+        if name.endswith('.prof'):
+            stats = pstats.Stats(path).stats # (file, line, func) -> (cc, calls, tottime, cumtime, callers)
+            rows = sorted(stats.items(), key=lambda item: -item[1][2])[:limit]
+            return [{"function": f"{func} ({os.path.basename(file)}:{line})", "calls": calls,
+                     "tottime": round(tt, 4), "cumtime": round(ct, 4)}
+                    for (file, line, func), (cc, calls, tt, ct, callers) in rows]
+        # Collapsed stacks: the last frame of each stack is where the sample landed
+        self_samples = defaultdict(int)
+        total = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                stack, _, n = line.rstrip('\n').rpartition(' ')
+                self_samples[stack.rsplit(';', 1)[-1]] += int(n)
+                total += int(n)
+        rows = sorted(self_samples.items(), key=lambda item: -item[1])[:limit]
+        return [{"function": func, "samples": n, "share": round(n / total, 4)} for func, n in rows]
+
+    def list(self, limit=20):
+        profiles = []
+        for name in self._files()[:limit]:
+            stamp, method, route, duration = name.rsplit('.', 1)[0].split('_')
+            try:
+                top = self.top_functions(name)
+            except Exception as e:
+                top = [{"error": str(e)}]
+            profiles.append({
+                "name": name,
+                "created": datetime.strptime(stamp, '%Y%m%d-%H%M%S-%f').isoformat(timespec='seconds'),
+                "method": method,
+                "route": route,
+                "duration_ms": int(duration[:-2]),
+                "mode": 'sample' if name.endswith('.collapsed') else 'cprofile',
+                "top": top
+            })
+        return profiles
+
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_KEEP, PROFILE_SAMPLE_INTERVAL)
+
+class StaticAssets:
+    """
+    Content-hashed static files.
+    - Every file under `root` also answers at a fingerprinted URL (/static/app.<hash>.js)
+      that is cached by browsers for a year as immutable
+    - index.html is rewritten to reference those URLs; it is the only file revalidated on each load
+    - Files up to memory_max bytes are kept in memory, larger ones are sent with sendfile
+    Edits on disk are picked up: the tree is re-stat'ed at most every check_interval seconds.
+    """
+    INDEX = 'index.html'
+    IMMUTABLE = 'public, max-age=31536000, immutable'
+    # src="app.js?v=2" / href="style.css" / href="/static/x.css" (absolute URLs and API paths are left alone)
+    REFERENCE = re.compile(r'''((?:src|href)=["'])(?![a-z]+:|//|#|/api/)/?(?:static/)?([^"'?#]+)(?:\?[^"'#]*)?(["'])''')
+
+    def __init__(self, root, memory_max, check_interval):
+        self.root = root
+        self.memory_max = memory_max
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = 0
+        self._assets = {} # relative name -> entry
+        self._by_url = {} # fingerprinted URL -> entry
+        self._index = None
+
+    def _scan(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                files.append((os.path.relpath(path, self.root).replace(os.sep, '/'), st.st_mtime_ns, st.st_size))
+        return tuple(sorted(files))
+
+    def _entry(self, path, data, digest):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        return {
+            "path": path,
+            "size": len(data),
+            "etag": f'"{digest}"',
+            "content_type": content_type,
+            "data": data if len(data) <= self.memory_max else None
+        }
+
+    def _build(self, signature):
+        assets, by_url = {}, {}
+        for rel, _, _ in signature:
+            if rel == self.INDEX:
+                continue
+            path = os.path.join(self.root, rel)
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            entry = self._entry(path, data, digest)
+            base, ext = os.path.splitext(rel)
+            entry["url"] = f"/static/{base}.{digest}{ext}"
+            assets[rel] = entry
+            by_url[entry["url"]] = entry
+
+        index = None
+        index_path = os.path.join(self.root, self.INDEX)
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                html = f.read()
+            def rewrite(m):
+                entry = assets.get(m.group(2))
+                return f"{m.group(1)}{entry['url']}{m.group(3)}" if entry else m.group(0)
+            data = self.REFERENCE.sub(rewrite, html).encode('utf-8')
+            index = self._entry(index_path, data, hashlib.sha256(data).hexdigest()[:12])
+            index["data"] = data # Rewritten, so it can only come from memory
+
+        self._assets, self._by_url, self._index = assets, by_url, index
+        self._signature = signature
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._signature is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._signature is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            signature = self._scan() if os.path.isdir(self.root) else ()
+            if signature != self._signature:
+                self._build(signature)
+
+    def lookup(self, path):
+        """(entry, immutable) for a request path, or (None, False) if it isn't a known static file."""
+        self._refresh()
+        if path in ('', '/', '/' + self.INDEX, '/static/' + self.INDEX):
+            return self._index, False
+        entry = self._by_url.get(path)
+        if entry:
+            return entry, True
+        rel = path[len('/static/'):] if path.startswith('/static/') else path.lstrip('/')
+        return self._assets.get(rel), False
+
+    def stats(self):
+        return {
+            "files": len(self._assets) + (1 if self._index else 0),
+            "in_memory_bytes": sum(len(e["data"]) for e in list(self._assets.values()) + [self._index or {"data": b""}] if e["data"])
+        }
+
+static_assets = StaticAssets(STATIC_DIR, STATIC_MEMORY_MAX, STATIC_CHECK_INTERVAL)
+
+def admission_class_for(path):
+    if path.split('?', 1)[0] in HEAVY_ROUTES:
+        return heavy_admission
+    return None
 
 def normalize_text(text):
     if not text: return "Não Informada"
@@ -255,493 +1932,2836 @@ def sanitize_numeric(val_str):
     except (ValueError, TypeError):
         return 0
 
-class RequestHandler(http.server.SimpleHTTPRequestHandler):
-    def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS, DELETE')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        # Prevent browsers from caching static files (JS, HTML, CSS)
-        if not self.path.startswith('/api/'):
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-        super().end_headers()
+class RequestBody:
+    """
+    Reader over exactly one request body on a persistent connection.
+    Handlers can't read into the next request, and whatever they leave
+    unread can be drained before the connection is reused.
+    """
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, n=-1):
+        if self.remaining <= 0:
+            return b""
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self._rfile.read(n)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readline(self, limit=-1):
+        if self.remaining <= 0:
+            return b""
+        if limit is None or limit < 0 or limit > self.remaining:
+            limit = self.remaining
+        data = self._rfile.readline(limit)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def drain(self, max_bytes):
+        """Discards the unread rest of the body; False if it was too big to bother."""
+        if self.remaining > max_bytes:
+            return False
+        while self.remaining > 0:
+            if not self.read(min(self.remaining, 64 * 1024)):
+                return False
+        return True
+
+class UploadTooLarge(Exception):
+    pass
+
+class MultipartError(ValueError):
+    pass
+
+# Routes with a request body cap; checked against Content-Length before anything is read
+BODY_LIMITS = {
+    '/api/line-events': MAX_UPLOAD_BYTES
+}
+
+def body_limit_for(path):
+    return BODY_LIMITS.get(path.split('?', 1)[0])
+
+def _header_params(name, value):
+    """Parses a MIME header's parameters (quoting, RFC 2231 filenames) via email.message."""
+    msg = email.message.Message()
+    msg[name] = value
+    return msg
+
+class MultipartParser:
+    """
+    Incremental multipart/form-data reader.
+    - The body is read in CHUNK-sized pieces; file parts go straight to the
+      file objects returned by open_file(filename), never into memory whole
+    - Text fields are collected into a dict (each capped at max_field_bytes)
+    - UploadTooLarge is raised as soon as more than max_bytes have been read
+    """
+    CHUNK = 64 * 1024
+    MAX_PART_HEADER = 16 * 1024
+
+    def __init__(self, rfile, content_type, max_bytes, max_field_bytes, open_file):
+        boundary = _header_params('Content-Type', content_type).get_param('boundary')
+        if not boundary:
+            raise MultipartError("Missing multipart boundary")
+        self._rfile = rfile
+        self._delimiter = b"\r\n--" + boundary.encode('latin-1')
+        self._max_bytes = max_bytes
+        self._max_field_bytes = max_field_bytes
+        self._open_file = open_file
+        self._buffer = b""
+        self._read = 0
+        self._eof = False
+        self.files = [] # {'name', 'filename', 'file', 'size'}; kept on the parser so callers can clean up after errors
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._rfile.read(self.CHUNK)
+        if not chunk:
+            self._eof = True
+            return False
+        self._read += len(chunk)
+        if self._read > self._max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {self._max_bytes} bytes")
+        self._buffer += chunk
+        return True
+
+    def _read_until(self, marker, limit):
+        """Returns the bytes before marker (consumed with it); limit guards header sections."""
+        while True:
+            pos = self._buffer.find(marker)
+            if pos >= 0:
+                data, self._buffer = self._buffer[:pos], self._buffer[pos + len(marker):]
+                return data
+            if len(self._buffer) > limit:
+                raise MultipartError("Multipart header section too long")
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+
+    def _stream_part(self, sink, limit=None):
+        """Writes part data to sink until the next delimiter; returns bytes written."""
+        keep = len(self._delimiter) - 1
+        written = 0
+        while True:
+            pos = self._buffer.find(self._delimiter)
+            if pos >= 0:
+                data, self._buffer = self._buffer[:pos], self._buffer[pos + len(self._delimiter):]
+            elif len(self._buffer) > keep:
+                # Everything except a possible partial delimiter at the end is safe to flush
+                data, self._buffer = self._buffer[:-keep], self._buffer[-keep:]
+            else:
+                data = b""
+            if data:
+                written += len(data)
+                if limit is not None and written > limit:
+                    raise UploadTooLarge(f"Form field exceeds {limit} bytes")
+                sink(data)
+            if pos >= 0:
+                return written
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+
+    def parse(self):
+        """Returns (fields, files); files is a list of {'name', 'filename', 'size', 'file'}."""
+        fields, files = {}, self.files
+        # Body starts with "--boundary" (no leading CRLF), so prime the buffer with one
+        self._buffer = b"\r\n"
+        self._read_until(self._delimiter, self.MAX_PART_HEADER)
+        while True:
+            while len(self._buffer) < 2 and self._fill():
+                pass
+            if self._buffer.startswith(b"--"):
+                return fields, files # Closing delimiter
+            self._read_until(b"\r\n", self.MAX_PART_HEADER)
+
+            header_block = self._read_until(b"\r\n\r\n", self.MAX_PART_HEADER).decode('utf-8', errors='replace')
+            disposition = ''
+            for line in header_block.split("\r\n"):
+                key, _, value = line.partition(':')
+                if key.strip().lower() == 'content-disposition':
+                    disposition = value.strip()
+            params = _header_params('Content-Disposition', disposition)
+            name = params.get_param('name', header='content-disposition')
+            filename = params.get_filename()
+
+            if filename:
+                f = self._open_file(filename)
+                files.append({"name": name, "filename": filename, "file": f, "size": 0})
+                files[-1]["size"] = self._stream_part(f.write)
+            else:
+                chunks = []
+                self._stream_part(chunks.append, self._max_field_bytes)
+                if name:
+                    fields[name] = b"".join(chunks).decode('utf-8', errors='ignore').strip()
+
+class IncomingAttachment:
+    """Upload being written to a temporary name in the store; hashed as it streams."""
+    def __init__(self, path):
+        self.name = path
+        self.size = 0
+        self._f = open(path, 'wb')
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def close(self):
+        self._f.close()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on a lock file, held by one thread or process at a time.
+    flock() where available; on Windows (no fork, so a single process) msvcrt.locking on its first byte.
+    """
+    with open(path, 'a+') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+            return
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1) # Retries for ~10s, then raises
+                break
+            except OSError:
+                continue
+        try:
+            yield
+        finally:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.end_headers()
+class AttachmentStore:
+    """
+    Content-addressed attachment files.
+    - Each distinct file is kept once as <root>/<sha256>; line_events.filename holds the hash
+    - attachments.ref_count counts the line_events rows pointing at a hash and the file
+      is removed only when the last of them lets go
+    - Uploads stream into a .incoming- temp file while being hashed and are moved into
+      place after the referencing row is committed (or dropped if the content is already stored)
+    - Files saved before the store (uuid names, no attachments row) are removed once no
+      line_events row references them any more
+    Reference counts change inside the caller's transaction; the file side (settle/collect)
+    runs after commit under a lock shared by threads and pre-forked workers.
+    """
+    HASH_NAME = re.compile(r'^[0-9a-f]{64}$')
 
-    def do_DELETE(self):
-        if self.path == '/api/groups':
-            try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data)
-                group_id = data.get('groupId')
-                
-                if not group_id:
-                    self.send_response(400)
-                    self.end_headers()
-                    self.wfile.write(b'Missing groupId')
-                    return
-                
-                conn, c = get_db_connection()
-                # Remove members first (or let CASCADE handle if set, but explicit is safer)
-                ph = "%s" if DATABASE_URL else "?"
-                c.execute(f"DELETE FROM line_group_members WHERE group_id = {ph}", (group_id,))
-                c.execute(f"DELETE FROM line_groups WHERE id = {ph}", (group_id,))
-                conn.commit()
-                conn.close()
-                
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b'{"success": true}')
-            except Exception as e:
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(str(e).encode())
-            return
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
 
-        if self.path == '/api/operational-options':
-            try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data)
-                option_id = data.get('id')
-                user_id = data.get('userId')
+    def path(self, name):
+        return os.path.join(self.root, name)
 
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                c.execute(f"SELECT role FROM users WHERE id = {ph}", (user_id,))
-                user = c.fetchone()
-                if not user or user['role'] != 'MASTER':
-                    self.send_response(403)
-                    self.end_headers()
-                    self.wfile.write(b'Forbidden')
-                    conn.close()
-                    return
+    def is_hash(self, name):
+        return bool(self.HASH_NAME.match(name or ''))
 
-                c.execute(f"DELETE FROM operational_options WHERE id = {ph}", (option_id,))
-                conn.commit()
-                conn.close()
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b'{"success": true}')
-            except Exception as e:
-                self.send_error(500, str(e))
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock, file_lock(self.path('.lock')):
+            yield
+
+    def open_incoming(self, filename):
+        return IncomingAttachment(self.path(f".incoming-{uuid.uuid4()}"))
+
+    def discard(self, incoming):
+        incoming.close()
+        try:
+            os.remove(incoming.name)
+        except FileNotFoundError:
+            pass
+
+    def reference(self, c, incoming):
+        """Takes a reference on a closed upload's content; returns the hash to store in line_events."""
+        sha = incoming.hexdigest()
+        ph = "%s" if DATABASE_URL else "?"
+        c.execute(f"""INSERT INTO attachments (sha256, size, ref_count) VALUES ({ph}, {ph}, 1)
+                      ON CONFLICT(sha256) DO UPDATE SET ref_count = attachments.ref_count + 1""",
+                  (sha, incoming.size))
+        return sha
+
+    def settle(self, incoming):
+        """After commit: moves the upload to its hash name, or drops it when that content is already on disk."""
+        target = self.path(incoming.hexdigest())
+        with self._locked():
+            if os.path.exists(target):
+                os.remove(incoming.name)
+            else:
+                os.replace(incoming.name, target)
+
+    def release(self, c, name):
+        """Drops one reference to a stored file; returns the name if it may now be unused (pass it to collect)."""
+        if not name:
+            return None
+        if not self.is_hash(name):
+            return name
+        ph = "%s" if DATABASE_URL else "?"
+        c.execute(f"UPDATE attachments SET ref_count = ref_count - 1 WHERE sha256 = {ph}", (name,))
+        c.execute(f"DELETE FROM attachments WHERE sha256 = {ph} AND ref_count <= 0", (name,))
+        return name
+
+    def collect(self, names):
+        """After commit: removes the files among names that nothing references any more."""
+        names = [n for n in set(names) if n and not n.startswith('.')]
+        if not names:
             return
+        ph = "%s" if DATABASE_URL else "?"
+        conn, c = get_db_connection()
+        try:
+            with self._locked():
+                for name in names:
+                    if self.is_hash(name):
+                        c.execute(f"SELECT 1 FROM attachments WHERE sha256 = {ph}", (name,))
+                    else:
+                        c.execute(f"SELECT 1 FROM line_events WHERE filename = {ph}", (name,))
+                    if c.fetchone():
+                        continue
+                    try:
+                        os.remove(self.path(name))
+                        log.debug("Attachment %s removed from disk", name)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        log.warning("Error removing attachment %s: %s", name, e)
+                        continue
+                    c.execute(f"DELETE FROM attachment_texts WHERE name = {ph}", (name,))
+            conn.commit()
+        finally:
+            conn.close()
+        mark_tables_changed('attachment_texts')
 
-        if self.path.startswith('/api/analysis'):
-            try:
-                from urllib.parse import urlparse, parse_qs
-                parsed_url = urlparse(self.path)
-                params = parse_qs(parsed_url.query)
-                
-                try:
-                    analysis_id = int(params.get('id', [0])[0])
-                    user_id = int(params.get('userId', [0])[0])
-                except (ValueError, TypeError):
-                    self.send_error(400, "Invalid ID format")
-                    return
-                
-                print(f"[DEBUG] DELETE /api/analysis: analysis_id={analysis_id}, user_id={user_id}")
+    def etag(self, name, st):
+        if self.is_hash(name):
+            return f'"{name}"'
+        return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
 
-                conn, c = get_db_connection()
-                
-                ph = "%s" if DATABASE_URL else "?"
-                # Check user role
-                c.execute(f"SELECT role FROM users WHERE id = {ph}", (user_id,))
-                user = c.fetchone()
-                if not user:
-                    print(f"[DEBUG] User {user_id} not found")
-                    self.send_response(401)
-                    self.end_headers()
-                    self.wfile.write(b'User not found')
-                    conn.close()
-                    return
+attachment_store = AttachmentStore(UPLOAD_DIR)
 
-                if user['role'] != 'MASTER':
-                    print(f"[DEBUG] User {user_id} has role {user['role']}, MASTER required")
-                    self.send_response(403)
-                    self.end_headers()
-                    self.wfile.write(b'Forbidden: Only Master users can delete analyses')
-                    conn.close()
-                    return
+class SearchIndex:
+    """
+    Full-text search over line events and the text of their attachments.
+    - SQLite: FTS5 tables over line_events (kept in step by triggers) and attachment_texts;
+      Postgres: GIN indexes on the matching to_tsvector expressions
+    - A background thread extracts text from attachment files (DOCX and XLSX always, PDF
+      when pypdf is installed) into attachment_texts, once per stored file; it scans
+      every `interval` seconds and right after an upload in its own process
+    - Results are ranked by relevance; a hit in an attachment counts for less than one
+      in the event's own fields
+    - SQLite builds without FTS5 fall back to LIKE scans
+    """
+    EVENT_TSVECTOR = ("to_tsvector('portuguese', COALESCE(fact, '') || ' ' || COALESCE(cause, '') || ' ' || "
+                      "COALESCE(action_taken, '') || ' ' || COALESCE(analysis_conclusion, ''))")
+    ATTACHMENT_TSVECTOR = "to_tsvector('portuguese', COALESCE(content, ''))"
+    ATTACHMENT_WEIGHT = 0.5
+    MAX_TERMS = 20
+    DOCX_PARAGRAPH = re.compile(r'</w:p>|<w:br/>|<w:tab/>')
+    DOCX_TEXT = re.compile(r'<w:t(?:\s[^>]*)?>([^<]*)</w:t>|(\n)')
+
+    def __init__(self, interval, text_max):
+        self.interval = interval
+        self.text_max = text_max
+        self.fts5 = False
+        self._wake = threading.Event()
+        self._thread = None
+        self.extracted = 0
+        self.unsupported = 0
+        self.failed = 0
+
+    def setup(self, c):
+        """Creates the search structures (called from init_db)."""
+        if DATABASE_URL:
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_line_events_fts ON line_events USING GIN ({self.EVENT_TSVECTOR})")
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_attachment_texts_fts ON attachment_texts USING GIN ({self.ATTACHMENT_TSVECTOR})")
+            return
+        try:
+            c.execute("SELECT name FROM sqlite_master WHERE name = 'line_events_fts'")
+            existed = c.fetchone() is not None
+            # External-content tables: the text lives in line_events / attachment_texts, triggers mirror changes
+            c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS line_events_fts USING fts5(
+                fact, cause, action_taken, analysis_conclusion,
+                content='line_events', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""")
+            c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS attachment_texts_fts USING fts5(
+                content, content='attachment_texts', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""")
+            for table, fts, cols in (('line_events', 'line_events_fts', 'fact, cause, action_taken, analysis_conclusion'),
+                                     ('attachment_texts', 'attachment_texts_fts', 'content')):
+                new_cols = ', '.join(f"new.{col.strip()}" for col in cols.split(','))
+                old_cols = ', '.join(f"old.{col.strip()}" for col in cols.split(','))
+                c.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols});
+                END""")
+                c.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                END""")
+                c.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols});
+                END""")
+                if not existed:
+                    c.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            self.fts5 = True
+        except sqlite3.OperationalError as e:
+            log.warning("SQLite without FTS5 (%s); search falls back to LIKE scans", e)
+
+    def terms(self, q):
+        return re.findall(r'\w+', (q or '').lower())[:self.MAX_TERMS]
+
+    def search(self, q, limit):
+        """[(event_id, score, in_event, in_attachment)] best first; every term must match (prefixes allowed)."""
+        terms = self.terms(q)
+        if not terms:
+            return []
+        if DATABASE_URL:
+            sql, params = self._postgres_query(terms, limit)
+        elif self.fts5:
+            sql, params = self._fts5_query(terms, limit)
+        else:
+            sql, params = self._like_query(terms, limit)
+        conn, c = get_db_connection()
+        try:
+            c.execute(sql, params)
+            return [(row[0], float(row[1] or 0), bool(row[2]), bool(row[3])) for row in c.fetchall()]
+        finally:
+            conn.close()
 
-                # Get filename to delete from disk
-                c.execute(f"SELECT filename FROM line_events WHERE id = {ph}", (analysis_id,))
-                row = c.fetchone()
-                if row:
-                    file_name = row['filename']
-                    print(f"[DEBUG] Found record in line_events, filename={file_name}")
-                    try:
-                        file_path = os.path.join(UPLOAD_DIR, file_name)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            print(f"[DEBUG] File {file_path} removed from disk")
-                    except Exception as e:
-                        print(f"[DEBUG] Error removing file: {e}")
-                    
-                    c.execute(f"DELETE FROM line_events WHERE id = {ph}", (analysis_id,))
-                    conn.commit()
-                    conn.close()
-                    
-                    self.send_response(200)
-                    self.end_headers()
-                    self.wfile.write(b'{"success": true}')
+    def _fts5_query(self, terms, limit):
+        match = ' '.join(f'"{t}"*' for t in terms)
+        return f"""
+            WITH hits AS (
+                SELECT rowid AS event_id, -bm25(line_events_fts) AS score, 1 AS in_event, 0 AS in_attachment
+                FROM line_events_fts WHERE line_events_fts MATCH ?
+                UNION ALL
+                SELECT e.id, -bm25(attachment_texts_fts) * {self.ATTACHMENT_WEIGHT}, 0, 1
+                FROM attachment_texts_fts
+                JOIN attachment_texts a ON a.id = attachment_texts_fts.rowid
+                JOIN line_events e ON e.filename = a.name
+                WHERE attachment_texts_fts MATCH ?
+            )
+            SELECT event_id, SUM(score) AS score, MAX(in_event), MAX(in_attachment)
+            FROM hits GROUP BY event_id ORDER BY score DESC, event_id DESC LIMIT ?""", (match, match, limit)
+
+    def _postgres_query(self, terms, limit):
+        query = ' & '.join(f"{t}:*" for t in terms)
+        return f"""
+            WITH q AS (SELECT to_tsquery('portuguese', %s) AS query),
+            hits AS (
+                SELECT e.id AS event_id, ts_rank({self.EVENT_TSVECTOR}, q.query) AS score, 1 AS in_event, 0 AS in_attachment
+                FROM line_events e, q WHERE {self.EVENT_TSVECTOR} @@ q.query
+                UNION ALL
+                SELECT e.id, ts_rank({self.ATTACHMENT_TSVECTOR}, q.query) * {self.ATTACHMENT_WEIGHT}, 0, 1
+                FROM attachment_texts a JOIN line_events e ON e.filename = a.name, q
+                WHERE {self.ATTACHMENT_TSVECTOR} @@ q.query
+            )
+            SELECT event_id, SUM(score) AS score, MAX(in_event), MAX(in_attachment)
+            FROM hits GROUP BY event_id ORDER BY score DESC, event_id DESC LIMIT %s""", (query, limit)
+
+    def _like_query(self, terms, limit):
+        fields = " || ' ' || ".join(f"COALESCE(e.{f}, '')" for f in ('fact', 'cause', 'action_taken', 'analysis_conclusion'))
+        in_event = ' AND '.join([f"LOWER({fields}) LIKE ? ESCAPE '\\'"] * len(terms))
+        in_attachment = ' AND '.join(["LOWER(COALESCE(a.content, '')) LIKE ? ESCAPE '\\'"] * len(terms))
+        patterns = [f"%{like_escape(t)}%" for t in terms]
+        return f"""
+            SELECT e.id, 0, CASE WHEN {in_event} THEN 1 ELSE 0 END, CASE WHEN a.id IS NOT NULL AND {in_attachment} THEN 1 ELSE 0 END
+            FROM line_events e LEFT JOIN attachment_texts a ON a.name = e.filename
+            WHERE ({in_event}) OR (a.id IS NOT NULL AND {in_attachment})
+            ORDER BY e.id DESC LIMIT ?""", patterns * 4 + [limit]
+
+    def extract(self, path):
+        """Plain text of a DOCX, XLSX or PDF file, or None if the format is not supported.
+        Stored files have no extension, so the format is told by content."""
+        with open(path, 'rb') as f:
+            head = f.read(5)
+        parts, size = [], 0
+        def add(text):
+            nonlocal size
+            if text and size < self.text_max:
+                parts.append(text)
+                size += len(text) + 1
+            return size < self.text_max
+
+        if head.startswith(b'%PDF'):
+            if pypdf is None:
+                return None
+            for page in pypdf.PdfReader(path).pages:
+                if not add(page.extract_text()):
+                    break
+        elif head.startswith(b'PK'):
+            with zipfile.ZipFile(path) as z:
+                names = set(z.namelist())
+                if 'word/document.xml' in names:
+                    xml = self.DOCX_PARAGRAPH.sub('\n', z.read('word/document.xml').decode('utf-8', errors='ignore'))
+                    add(html.unescape(''.join(m.group(1) or m.group(2) for m in self.DOCX_TEXT.finditer(xml))))
+                elif 'xl/workbook.xml' in names:
+                    # Passed as a file object: openpyxl refuses paths without an .xlsx extension
+                    with open(path, 'rb') as f:
+                        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+                        try:
+                            for ws in wb.worksheets:
+                                for row in ws.iter_rows(values_only=True):
+                                    if not add(' '.join(str(v) for v in row if v is not None)):
+                                        break
+                        finally:
+                            wb.close()
                 else:
-                    print(f"[DEBUG] Record with id {analysis_id} not found in line_events")
-                    conn.close()
-                    self.send_response(404)
-                    self.end_headers()
-                    self.wfile.write(b'Event not found')
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                self.send_error(500, str(e))
-            return
+                    return None
+        else:
+            return None
+        # Postgres rejects NUL characters in text
+        return '\n'.join(parts)[:self.text_max].replace('\x00', '')
 
-        if self.path.startswith('/api/line-events'):
-            try:
-                from urllib.parse import urlparse, parse_qs
-                parsed_url = urlparse(self.path)
-                params = parse_qs(parsed_url.query)
-                
-                event_id = int(params.get('id', [0])[0])
-                user_id = int(params.get('userId', [0])[0])
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+        self._thread.start()
 
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                
-                c.execute(f"SELECT role FROM users WHERE id = {ph}", (user_id,))
-                user = c.fetchone()
-                if not user or user['role'] != 'MASTER':
-                    self.send_response(403)
-                    self.end_headers()
-                    self.wfile.write(b'Forbidden')
-                    conn.close()
-                    return
+    def notify(self):
+        """Asks the background thread to look for new attachments now."""
+        self._wake.set()
 
-                # Get filename to delete from disk
-                c.execute(f"SELECT filename FROM line_events WHERE id = {ph}", (event_id,))
-                row = c.fetchone()
-                if row and row['filename']:
-                    try:
-                        file_path = os.path.join(UPLOAD_DIR, row['filename'])
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                    except: pass
-                
-                c.execute(f"DELETE FROM line_events WHERE id = {ph}", (event_id,))
+    def _run(self):
+        while True:
+            try:
+                self.index_pending()
+            except Exception as e:
+                log.warning("Attachment text indexing failed: %s", e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def index_pending(self):
+        """Extracts the text of every referenced attachment that has no attachment_texts row yet."""
+        conn, c = get_db_connection()
+        try:
+            c.execute("""SELECT DISTINCT e.filename FROM line_events e
+                         LEFT JOIN attachment_texts a ON a.name = e.filename
+                         WHERE e.filename IS NOT NULL AND e.filename <> '' AND a.id IS NULL""")
+            names = [row[0] for row in c.fetchall()]
+        finally:
+            conn.close()
+
+        indexed = 0
+        for name in names:
+            path = attachment_store.path(name)
+            if not os.path.exists(path):
+                continue # not moved into place yet, or missing on disk
+            try:
+                text = self.extract(path)
+                status = 'ok' if text is not None else 'unsupported'
+            except Exception as e:
+                log.warning("Could not extract text from attachment %s: %s", name, e, extra={'rate_key': 'attachment-extract'})
+                text, status = None, 'error'
+            conn, c = get_db_connection()
+            try:
+                ph = "%s" if DATABASE_URL else "?"
+                c.execute(f"""INSERT INTO attachment_texts (name, status, content) VALUES ({ph}, {ph}, {ph})
+                              ON CONFLICT(name) DO NOTHING""", (name, status, text))
                 conn.commit()
+            finally:
                 conn.close()
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b'{"success": true}')
-            except Exception as e:
-                self.send_error(500, str(e))
+            indexed += 1
+            if status == 'ok':
+                self.extracted += 1
+            elif status == 'unsupported':
+                self.unsupported += 1
+            else:
+                self.failed += 1
+        if indexed:
+            mark_tables_changed('attachment_texts')
+            log.info("Indexed the text of %d attachment(s)", indexed)
+
+    def stats(self):
+        return {
+            "engine": "postgres" if DATABASE_URL else ("fts5" if self.fts5 else "like"),
+            "pdf_support": pypdf is not None,
+            "extracted": self.extracted,
+            "unsupported": self.unsupported,
+            "failed": self.failed
+        }
+
+search_index = SearchIndex(SEARCH_INDEX_INTERVAL, ATTACHMENT_TEXT_MAX)
+
+class BusLinePartitions:
+    """
+    Monthly range partitions of bus_lines on Postgres: bus_lines_yYYYYmMM, keyed on date (DATE).
+    - New databases create bus_lines partitioned; an existing plain table keeps working
+      unpartitioned until migrate_partition_bus_lines.py converts it
+    - A row whose month has no partition is rejected, so imports (and archive restores)
+      call ensure() for the months they are about to write
+    - Old months are detached (kept as a standalone <partition>_detached table) or dropped,
+      both catalog operations instead of DELETEs over the whole table
+    """
+    DDL = '''CREATE TABLE IF NOT EXISTS bus_lines (
+        id SERIAL,
+        date DATE NOT NULL,
+        line_code TEXT NOT NULL,
+        line_name TEXT,
+        company TEXT NOT NULL,
+        predicted_passengers REAL DEFAULT 0,
+        realized_passengers REAL DEFAULT 0,
+        PRIMARY KEY (id, date),
+        UNIQUE(date, line_code, company)
+    ) PARTITION BY RANGE (date)'''
+    LOCK_KEY = "hashtext('bus_lines_partitions')"
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.created = 0
+        self.detached = 0
+        self.dropped = 0
+
+    @staticmethod
+    def name(year, month):
+        return f"bus_lines_y{year:04d}m{month:02d}"
+
+    @staticmethod
+    def bounds(year, month):
+        """First day of the month and first day of the next one, as 'YYYY-MM-DD'."""
+        following = (year + 1, 1) if month == 12 else (year, month + 1)
+        return f"{year:04d}-{month:02d}-01", f"{following[0]:04d}-{following[1]:02d}-01"
+
+    @staticmethod
+    def month_dates(year, month):
+        first = datetime(year, month, 1)
+        return {(first + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(31) if (first + timedelta(days=i)).month == month}
+
+    def setup(self, c):
+        """Called by init_db on Postgres: creates bus_lines (partitioned) if missing and detects its layout."""
+        c.execute(self.DDL)
+        c.execute("SELECT relkind FROM pg_class WHERE oid = 'bus_lines'::regclass")
+        self.enabled = c.fetchone()[0] == 'p'
+        if not self.enabled:
+            log.warning("bus_lines is not partitioned; run migrate_partition_bus_lines.py to convert it")
+
+    def _existing(self, c):
+        c.execute("""
+            SELECT child.relname FROM pg_inherits i JOIN pg_class child ON child.oid = i.inhrelid
+            WHERE i.inhparent = 'bus_lines'::regclass
+        """)
+        return {r[0] for r in c.fetchall()}
+
+    def months(self):
+        """(year, month) of every attached partition, oldest first."""
+        conn, c = get_db_connection()
+        try:
+            names = self._existing(c)
+        finally:
+            conn.close()
+        found = (re.fullmatch(r'bus_lines_y(\d{4})m(\d{2})', name) for name in names)
+        return sorted((int(m.group(1)), int(m.group(2))) for m in found if m)
+
+    def ensure(self, dates):
+        """Creates the missing partitions of the months these 'YYYY-MM-DD' dates fall in."""
+        if not self.enabled or not dates:
             return
+        months = {LineArchive.month_of(d) for d in dates}
+        conn, c = get_db_connection()
+        try:
+            # One creator at a time across processes; IF NOT EXISTS alone still races in the catalog
+            c.execute(f"SELECT pg_advisory_xact_lock({self.LOCK_KEY})")
+            existing = self._existing(c)
+            missing = sorted(m for m in months if self.name(*m) not in existing)
+            for year, month in missing:
+                first, following = self.bounds(year, month)
+                c.execute(f"CREATE TABLE {self.name(year, month)} PARTITION OF bus_lines FOR VALUES FROM ('{first}') TO ('{following}')")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if missing:
+            with self._lock:
+                self.created += len(missing)
+            log.info("Created bus_lines partitions: %s", ', '.join(self.name(*m) for m in missing))
+
+    def detach_in(self, c, year, month, drop=False):
+        """Detaches one month's partition inside the caller's transaction, then drops it or renames it <name>_detached."""
+        name = self.name(year, month)
+        c.execute(f"SELECT pg_advisory_xact_lock({self.LOCK_KEY})")
+        if name not in self._existing(c):
+            raise ValueError(f"Partição {name} não encontrada")
+        c.execute(f"ALTER TABLE bus_lines DETACH PARTITION {name}")
+        if drop:
+            c.execute(f"DROP TABLE {name}")
+        else:
+            # Renamed so a later import into this month can create a fresh partition
+            c.execute(f"ALTER TABLE {name} RENAME TO {name}_detached")
+        with self._lock:
+            if drop:
+                self.dropped += 1
+            else:
+                self.detached += 1
 
-    def do_POST(self):
-        if self.path == '/api/operational-options':
-            try:
-                content_length = int(self.headers.get('Content-Length', 0))
-                post_data = self.rfile.read(content_length).decode('utf-8')
-                data = json.loads(post_data)
-                
-                type_opt = data.get('type')
-                label = data.get('label')
-                opt_id = data.get('id') # If present, it's an EDIT
-                user_id = data.get('userId')
+    def detach(self, year, month, drop=False):
+        conn, c = get_db_connection()
+        try:
+            self.detach_in(c, year, month, drop)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        mark_tables_changed('bus_lines', dates=self.month_dates(year, month))
+        line_stats.refresh(self.month_dates(year, month))
+        log.info("%s bus_lines partition %s", "Dropped" if drop else "Detached", self.name(year, month))
 
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                c.execute(f"SELECT role FROM users WHERE id = {ph}", (user_id,))
-                user = c.fetchone()
-                if not user or user['role'] != 'MASTER':
-                    self.send_response(403)
-                    self.end_headers()
-                    self.wfile.write(b'Forbidden')
-                    conn.close()
-                    return
+    def describe(self):
+        """Attached partitions with their planner row estimate and size on disk."""
+        conn, c = get_db_connection()
+        try:
+            c.execute("""
+                SELECT child.relname, child.reltuples, pg_total_relation_size(child.oid)
+                FROM pg_inherits i JOIN pg_class child ON child.oid = i.inhrelid
+                WHERE i.inhparent = 'bus_lines'::regclass
+                ORDER BY child.relname
+            """)
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        partitions = []
+        for name, tuples, size in rows:
+            m = re.fullmatch(r'bus_lines_y(\d{4})m(\d{2})', name)
+            partitions.append({"month": f"{m.group(1)}-{m.group(2)}" if m else None, "table": name,
+                               "rows_estimate": max(int(tuples), 0), "bytes": size})
+        return partitions
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "created": self.created, "detached": self.detached, "dropped": self.dropped}
+
+bus_line_partitions = BusLinePartitions()
+
+class LineArchive:
+    """
+    Parquet archive tier for closed months of bus_lines.
+    - Each archived month is one file, <directory>/year=YYYY/month=MM/data.parquet, and its rows
+      are deleted from bus_lines: a month lives either in the table or in the archive, never both
+    - Reads open only the files of the months a date range touches and push the date/line
+      filters and the column list down to the Parquet reader
+    - An import that touches an archived month restores the month into bus_lines first
+    - clear_bus_lines edits archived months in place (clear_month) instead of restoring them
+    - The list of archived months is rescanned when the bus_lines version changes (archiving and
+      restoring bump it), so every worker process sees the same months
+    """
+    COLUMNS = ['id', 'date', 'line_code', 'line_name', 'company', 'predicted_passengers', 'realized_passengers']
+    ROW_GROUP_SIZE = 50000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._months = None
+        self._version = None
+        self.reads = 0
+        self.rows_read = 0
+
+    @property
+    def available(self):
+        return pyarrow is not None
+
+    def path(self, year, month):
+        return os.path.join(self.directory, f"year={year:04d}", f"month={month:02d}", "data.parquet")
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, file_lock(os.path.join(self.directory, '.lock')):
+            yield
+
+    @staticmethod
+    def month_of(date):
+        """(year, month) of a 'YYYY-MM-DD' (or 'YYYY-MM') string."""
+        return int(str(date)[:4]), int(str(date)[5:7])
+
+    def months(self):
+        """Archived (year, month) pairs."""
+        version = table_versions.snapshot(('bus_lines',))
+        with self._lock:
+            if self._months is not None and self._version == version:
+                return self._months
+        found = set()
+        try:
+            years = os.listdir(self.directory)
+        except OSError:
+            years = []
+        for year_dir in years:
+            y = re.fullmatch(r'year=(\d{4})', year_dir)
+            if not y:
+                continue
+            try:
+                month_dirs = os.listdir(os.path.join(self.directory, year_dir))
+            except OSError:
+                continue
+            for month_dir in month_dirs:
+                m = re.fullmatch(r'month=(\d{2})', month_dir)
+                if m and os.path.exists(self.path(int(y.group(1)), int(m.group(1)))):
+                    found.add((int(y.group(1)), int(m.group(1))))
+        with self._lock:
+            self._months, self._version = frozenset(found), version
+        return self._months
+
+    def months_between(self, start=None, end=None):
+        """Archived months touched by a date range (either end may be open), oldest first."""
+        low = self.month_of(start) if start else (0, 0)
+        high = self.month_of(end) if end else (9999, 12)
+        return sorted(m for m in self.months() if low <= m <= high)
+
+    def read(self, start=None, end=None, lines=None, columns=None):
+        """Archived rows (dicts) in a date range, optionally only of these lines."""
+        months = self.months_between(start, end)
+        if not months:
+            return []
+        if pyarrow is None:
+            raise RuntimeError("Há meses arquivados em Parquet, mas o pacote pyarrow não está instalado")
+        condition = None
+        for expr in ((pa_dataset.field('date') >= start) if start else None,
+                     (pa_dataset.field('date') <= end) if end else None,
+                     pa_dataset.field('line_code').isin(list(lines)) if lines else None):
+            if expr is not None:
+                condition = expr if condition is None else condition & expr
+        dataset = pa_dataset.dataset([self.path(y, m) for y, m in months], format='parquet')
+        rows = dataset.to_table(columns=columns or self.COLUMNS, filter=condition).to_pylist()
+        with self._lock:
+            self.reads += 1
+            self.rows_read += len(rows)
+        return rows
+
+    def iter_rows(self, start=None, end=None, lines=None, companies=None, after=None):
+        """
+        Archived rows as COLUMNS tuples in (date, id) order, optionally of these lines/companies
+        and only past after=(date, id). Streams one month at a time, so memory is bounded by a
+        month (as when it was archived), not by the range.
+        """
+        months = self.months_between(start, end)
+        if after:
+            months = [m for m in months if m >= self.month_of(after[0])]
+        if not months:
+            return
+        if pyarrow is None:
+            raise RuntimeError("Há meses arquivados em Parquet, mas o pacote pyarrow não está instalado")
+        field = pa_dataset.field
+        condition = None
+        for expr in ((field('date') >= start) if start else None,
+                     (field('date') <= end) if end else None,
+                     field('line_code').isin(list(lines)) if lines else None,
+                     field('company').isin(list(companies)) if companies else None,
+                     ((field('date') > after[0]) | ((field('date') == after[0]) & (field('id') > after[1]))) if after else None):
+            if expr is not None:
+                condition = expr if condition is None else condition & expr
+        for year, month in months:
+            table = pa_dataset.dataset(self.path(year, month), format='parquet').to_table(columns=self.COLUMNS, filter=condition)
+            table = table.sort_by([('date', 'ascending'), ('id', 'ascending')])
+            with self._lock:
+                self.reads += 1
+                self.rows_read += table.num_rows
+            for batch in table.to_batches(max_chunksize=EXPORT_FETCH_SIZE):
+                yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    def date_of(self, row_id):
+        """Date of an archived row by id, or None."""
+        months = sorted(self.months())
+        if not months or pyarrow is None:
+            return None
+        table = pa_dataset.dataset([self.path(y, m) for y, m in months], format='parquet').to_table(
+            columns=['date'], filter=pa_dataset.field('id') == row_id)
+        return table.column('date')[0].as_py() if table.num_rows else None
+
+    def daily_realized(self, start, end, line_code=None):
+        """
+        date -> archived realized passengers in a range: of one line (its first row, as the
+        live per-day lookups take it) or, without line_code, summed over all lines.
+        """
+        totals = {}
+        for r in self.read(start, end, [line_code] if line_code else None, ['date', 'realized_passengers']):
+            if line_code:
+                totals.setdefault(r['date'], r['realized_passengers'])
+            else:
+                totals[r['date']] = totals.get(r['date'], 0) + (r['realized_passengers'] or 0)
+        return totals
+
+    def line_codes(self):
+        """Distinct line codes present in the archive."""
+        months = self.months()
+        if not months:
+            return set()
+        if pyarrow is None:
+            raise RuntimeError("Há meses arquivados em Parquet, mas o pacote pyarrow não está instalado")
+        dataset = pa_dataset.dataset([self.path(y, m) for y, m in sorted(months)], format='parquet')
+        return set(dataset.to_table(columns=['line_code']).column('line_code').unique().to_pylist())
+
+    def _schema(self):
+        return pyarrow.schema([
+            ('id', pyarrow.int64()), ('date', pyarrow.string()), ('line_code', pyarrow.string()),
+            ('line_name', pyarrow.string()), ('company', pyarrow.string()),
+            ('predicted_passengers', pyarrow.float64()), ('realized_passengers', pyarrow.float64())
+        ])
+
+    def live_months(self, before):
+        """'YYYY-MM' months that still have rows in bus_lines before the given 'YYYY-MM'."""
+        ph = "%s" if DATABASE_URL else "?"
+        conn, c = get_db_connection()
+        try:
+            c.execute(f"SELECT DISTINCT SUBSTR(CAST(date AS TEXT), 1, 7) FROM bus_lines WHERE date < {ph} ORDER BY 1", (f"{before}-01",))
+            return [r[0] for r in c.fetchall()]
+        finally:
+            conn.close()
 
-                if opt_id:
-                    c.execute(f"UPDATE operational_options SET label = {ph} WHERE id = {ph}", (label, opt_id))
+    def archive_month(self, year, month):
+        """Moves one month of bus_lines into its Parquet file; returns the number of rows moved."""
+        if pyarrow is None:
+            raise RuntimeError("O arquivo Parquet requer o pacote pyarrow")
+        ph = "%s" if DATABASE_URL else "?"
+        first, following = BusLinePartitions.bounds(year, month)
+        path = self.path(year, month)
+        with self._locked():
+            if os.path.exists(path):
+                raise ValueError(f"{year:04d}-{month:02d} já está arquivado")
+            conn, c = get_db_connection()
+            try:
+                # Sorted so row-group statistics on date/line_code let reads skip most of the file
+                c.execute(f"SELECT {', '.join(self.COLUMNS)} FROM bus_lines WHERE date >= {ph} AND date < {ph} ORDER BY date, line_code, company", (first, following))
+                rows = [dict(zip(self.COLUMNS, r)) for r in c.fetchall()]
+                if not rows:
+                    return 0
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{uuid.uuid4().hex[:8]}.part"
+                try:
+                    pa_parquet.write_table(pyarrow.Table.from_pylist(rows, schema=self._schema()), tmp,
+                                           row_group_size=self.ROW_GROUP_SIZE, compression='zstd')
+                    if bus_line_partitions.enabled:
+                        bus_line_partitions.detach_in(c, year, month, drop=True)
+                    else:
+                        c.execute(f"DELETE FROM bus_lines WHERE date >= {ph} AND date < {ph}", (first, following))
+                    os.replace(tmp, path)
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    for leftover in (tmp, path):
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+                    raise
+            finally:
+                conn.close()
+        mark_tables_changed('bus_lines', dates={r['date'] for r in rows})
+        log.info("Archived %04d-%02d: %d rows -> %s", year, month, len(rows), path)
+        return len(rows)
+
+    def restore_month(self, year, month):
+        """Moves an archived month back into bus_lines; returns the number of rows restored."""
+        if pyarrow is None:
+            raise RuntimeError("O arquivo Parquet requer o pacote pyarrow")
+        ph = "%s" if DATABASE_URL else "?"
+        path = self.path(year, month)
+        with self._locked():
+            if not os.path.exists(path):
+                return 0
+            rows = pa_parquet.read_table(path, columns=self.COLUMNS).to_pylist()
+            bus_line_partitions.ensure({r['date'] for r in rows})
+            conn, c = get_db_connection()
+            try:
+                # Original ids are kept; sequences never hand them out again
+                insert = f"""
+                    INSERT INTO bus_lines ({', '.join(self.COLUMNS)}) VALUES ({', '.join([ph] * len(self.COLUMNS))})
+                    ON CONFLICT(date, line_code, company) DO NOTHING
+                """
+                data = [tuple(r[col] for col in self.COLUMNS) for r in rows]
+                if DATABASE_URL:
+                    extras.execute_batch(c, insert, data)
                 else:
-                    c.execute(f"INSERT INTO operational_options (type, label) VALUES ({ph}, {ph})", (type_opt, label))
-                
+                    c.executemany(insert, data)
                 conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
                 conn.close()
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b'{"success": true}')
-            except Exception as e:
-                self.send_error(500, str(e))
-            return
-        print(f"DEBUG: do_POST Path='{self.path}'")
-        if self.path.startswith('/api/clear-data'):
+            os.remove(path)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(path))
+        mark_tables_changed('bus_lines', dates={r['date'] for r in rows})
+        log.info("Restored %04d-%02d from the archive: %d rows", year, month, len(rows))
+        return len(rows)
+
+    def drop_month(self, year, month):
+        """Deletes an archived month's file (its rows are gone for good)."""
+        path = self.path(year, month)
+        with self._locked():
+            if not os.path.exists(path):
+                return False
+            os.remove(path)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(path))
+        mark_tables_changed('bus_lines', dates=BusLinePartitions.month_dates(year, month))
+        line_stats.refresh(BusLinePartitions.month_dates(year, month))
+        log.info("Dropped archived month %04d-%02d", year, month)
+        return True
+
+    def clear_month(self, year, month, predicted, realized, start=None, end=None, lines=None, companies=None):
+        """
+        clear_bus_lines inside an archived month: zeroes predicted and/or realized of the rows in
+        scope and deletes the rows left with both at zero, rewriting the file (the month stays
+        archived; the file goes when no row is left). Returns (deleted, updated).
+        """
+        if pyarrow is None:
+            raise RuntimeError("O arquivo Parquet requer o pacote pyarrow")
+        path = self.path(year, month)
+        lines, companies = set(lines or ()), set(companies or ())
+        cleared = [col for col, wanted in (('predicted_passengers', predicted), ('realized_passengers', realized)) if wanted]
+        deleted = updated = 0
+        dates = set()
+        with self._locked():
+            if not os.path.exists(path):
+                return 0, 0
+            kept = []
+            for r in pa_parquet.read_table(path, columns=self.COLUMNS).to_pylist():
+                in_scope = ((not start or r['date'] >= start) and (not end or r['date'] <= end)
+                            and (not lines or r['line_code'] in lines) and (not companies or r['company'] in companies))
+                if in_scope:
+                    changed = [col for col in cleared if r[col]]
+                    for col in changed:
+                        r[col] = 0
+                    if not r['predicted_passengers'] and not r['realized_passengers']:
+                        deleted += 1
+                        dates.add(r['date'])
+                        continue
+                    if changed:
+                        updated += 1
+                        dates.add(r['date'])
+                kept.append(r)
+            if not dates:
+                return 0, 0
+            if kept:
+                tmp = f"{path}.{uuid.uuid4().hex[:8]}.part"
+                try:
+                    pa_parquet.write_table(pyarrow.Table.from_pylist(kept, schema=self._schema()), tmp,
+                                           row_group_size=self.ROW_GROUP_SIZE, compression='zstd')
+                    os.replace(tmp, path)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            else:
+                os.remove(path)
+                with contextlib.suppress(OSError):
+                    os.rmdir(os.path.dirname(path))
+        mark_tables_changed('bus_lines', dates=dates)
+        log.info("Cleared archived month %04d-%02d: %d rows deleted, %d updated", year, month, deleted, updated)
+        return deleted, updated
+
+    def restore_dates(self, dates):
+        """Restores every archived month among these dates (imports call this before writing)."""
+        archived = self.months()
+        for year, month in sorted({self.month_of(d) for d in dates} & archived):
+            self.restore_month(year, month)
+
+    def describe(self):
+        months = []
+        for year, month in sorted(self.months()):
+            path = self.path(year, month)
             try:
-                content_length = int(self.headers.get('Content-Length', 0))
-                post_data = self.rfile.read(content_length).decode('utf-8')
-                data = json.loads(post_data)
-                user_id = data.get('userId')
-                targets = data.get('targets', [])  # List of strings: 'actions', 'predicted', 'realized', 'groups', 'distribution'
-                
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                
-                # Security: Only MASTER can wipe
-                c.execute(f"SELECT role FROM users WHERE id = {ph}", (user_id,))
-                user = c.fetchone()
-                if not user or user[0] != 'MASTER':
-                    self.send_error(403, "Acesso Negado")
-                    conn.close()
-                    return
+                size = os.path.getsize(path)
+                rows = pa_parquet.ParquetFile(path).metadata.num_rows if pyarrow else None
+            except OSError:
+                continue
+            months.append({"month": f"{year:04d}-{month:02d}", "rows": rows, "bytes": size})
+        return months
 
-                if 'actions' in targets:
-                    c.execute("DELETE FROM line_events")
-                    c.execute("DELETE FROM occurrences")
-                
-                if 'predicted' in targets:
-                    c.execute("UPDATE bus_lines SET predicted_passengers = 0")
-                
-                if 'realized' in targets:
-                    c.execute("UPDATE bus_lines SET realized_passengers = 0")
-                
-                if 'groups' in targets:
-                    c.execute("DELETE FROM line_groups")
-                    # Cascade should handle members if ON DELETE CASCADE is set, but let's be safe
-                    c.execute("DELETE FROM line_group_members")
-                
-                if 'distribution' in targets and 'groups' not in targets:
-                    # If wiping distribution but keeping groups
-                    c.execute("DELETE FROM line_group_members")
+    def stats(self):
+        with self._lock:
+            return {"available": self.available, "months": len(self._months or ()), "reads": self.reads, "rows_read": self.rows_read}
+
+line_archive = LineArchive(ARCHIVE_DIR)
+
+class LineStats:
+    """
+    Per-line, per-weekday aggregates of bus_lines by month (line_stats table), behind the
+    line detail summary.
+    - One row per (line_code, month, weekday 0=Sunday..6) with the number of days, the predicted
+      and realized totals and the realized min/max of a day (a day sums all companies)
+    - refresh() recomputes only the months (and lines) a write touched; archived months are read
+      from the Parquet archive, so archiving and restoring leave the table as it is
+    - summary() takes the whole months of a range from line_stats and aggregates from bus_lines
+      only the partial months at its edges and the recent days the trend compares
+    """
+    TREND_DAYS = 3 # recent days compared with the same number of days before them
+    MAX_LINE_FILTER = 500 # larger line sets refresh whole months (keeps IN lists short)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.months_refreshed = 0
+        self.summaries = 0
+
+    def setup(self, c):
+        c.execute('''CREATE TABLE IF NOT EXISTS line_stats (
+            line_code TEXT NOT NULL,
+            month TEXT NOT NULL,
+            weekday INTEGER NOT NULL,
+            days INTEGER NOT NULL,
+            predicted_total REAL NOT NULL DEFAULT 0,
+            realized_total REAL NOT NULL DEFAULT 0,
+            realized_min REAL,
+            realized_max REAL,
+            PRIMARY KEY (line_code, month, weekday)
+        )''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_line_stats_month ON line_stats (month)")
+
+    @staticmethod
+    def weekday(date):
+        """0 = Sunday .. 6 = Saturday, as JavaScript's getDay()."""
+        return datetime.strptime(str(date)[:10], '%Y-%m-%d').isoweekday() % 7
+
+    @staticmethod
+    def month_range(month):
+        """'YYYY-MM' -> (first day, last day)."""
+        first, following = BusLinePartitions.bounds(int(month[:4]), int(month[5:7]))
+        return first, (datetime.strptime(following, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def daily(self, start, end, lines=None):
+        """{(line_code, date): [predicted, realized]} per day of a date range, live and archived rows."""
+        ph = "%s" if DATABASE_URL else "?"
+        query = f"""
+            SELECT line_code, date, SUM(predicted_passengers), SUM(realized_passengers)
+            FROM bus_lines WHERE date >= {ph} AND date <= {ph}
+        """
+        args = [start, end]
+        if lines:
+            query += f" AND line_code IN ({','.join([ph] * len(lines))})"
+            args.extend(lines)
+        # Not the read mirror: refresh() runs right after a write the mirror may not have yet
+        conn, c = get_db_connection()
+        try:
+            c.execute(query + " GROUP BY line_code, date", args)
+            totals = {(r[0], str(r[1])[:10]): [r[2] or 0, r[3] or 0] for r in c.fetchall()}
+        finally:
+            conn.close()
+        for r in line_archive.read(start, end, lines, ['line_code', 'date', 'predicted_passengers', 'realized_passengers']):
+            day = totals.setdefault((r['line_code'], str(r['date'])[:10]), [0, 0])
+            day[0] += r['predicted_passengers'] or 0
+            day[1] += r['realized_passengers'] or 0
+        return totals
+
+    def _all_months(self):
+        conn, c = get_db_connection()
+        try:
+            c.execute("SELECT DISTINCT SUBSTR(CAST(date AS TEXT), 1, 7) FROM bus_lines")
+            months = {r[0] for r in c.fetchall()}
+            c.execute("SELECT DISTINCT month FROM line_stats")
+            months.update(r[0] for r in c.fetchall())
+        finally:
+            conn.close()
+        return months | {f"{y:04d}-{m:02d}" for y, m in line_archive.months()}
 
+    def refresh(self, dates=None, lines=None):
+        """
+        Recomputes the months containing `dates` (every month if None), only for `lines` when
+        given. Call it after each committed bus_lines write; returns the number of months done.
+        """
+        ph = "%s" if DATABASE_URL else "?"
+        months = sorted({str(d)[:7] for d in dates} if dates is not None else self._all_months())
+        lines = sorted(set(lines)) if lines and len(set(lines)) <= self.MAX_LINE_FILTER else None
+        for month in months:
+            buckets = {}
+            for (code, date), (predicted, realized) in self.daily(*self.month_range(month), lines).items():
+                bucket = buckets.get((code, self.weekday(date)))
+                if bucket is None:
+                    buckets[(code, self.weekday(date))] = [1, predicted, realized, realized, realized]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += predicted
+                    bucket[2] += realized
+                    bucket[3] = min(bucket[3], realized)
+                    bucket[4] = max(bucket[4], realized)
+            conn, c = get_db_connection()
+            try:
+                delete = f"DELETE FROM line_stats WHERE month = {ph}"
+                if lines:
+                    delete += f" AND line_code IN ({','.join([ph] * len(lines))})"
+                c.execute(delete, [month] + (lines or []))
+                insert = f"""
+                    INSERT INTO line_stats (line_code, month, weekday, days, predicted_total, realized_total, realized_min, realized_max)
+                    VALUES ({', '.join([ph] * 8)})
+                """
+                data = [(code, month, weekday, *bucket) for (code, weekday), bucket in buckets.items()]
+                if DATABASE_URL:
+                    extras.execute_batch(c, insert, data)
+                else:
+                    c.executemany(insert, data)
                 conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
                 conn.close()
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": True, "message": "Dados limpos com sucesso"}).encode())
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                self.send_error(500, str(e))
+        if months:
+            mark_tables_changed('line_stats')
+        with self._lock:
+            self.refreshes += 1
+            self.months_refreshed += len(months)
+        return len(months)
+
+    def is_empty(self):
+        conn, c = get_db_connection()
+        try:
+            c.execute("SELECT 1 FROM line_stats LIMIT 1")
+            return c.fetchone() is None
+        finally:
+            conn.close()
+
+    def summary(self, line_code, start=None, end=None):
+        """
+        Detail view figures of one line in a date range (open ends = all its data):
+        {"all": {...}, "0".."6": {...}} with days, totals, daily average/min/max,
+        realized/predicted ratio and the trend of the last TREND_DAYS days against the ones before.
+        """
+        ph = "%s" if DATABASE_URL else "?"
+        conn, c = get_db_connection()
+        try:
+            if not (start and end):
+                c.execute(f"SELECT MIN(month), MAX(month) FROM line_stats WHERE line_code = {ph}", (line_code,))
+                low, high = c.fetchone()
+                if low is None:
+                    return {"all": self._figures([], [])}
+                start = start or self.month_range(low)[0]
+                end = end or self.month_range(high)[1]
+            # Months wholly inside the range come from line_stats; the rest are daily edges
+            low = start[:7] if start == self.month_range(start[:7])[0] else self._next_month(start[:7])
+            high = end[:7] if end == self.month_range(end[:7])[1] else self._previous_month(end[:7])
+            c.execute(f"""
+                SELECT weekday, SUM(days), SUM(predicted_total), SUM(realized_total), MIN(realized_min), MAX(realized_max)
+                FROM line_stats WHERE line_code = {ph} AND month >= {ph} AND month <= {ph}
+                GROUP BY weekday
+            """, (line_code, low, high))
+            rows = [list(r) for r in c.fetchall()]
+        finally:
+            conn.close()
+
+        edges = []
+        if low > high:
+            edges.append((start, end))
+        else:
+            if start < self.month_range(low)[0]:
+                edges.append((start, self.month_range(start[:7])[1]))
+            if end > self.month_range(high)[1]:
+                edges.append((self.month_range(end[:7])[0], end))
+        by_weekday = {r[0]: r[1:] for r in rows}
+        for a, b in edges:
+            for (_, date), (predicted, realized) in self.daily(a, b, [line_code]).items():
+                weekday = self.weekday(date)
+                bucket = by_weekday.get(weekday)
+                if bucket is None:
+                    by_weekday[weekday] = [1, predicted, realized, realized, realized]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += predicted
+                    bucket[2] += realized
+                    bucket[3] = realized if bucket[3] is None else min(bucket[3], realized)
+                    bucket[4] = realized if bucket[4] is None else max(bucket[4], realized)
+
+        # Trend: the last days with data, overall and per weekday; the window widens over gaps
+        wanted = 2 * self.TREND_DAYS
+        span = 7 * wanted
+        while True:
+            since = max(start, (datetime.strptime(end, '%Y-%m-%d') - timedelta(days=span - 1)).strftime('%Y-%m-%d'))
+            recent = sorted((date, values) for (_, date), values in self.daily(since, end, [line_code]).items())
+            found = defaultdict(int)
+            for date, _ in recent:
+                found[self.weekday(date)] += 1
+            if since == start or all(found[w] >= min(wanted, b[0]) for w, b in by_weekday.items()):
+                break
+            span *= 2
+        with self._lock:
+            self.summaries += 1
+
+        result = {"all": self._figures(list(by_weekday.values()), recent)}
+        for weekday in range(7):
+            if weekday in by_weekday:
+                result[str(weekday)] = self._figures([by_weekday[weekday]],
+                                                     [d for d in recent if self.weekday(d[0]) == weekday])
+        result["start"], result["end"] = start, end
+        return result
+
+    def _figures(self, buckets, recent):
+        days = sum(b[0] for b in buckets)
+        predicted = sum(b[1] for b in buckets)
+        realized = sum(b[2] for b in buckets)
+        lows = [b[3] for b in buckets if b[3] is not None]
+        highs = [b[4] for b in buckets if b[4] is not None]
+        trend = None
+        if len(recent) >= 2 * self.TREND_DAYS:
+            last = sum(v[1] for _, v in recent[-self.TREND_DAYS:])
+            before = sum(v[1] for _, v in recent[-2 * self.TREND_DAYS:-self.TREND_DAYS])
+            # Same thresholds the detail view always used: 5% of the period's total
+            trend = 'up' if last - before > realized * 0.05 else 'down' if last - before < -realized * 0.05 else 'stable'
+        return {
+            "days": days,
+            "predicted_total": predicted,
+            "realized_total": realized,
+            "realized_avg": realized / days if days else 0,
+            "realized_min": min(lows) if lows else None,
+            "realized_max": max(highs) if highs else None,
+            "ratio": realized / predicted if predicted else None,
+            "trend": trend,
+        }
+
+    @staticmethod
+    def _next_month(month):
+        year, number = int(month[:4]), int(month[5:7])
+        return f"{year + 1:04d}-01" if number == 12 else f"{year:04d}-{number + 1:02d}"
+
+    @staticmethod
+    def _previous_month(month):
+        year, number = int(month[:4]), int(month[5:7])
+        return f"{year - 1:04d}-12" if number == 1 else f"{year:04d}-{number - 1:02d}"
+
+    def stats(self):
+        with self._lock:
+            return {"refreshes": self.refreshes, "months_refreshed": self.months_refreshed, "summaries": self.summaries}
+
+line_stats = LineStats()
+
+def clear_bus_lines(predicted, realized, start=None, end=None, lines=None, companies=None, batch=CLEAR_BATCH_SIZE):
+    """
+    Zeroes predicted and/or realized passengers of the bus_lines rows in a scope (date range,
+    lines, companies; None means unlimited) and deletes the rows left with both values at zero.
+    - Rows change in batches of `batch`, one transaction each, so readers are never blocked for
+      long and an interrupted clear can simply be run again
+    - Clearing both values of whole months with no line/company limit drops the month's
+      partition (Postgres) or archive file instead of touching its rows
+    - Other archived months in scope are cleared inside their Parquet files and stay archived
+    Returns counts of what was done.
+    """
+    report = {"deleted": 0, "updated": 0, "partitions_dropped": [], "archive_dropped": []}
+    whole_months = predicted and realized and not lines and not companies
+
+    def covers(year, month):
+        first, following = BusLinePartitions.bounds(year, month)
+        last = (datetime.strptime(following, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        return (not start or start <= first) and (not end or end >= last)
+
+    for year, month in line_archive.months_between(start, end):
+        if whole_months and covers(year, month):
+            if line_archive.drop_month(year, month):
+                report["archive_dropped"].append(f"{year:04d}-{month:02d}")
+        else:
+            deleted, updated = line_archive.clear_month(year, month, predicted, realized, start, end, lines, companies)
+            report["deleted"] += deleted
+            report["updated"] += updated
+
+    if whole_months and bus_line_partitions.enabled:
+        for year, month in bus_line_partitions.months():
+            if covers(year, month):
+                bus_line_partitions.detach(year, month, drop=True)
+                report["partitions_dropped"].append(f"{year:04d}-{month:02d}")
+
+    ph = "%s" if DATABASE_URL else "?"
+    where, args = [], []
+    if start:
+        where.append(f"date >= {ph}")
+        args.append(start)
+    if end:
+        where.append(f"date <= {ph}")
+        args.append(end)
+    if lines:
+        where.append(f"line_code IN ({','.join([ph] * len(lines))})")
+        args.extend(lines)
+    if companies:
+        where.append(f"company IN ({','.join([ph] * len(companies))})")
+        args.extend(companies)
+    scope = ' AND '.join(where) or '1 = 1'
+
+    # The outer scope repeats the inner one so Postgres can prune partitions
+    if predicted and realized:
+        steps = [("deleted", f"DELETE FROM bus_lines WHERE {scope} AND id IN (SELECT id FROM bus_lines WHERE {scope} LIMIT {int(batch)})")]
+    else:
+        cleared, kept = ('predicted_passengers', 'realized_passengers') if predicted else ('realized_passengers', 'predicted_passengers')
+        steps = [
+            # Rows whose other value is already zero would be left empty: delete them instead of rewriting them
+            ("deleted", f"DELETE FROM bus_lines WHERE {scope} AND id IN (SELECT id FROM bus_lines WHERE {scope} AND COALESCE({kept}, 0) = 0 LIMIT {int(batch)})"),
+            ("updated", f"UPDATE bus_lines SET {cleared} = 0 WHERE {scope} AND id IN (SELECT id FROM bus_lines WHERE {scope} AND {cleared} <> 0 LIMIT {int(batch)})"),
+        ]
+    for key, sql in steps:
+        while True:
+            conn, c = get_db_connection()
+            try:
+                c.execute(sql, args + args)
+                count = c.rowcount
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            report[key] += count
+            if count < batch:
+                break
+
+    dates = None
+    if start and end:
+        first, last = datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d')
+        dates = {(first + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((last - first).days + 1)}
+    mark_tables_changed('bus_lines', dates=dates)
+    line_stats.refresh(dates, lines)
+    log.info("Cleared bus_lines (predicted=%s, realized=%s, %s..%s, %d lines, %d companies): %s",
+             predicted, realized, start, end, len(lines or []), len(companies or []), report)
+    return report
+
+def iter_query(sql, params=(), batch=EXPORT_FETCH_SIZE):
+    """
+    Yields the rows of a query a batch at a time instead of fetching them all.
+    On Postgres this uses a server-side (named) cursor, so the client never holds the whole result.
+    """
+    conn, c = get_db_connection()
+    try:
+        if DATABASE_URL:
+            named = conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=extras.DictCursor)
+            named.itersize = batch
+            c = InstrumentedCursor(named, 'postgres')
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+        c.close()
+    finally:
+        conn.close()
+
+class ChunkedWriter:
+    """
+    Response body writer for streamed responses of unknown length.
+    Buffers up to chunk_size bytes and sends them as one HTTP/1.1 chunk (or raw bytes
+    when chunked is False, for HTTP/1.0 clients that read until the connection closes,
+    or for plain files). Everything sent is also written to `copy` when given.
+    """
+    def __init__(self, raw, chunked=True, chunk_size=64 * 1024, copy=None):
+        self._raw = raw
+        self._chunked = chunked
+        self._copy = copy
+        self.chunk_size = chunk_size
+        self._buf = bytearray()
+        self.bytes = 0
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= self.chunk_size:
+            self._send()
+        return len(data)
+
+    def _send(self):
+        if not self._buf:
             return
+        if self._chunked:
+            self._raw.write(b'%x\r\n' % len(self._buf))
+        self._raw.write(self._buf)
+        if self._chunked:
+            self._raw.write(b'\r\n')
+        if self._copy:
+            self._copy.write(self._buf)
+        self.bytes += len(self._buf)
+        self._buf = bytearray()
+
+    def flush(self):
+        self._send()
+
+    def close(self):
+        """Sends what is buffered and ends the body."""
+        self._send()
+        if self._chunked:
+            self._raw.write(b'0\r\n\r\n')
+
+class XlsxBook:
+    """openpyxl write-only workbook: rows go to temp files, save() zips them straight into `out`."""
+    multi_sheet = True
+
+    def __init__(self, out):
+        self._out = out
+        self._wb = openpyxl.Workbook(write_only=True)
+        self._ws = None
+        self.rows = 0
+
+    def sheet(self, title, header, widths=None):
+        self._ws = self._wb.create_sheet(title=title[:31])
+        for idx, width in enumerate(widths or []):
+            self._ws.column_dimensions[openpyxl.utils.get_column_letter(idx + 1)].width = width
+        self._ws.append(header)
+
+    def row(self, values):
+        self._ws.append(values)
+        self.rows += 1
+
+    def close(self):
+        self._wb.save(self._out)
+
+class CsvBook:
+    """UTF-8 CSV, by default ';'-separated with a BOM (what Excel in pt-BR opens directly); one table only."""
+    multi_sheet = False
+
+    def __init__(self, out, delimiter=';', bom=True):
+        self._out = out
+        self._writer = csv.writer(self, delimiter=delimiter)
+        self._header = None
+        self.rows = 0
+        if bom:
+            out.write('\ufeff'.encode('utf-8'))
+
+    def write(self, text):
+        self._out.write(text.encode('utf-8'))
+
+    def sheet(self, title, header, widths=None):
+        if self._header is None:
+            self._header = header
+            self._writer.writerow(header)
+
+    def row(self, values):
+        self._writer.writerow(values)
+        self.rows += 1
+
+    def close(self):
+        pass
+
+class NdjsonBook:
+    """One JSON object per line, keyed by the header; one table only."""
+    multi_sheet = False
+
+    def __init__(self, out):
+        self._out = out
+        self._header = None
+        self.rows = 0
+
+    def sheet(self, title, header, widths=None):
+        if self._header is None:
+            self._header = header
+
+    def row(self, values):
+        self._out.write(json.dumps(dict(zip(self._header, values)), ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+        self.rows += 1
+
+    def close(self):
+        pass
+
+class GzipWriter:
+    """Gzip-compresses everything written before passing it to a ChunkedWriter."""
+    def __init__(self, raw, level=6):
+        self._raw = raw
+        self._zip = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits 31: gzip container
+
+    @property
+    def bytes(self):
+        return self._raw.bytes
+
+    def write(self, data):
+        compressed = self._zip.compress(data)
+        if compressed:
+            self._raw.write(compressed)
+        return len(data)
+
+    def flush(self):
+        self._raw.write(self._zip.flush(zlib.Z_SYNC_FLUSH))
+        self._raw.flush()
+
+    def close(self):
+        self._raw.write(self._zip.flush())
+        self._raw.close()
 
-        if self.path == '/api/import-csv':
-            self.handle_import(self.rfile, is_predicted=False)
+class ExportEngine:
+    """
+    Streams XLSX/CSV exports to the client while the rows are still being read.
+    - Callers pass an iterator of rows (usually iter_query) and a function that writes
+      them into a book (XlsxBook or CsvBook); nothing holds the whole export in memory
+    - The response uses chunked transfer encoding, since its size is unknown up front
+    - Each export's rows, bytes, duration and peak traced memory are logged and kept
+      for /api/stats (peaks overlap when exports run concurrently)
+    """
+    FORMATS = {
+        'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', XlsxBook),
+        'csv': ('text/csv; charset=utf-8', CsvBook),
+        'ndjson': ('application/x-ndjson; charset=utf-8', NdjsonBook),
+    }
+    KEEP = 20
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        self._active = 0
+        self._started_tracing = False
+        self.recent = deque(maxlen=self.KEEP)
+        self.count = 0
+        self.failed = 0
+
+    def _memory_begin(self):
+        if not self.trace_memory:
+            return 0
+        with self._lock:
+            if self._active == 0:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracing = True
+                tracemalloc.reset_peak()
+            self._active += 1
+            return tracemalloc.get_traced_memory()[0]
+
+    def _memory_end(self, baseline):
+        if not self.trace_memory:
+            return None
+        with self._lock:
+            peak = max(tracemalloc.get_traced_memory()[1] - baseline, 0)
+            self._active -= 1
+            if self._active == 0 and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+            return peak
+
+    def run(self, out, fmt, write, label, book_class=None):
+        """Writes one export into out (a ChunkedWriter); write(book) fills it. Raises if it fails midway."""
+        started = time.perf_counter()
+        baseline = self._memory_begin()
+        book = None
+        ok = False
+        try:
+            book = (book_class or self.FORMATS[fmt][1])(out)
+            write(book)
+            book.close()
+            out.flush()
+            ok = True
+        finally:
+            peak = self._memory_end(baseline)
+            report = {
+                "export": label,
+                "format": fmt,
+                "rows": book.rows if book else 0,
+                "bytes": out.bytes,
+                "seconds": round(time.perf_counter() - started, 3),
+                "peak_memory_bytes": peak,
+                "ok": ok
+            }
+            with self._lock:
+                self.count += 1
+                self.failed += 0 if ok else 1
+                self.recent.append(report)
+            log.info("Export %s (%s): %d rows, %d bytes in %.2fs, peak memory %s%s",
+                     label, fmt, report["rows"], report["bytes"], report["seconds"],
+                     f"{peak / 1048576:.1f} MB" if peak is not None else "n/a", "" if ok else " (aborted)")
+
+    def send(self, handler, filename, fmt, write, label, copy=None, complete=None, book_class=None, compress=False):
+        """Streams one export as the response (and into copy, if given). Headers are sent first,
+        so callers must check for an empty result (and send their 404) before calling this.
+        complete() runs once the body is written but before the response ends, so whatever it
+        publishes is in place by the time the client can ask again.
+        compress sends the body with Content-Encoding: gzip."""
+        chunked = handler.request_version != 'HTTP/1.0'
+        out = ChunkedWriter(handler.wfile, chunked, copy=copy)
+        if compress:
+            out = GzipWriter(out)
+        ok = False
+        try:
+            handler.send_response(200)
+            handler.send_header('Content-Type', self.FORMATS[fmt][0])
+            handler.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+            if compress:
+                handler.send_header('Content-Encoding', 'gzip')
+                handler.send_header('Vary', 'Accept-Encoding')
+            if copy:
+                handler.send_header('X-Export-Cache', 'MISS')
+            if chunked:
+                handler.send_header('Transfer-Encoding', 'chunked')
+            else:
+                handler.close_connection = True
+            handler.end_headers()
+            self.run(out, fmt, write, label, book_class)
+            if complete:
+                complete()
+            out.close()
+            ok = True
+        finally:
+            if not ok:
+                # Body is cut short; the client must not reuse the connection
+                handler.close_connection = True
+
+    def stats(self):
+        with self._lock:
+            return {"count": self.count, "failed": self.failed, "trace_memory": self.trace_memory, "recent": list(self.recent)}
+
+export_engine = ExportEngine(EXPORT_TRACE_MEMORY)
+
+class ExportError(Exception):
+    """An export request that cannot be served; carries the HTTP status and the message for the client."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def export_options(params, layouts, formats=('xlsx', 'csv')):
+    """(format, layout) from ?format=xlsx|csv&layout=...; raises ExportError(400) if invalid."""
+    fmt = (params.get('format', [formats[0]])[0] or formats[0]).lower()
+    layout = (params.get('layout', [layouts[0]])[0] or layouts[0]).lower()
+    if fmt not in formats or layout not in layouts:
+        raise ExportError(400, f"format deve ser {'/'.join(formats)} e layout {'/'.join(layouts)}")
+    return fmt, layout
+
+def plan_group_export(params):
+    """
+    Group export. layout=sheets (default): one sheet per date (CSV: one table with a DATA
+    column); layout=pivot: one sheet, lines x dates. format=xlsx|csv.
+    Like every plan_*_export, returns what the export cache keys the export by plus
+    produce(), which runs the query and returns the function that writes the rows into
+    a book (ExportError 404 when there are none).
+    """
+    tables = ('bus_lines', 'line_groups', 'line_group_members')
+    version = data_version(tables) # Before reading anything, so a concurrent write leaves the entry stale
+    group_id = params.get('group_id', [None])[0]
+    start = params.get('start', [None])[0]
+    end = params.get('end', [None])[0]
+
+    if not all([group_id, start, end]):
+        raise ExportError(400, "Parâmetros ausentes")
+    fmt, layout = export_options(params, ('sheets', 'pivot'))
+
+    # 1. Get lines in group
+    group = group_index.get(group_id)
+    lines = group["lines"] if group else []
+    if not lines:
+        raise ExportError(404, "Bloco vazio ou não encontrado")
+
+    ph = "%s" if DATABASE_URL else "?"
+    where = f"line_code IN ({','.join([ph] * len(lines))}) AND date BETWEEN {ph} AND {ph}"
+    order = "date ASC, line_code ASC" if layout == 'sheets' else "line_code ASC, date ASC"
+    rounded = lambda v: int(round(v)) if v is not None else None
+
+    def produce():
+        # 2. Stream data for these lines/dates; archived months are summed here and merged in order
+        sort_key = (lambda r: (r[0], r[1])) if layout == 'sheets' else (lambda r: (r[1], r[0]))
+        archived = {}
+        for r in line_archive.read(start, end, lines, ['date', 'line_code', 'predicted_passengers', 'realized_passengers']):
+            sums = archived.setdefault((r['date'], r['line_code']), [0, 0])
+            sums[0] += r['predicted_passengers'] or 0
+            sums[1] += r['realized_passengers'] or 0
+        archived_rows = sorted(((d, l, p, rz) for (d, l), (p, rz) in archived.items()), key=sort_key)
+        dates = None
+        if layout == 'pivot':
+            # The pivot's columns; read before the row stream opens so one connection is held at a time
+            conn, c = get_db_connection()
+            try:
+                c.execute(f"SELECT DISTINCT date FROM bus_lines WHERE {where} ORDER BY date", lines + [start, end])
+                dates = sorted({str(r[0]) for r in c.fetchall()} | {d for d, _ in archived})
+            finally:
+                conn.close()
+        rows = heapq.merge(iter_query(f"""
+            SELECT date, line_code, SUM(predicted_passengers), SUM(realized_passengers)
+            FROM bus_lines 
+            WHERE {where}
+            GROUP BY date, line_code
+            ORDER BY {order}
+        """, lines + [start, end]), archived_rows, key=sort_key)
+        first = next(rows, None)
+        if first is None:
+            raise ExportError(404, "Nenhum dado encontrado para este período")
+        rows = itertools.chain([first], rows)
+
+        def write_sheets(book):
+            current = None
+            for date, line_code, predicted, realized in rows:
+                if not book.multi_sheet:
+                    if current is None:
+                        current = True
+                        book.sheet('Dados', ['DATA', 'LINHA', 'PREVISTO', 'REALIZADO'])
+                    book.row([str(date), line_code, rounded(predicted), rounded(realized)])
+                    continue
+                if date != current:
+                    current = date
+                    book.sheet(str(date), ['LINHA', 'PREVISTO', 'REALIZADO'])
+                book.row([line_code, rounded(predicted), rounded(realized)])
+
+        def write_pivot(book):
+            # Only the date list and one line's values are held at a time
+            header = ['LINHA']
+            for d in dates:
+                header += [f"{d} PREVISTO", f"{d} REALIZADO"]
+            book.sheet('Linhas x Datas', header, [10] + [20] * (len(header) - 1))
+
+            def emit(line_code, values):
+                out = [line_code]
+                for d in dates:
+                    out.extend(values.get(d, (None, None)))
+                book.row(out)
+
+            current, values = None, {}
+            for date, line_code, predicted, realized in rows:
+                if line_code != current:
+                    if current is not None:
+                        emit(current, values)
+                    current, values = line_code, {}
+                values[str(date)] = (rounded(predicted), rounded(realized))
+            if current is not None:
+                emit(current, values)
+
+        return write_sheets if layout == 'sheets' else write_pivot
+
+    return {
+        "name": "group",
+        "params": {"group_id": str(group_id), "start": start, "end": end, "format": fmt, "layout": layout},
+        "version": version,
+        "filename": f"Export_{group['name']}_{start}_{end}.{fmt}",
+        "format": fmt,
+        "label": f"group:{layout}",
+        "produce": produce
+    }
+
+def plan_actions_export(params):
+    """Actions (line events) of a period as one table; see plan_group_export."""
+    tables = ('line_events', 'line_groups', 'line_group_members')
+    version = data_version(tables)
+    start = params.get('start', [None])[0]
+    end = params.get('end', [None])[0]
+
+    if not start or not end:
+        raise ExportError(400, "Período não selecionado")
+    fmt = export_options(params, ('list',))[0]
+
+    def produce():
+        ph = "%s" if DATABASE_URL else "?"
+        rows = iter_query(f"""
+            SELECT 
+                e.created_at, 
+                e.implementation_date, 
+                e.line_code, 
+                e.fact, 
+                e.cause, 
+                e.action_taken, 
+                e.analysis_conclusion, 
+                e.analyst
+            FROM line_events e
+            WHERE (e.implementation_date BETWEEN {ph} AND {ph} OR e.implementation_date IS NULL OR e.implementation_date = '')
+            ORDER BY CASE WHEN e.implementation_date IS NULL OR e.implementation_date = '' THEN 1 ELSE 0 END DESC, COALESCE(NULLIF(e.implementation_date, ''), CAST(e.created_at AS TEXT)) DESC, e.created_at DESC, e.id DESC
+        """, (start, end))
+        first = next(rows, None)
+        if first is None:
+            raise ExportError(404, "Nenhuma ação encontrada para este período")
+        rows = itertools.chain([first], rows)
+
+        # Column names in Portuguese for the Excel; widths are fixed since rows are written as they arrive
+        cols = [
+            'DATA CADASTRO', 'DATA AÇÃO', 'GRUPO', 'LINHA', 
+            'FATO', 'CAUSA', 'AÇÃO', 'ANÁLISE', 'NOME'
+        ]
+        widths = [15, 12, 20, 8, 30, 40, 40, 50, 20]
+
+        def write(book):
+            book.sheet('Ações', cols, widths)
+            for r in rows:
+                row_list = list(r)
+                # Group name comes from the in-memory index instead of a join
+                group = group_index.group_of(row_list[2])
+                row_list.insert(2, group["name"] if group else None)
+                for i in range(len(row_list)):
+                    if i in [0, 1]:
+                        # Format created_at and implementation_date to DD/MM/YYYY if they look like YYYY-MM-DD
+                        if row_list[i] and '-' in str(row_list[i]):
+                            parts = str(row_list[i]).split(' ')[0].split('-')
+                            if len(parts) == 3:
+                                row_list[i] = f"{parts[2]}/{parts[1]}/{parts[0]}"
+                    elif isinstance(row_list[i], str):
+                        # Sanitize strings to remove newlines, multiple spaces
+                        row_list[i] = ' '.join(row_list[i].split())
+                book.row(row_list)
+
+        return write
+
+    return {
+        "name": "actions",
+        "params": {"start": start, "end": end, "format": fmt},
+        "version": version,
+        "filename": f"Export_Acoes_{start}_a_{end}.{fmt}",
+        "format": fmt,
+        "label": "actions",
+        "produce": produce
+    }
+
+EXPORT_PLANS = {'group': plan_group_export, 'actions': plan_actions_export}
+
+class ExportCache:
+    """
+    Finished exports kept on disk, so repeated downloads skip the query and the workbook build.
+    - Keyed by export name + normalized parameters + data version of the tables it reads,
+      plus a per-boot epoch (versions restart at zero), so any write makes old files unreachable
+    - Files live in one directory shared by all worker processes; recency is the file mtime
+      (touched on every hit) and the least recently used go once the total passes max_bytes
+    - Jobs build an export in the background. Their state is kept as files too (<key>.job while
+      running, <key>.err if it failed), so any worker can report it
+    """
+    KEY_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{32}')
+
+    def __init__(self, directory, max_bytes, job_workers):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.job_workers = job_workers
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.jobs = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, plan):
+        raw = json.dumps([plan["name"], plan["params"], plan["version"]], sort_keys=True, default=str)
+        return f"{self.epoch}-{hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]}"
+
+    def is_key(self, value):
+        return bool(value) and self.KEY_PATTERN.fullmatch(value) is not None
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def lookup(self, key, count=True):
+        """(path, meta) of a finished export, or None. A hit touches the file, keeping it recent."""
+        found = None
+        if self.enabled:
+            try:
+                with open(self._path(key, '.json'), encoding='utf-8') as f:
+                    meta = json.load(f)
+                path = self._path(key, '.' + meta["format"])
+                os.utime(path)
+                found = (path, meta)
+            except (OSError, ValueError, KeyError):
+                pass
+        if count:
+            with self._lock:
+                if found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def open_entry(self, key):
+        """Temporary file for a new entry; publish it with commit() or drop it with discard()."""
+        os.makedirs(self.directory, exist_ok=True)
+        return open(self._path(key, f".{uuid.uuid4().hex[:8]}.part"), 'wb')
+
+    def discard(self, f):
+        f.close()
+        self._remove(f.name)
+
+    def commit(self, key, f, plan):
+        """Publishes a completed entry: the file first, then its metadata (what lookup reads)."""
+        f.close()
+        size = os.path.getsize(f.name)
+        os.replace(f.name, self._path(key, '.' + plan["format"]))
+        meta = {"filename": plan["filename"], "format": plan["format"], "size": size, "created": time.time()}
+        tmp = self._path(key, f".{uuid.uuid4().hex[:8]}.part")
+        with open(tmp, 'w', encoding='utf-8') as mf:
+            json.dump(meta, mf)
+        os.replace(tmp, self._path(key, '.json'))
+        with self._lock:
+            self.stores += 1
+        self.prune()
+
+    def prune(self):
+        """Removes files of earlier boots, then least recently used entries until under max_bytes."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
             return
-        
-        elif self.path == '/api/import-predicted':
-            self.handle_import(self.rfile, is_predicted=True)
+        entries = []
+        total = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.startswith(self.epoch + '-'):
+                self._remove(path)
+                continue
+            stem, _, ext = name.partition('.')
+            if ext in ExportEngine.FORMATS:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, stem, path, st.st_size))
+                total += st.st_size
+        entries.sort()
+        for _, stem, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(self._path(stem, '.json'))
+            self._remove(path)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    @staticmethod
+    def _alive(pid):
+        if pid == os.getpid():
+            return True
+        if not hasattr(os, 'fork'):
+            return False # Single process on this platform: another pid is an earlier run
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def job_state(self, key):
+        """Status of the export with this key: done (with its download link), running, failed, or None if unknown."""
+        found = self.lookup(key, count=False)
+        if found:
+            meta = found[1]
+            return {"id": key, "status": "done", "filename": meta["filename"], "size": meta["size"],
+                    "download_url": f"/api/export-jobs/download?id={key}"}
+        job_path = self._path(key, '.job')
+        try:
+            with open(job_path, encoding='utf-8') as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            job = None
+        except (OSError, ValueError):
+            job = {} # Being written by the submitting worker
+        if job is not None:
+            if 'pid' not in job or self._alive(job['pid']):
+                return {"id": key, "status": "running", "started": job.get('started')}
+            self._remove(job_path)
+            return {"id": key, "status": "failed", "error": "Exportação interrompida"}
+        try:
+            with open(self._path(key, '.err'), encoding='utf-8') as f:
+                return {"id": key, "status": "failed", "error": json.load(f).get('error')}
+        except (OSError, ValueError):
+            return None
+
+    def submit(self, key, plan):
+        """Starts building plan in the background unless it is cached or already being built; returns its state."""
+        state = self.job_state(key)
+        if state and state["status"] in ('done', 'running'):
+            return state
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            # O_EXCL: two workers submitting the same export start a single job
+            fd = os.open(self._path(key, '.job'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self.job_state(key)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"pid": os.getpid(), "started": time.time()}, f)
+        self._remove(self._path(key, '.err'))
+        with self._lock:
+            # Created lazily, so forked workers never inherit a parent's threads
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.job_workers), thread_name_prefix='export-job')
+                self._executor_pid = os.getpid()
+            self.jobs += 1
+            self._executor.submit(self._run_job, key, plan)
+        return {"id": key, "status": "running", "started": time.time()}
+
+    def _run_job(self, key, plan):
+        entry = None
+        try:
+            write = plan["produce"]()
+            entry = self.open_entry(key)
+            export_engine.run(ChunkedWriter(entry, chunked=False), plan["format"], write, plan["label"] + ":job")
+            self.commit(key, entry, plan)
+            entry = None
+        except Exception as e:
+            if isinstance(e, ExportError):
+                error = e.message
+            else:
+                log.exception("Export job %s failed: %s", key, e)
+                error = f"Erro ao gerar exportação: {e}"
+            with open(self._path(key, '.err'), 'w', encoding='utf-8') as f:
+                json.dump({"error": error}, f)
+        finally:
+            if entry:
+                self.discard(entry)
+            self._remove(self._path(key, '.job'))
+            db_pool.release_thread_connections()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "jobs": self.jobs
+            }
+
+export_cache = ExportCache(EXPORT_CACHE_DIR, int(EXPORT_CACHE_MAX_MB * 1048576), EXPORT_JOB_WORKERS)
+
+def parse_byte_range(header, size):
+    """
+    Single "bytes=" range from a Range header -> (start, end) inclusive, or None to send the whole file
+    (no header, other units, malformed or multiple ranges). Raises ValueError when unsatisfiable.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+# /api/line-events sort options: name -> SQL key (NULLs folded to '' so keyset comparisons hold)
+EVENT_SORTS = {
+    # Legacy order: undated events first, then by action date (or registration date), newest first
+    'recent': "CASE WHEN e.implementation_date IS NULL OR e.implementation_date = '' THEN '1|' ELSE '0|' END"
+              " || COALESCE(NULLIF(e.implementation_date, ''), CAST(e.created_at AS TEXT))",
+    'created_at': "COALESCE(CAST(e.created_at AS TEXT), '')",
+    'implementation_date': "COALESCE(e.implementation_date, '')",
+    # Only sort key that needs the group tables; filters and results use group_index
+    'group_name': "COALESCE((SELECT g.name FROM line_group_members m JOIN line_groups g ON g.id = m.group_id"
+                  " WHERE m.line_code = e.line_code), '')",
+    'line_code': "COALESCE(e.line_code, '')",
+    'type': "COALESCE(e.type, '')",
+    'fact': "COALESCE(e.fact, '')",
+    'cause': "COALESCE(e.cause, '')",
+    'action_taken': "COALESCE(e.action_taken, '')",
+    'analysis_conclusion': "COALESCE(e.analysis_conclusion, '')",
+    'analyst': "COALESCE(e.analyst, '')",
+}
+EVENTS_PAGE_DEFAULT = 100
+EVENTS_PAGE_MAX = 500
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on anything it did not produce."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+class RequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Persistent connections: the page's many fetches reuse one socket
+    protocol_version = 'HTTP/1.1'
+    timeout = HTTP_IDLE_TIMEOUT
+    MAX_DRAIN_BYTES = 64 * 1024
+
+    def parse_request(self):
+        self._admission = None
+        if not hasattr(self, '_conn_rfile'):
+            self._conn_rfile = self.rfile
+            self._conn_wfile = self.wfile
+        # Metrics: timed from here (idle keep-alive wait excluded) until the response is written
+        self._started = time.perf_counter()
+        self._status = None
+        self._body_length = 0
+        self._cache_headers_set = False
+        self._route_handler, self._route_label = None, 'unmatched'
+        self.wfile = _CountingWriter(self._conn_wfile)
+        sql_monitor.begin_request()
+        if not super().parse_request():
+            return False
+
+        if self.reject_oversized_body():
+            return False
+
+        path = urlparse(self.path).path
+        self._route_handler, label = find_route(self.command, path)
+        if label:
+            self._route_label = label
+        elif self.command in ('GET', 'HEAD'):
+            self._route_label = 'static'
+        elif self.command == 'OPTIONS':
+            self._route_label = '*'
+
+        if self.headers.get('Transfer-Encoding'):
+            # Chunked request bodies aren't parsed here; don't try to reuse the socket after one
+            self.close_connection = True
+        try:
+            body_length = int(self.headers.get('Content-Length', 0) or 0)
+        except ValueError:
+            body_length = 0
+            self.close_connection = True
+        if body_length > 0:
+            self.rfile = RequestBody(self._conn_rfile, body_length)
+            self._body_length = body_length
+
+        admission = admission_class_for(self.path)
+        if admission:
+            if not admission.try_acquire():
+                # Body (if any) stays unread, so this connection can't be reused
+                self.close_connection = True
+                self.send_response(503)
+                self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+                self.send_header('Content-type', 'application/json')
+                body = json.dumps({"error": "Muitas operações pesadas em andamento, tente novamente em instantes."}).encode()
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return False
+            self._admission = admission
+        return True
+
+    def reject_oversized_body(self):
+        """Answers 413 (once) if Content-Length is over the route's limit, before the body is read."""
+        limit = body_limit_for(self.path)
+        try:
+            length = int(self.headers.get('Content-Length', 0) or 0)
+        except ValueError:
+            length = 0
+        if limit is None or length <= limit:
+            return False
+        if not getattr(self, '_rejected_body', False):
+            self._rejected_body = True
+            self.close_connection = True
+            self.send_json(413, {"error": f"Arquivo muito grande (limite {limit // (1024 * 1024)} MB)."})
+        return True
+
+    def handle_expect_100(self):
+        # Refuse before the client starts sending, not after
+        if self.reject_oversized_body():
+            return False
+        return super().handle_expect_100()
+
+    def handle_one_request(self):
+        self._started = None
+        self._rejected_body = False
+        try:
+            super().handle_one_request()
+        finally:
+            if self._started is not None:
+                elapsed = time.perf_counter() - self._started
+                trace = sql_monitor.end_request(self.command, self._route_label)
+                route_metrics.observe(self.command, self._route_label, self._status, elapsed,
+                                      self._body_length, self.wfile.count, trace.statements, trace.seconds)
+                if request_log_sampler.should_log(self._route_label, self._status):
+                    log.info('%s "%s" %s %s %.1fms', self.address_string(), self.requestline,
+                             self._status or '-', self.wfile.count, elapsed * 1000)
+                self.wfile = self._conn_wfile
+            if isinstance(self.rfile, RequestBody):
+                if not self.close_connection:
+                    try:
+                        if not self.rfile.drain(self.MAX_DRAIN_BYTES):
+                            self.close_connection = True
+                    except OSError:
+                        self.close_connection = True
+                self.rfile = self._conn_rfile
+            if getattr(self, '_admission', None):
+                self._admission.release()
+                self._admission = None
+            # Safety net: error branches that return before conn.close() must not leak pool slots
+            db_pool.release_thread_connections()
+            if read_mirror:
+                read_mirror.pool.release_thread_connections()
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def log_request(self, code='-', size='-'):
+        # Written (sampled) once the response is finished, see handle_one_request
+        pass
+
+    def log_error(self, format, *args):
+        message = format % args
+        log.warning("%s - %s", self.address_string(), message, extra={'rate_key': message})
+
+    def log_message(self, format, *args):
+        log.info("%s - %s", self.address_string(), format % args)
+
+    def end_headers(self):
+        trace = sql_monitor.current()
+        if trace and trace.statements:
+            # Visible in the browser's network panel
+            self.send_header('Server-Timing', f'db;dur={trace.seconds * 1000:.1f};desc="{trace.statements} queries"')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS, DELETE')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Profile, X-Profile-Mode')
+        # Prevent browsers from caching static files outside the fingerprinted pipeline
+        if not self.path.startswith('/api/') and not self._cache_headers_set:
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Expires', '0')
+        super().end_headers()
+
+    def send_body(self, status, body, content_type='text/plain; charset=utf-8'):
+        """Writes a complete response with Content-Length so the connection can be kept alive."""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data, default=str).encode(), 'application/json')
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        log.debug("INCOMING GET REQUEST Path='%s'", self.path)
+        self.dispatch()
+
+    def do_POST(self):
+        log.debug("do_POST Path='%s'", self.path)
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def do_HEAD(self):
+        self.dispatch()
+
+    def dispatch(self):
+        """Calls the handler registered for this method + path (resolved in parse_request)."""
+        parsed_url = urlparse(self.path)
+        params = parse_qs(parsed_url.query)
+        if self._route_handler:
+            call = lambda: self._route_handler(self, params)
+        elif self.command in ('GET', 'HEAD'):
+            call = lambda: self.serve_static(parsed_url.path)
+        else:
+            self.send_error(404, "Endpoint não encontrado")
             return
 
-        elif self.path == '/api/groups':
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length).decode('utf-8')
+        mode = self.requested_profile_mode(params)
+        if mode:
+            profile_store.run(mode, self.command, self._route_label, call)
+        else:
+            call()
+
+    def requested_profile_mode(self, params):
+        """
+        Opt-in profiling: 'X-Profile: 1' header or '?_profile=1' on a request carrying a MASTER session.
+        Mode comes from 'X-Profile-Mode' / '_profile_mode' ('cprofile' default, or 'sample').
+        """
+        wanted = self.headers.get('X-Profile') or params.pop('_profile', [None])[0]
+        mode = (self.headers.get('X-Profile-Mode') or params.pop('_profile_mode', ['cprofile'])[0]).lower()
+        if not wanted:
+            return None
+        session = self.current_session()
+        if mode not in ProfileStore.MODES or not session or session['role'] != 'MASTER':
+            log.warning("Profiling request ignored (user %s, mode %s)", session['user_id'] if session else None, mode)
+            return None
+        return mode
+
+    def current_session(self):
+        """Session of the 'Authorization: Bearer <token>' header, or None."""
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer':
+            return None
+        return session_store.get(token.strip())
+
+    def require_session(self):
+        """Session of any logged-in user; otherwise sends 401 and returns None."""
+        session = self.current_session()
+        if not session:
+            self.send_json(401, {"success": False, "message": "Sessão inválida ou expirada"})
+        return session
+
+    def require_master(self):
+        """Session of a MASTER user; otherwise sends 401/403 and returns None."""
+        session = self.require_session()
+        if not session:
+            return None
+        if session['role'] != 'MASTER':
+            self.send_json(403, {"success": False, "message": "Acesso Negado"})
+            return None
+        return session
+
+    @route('DELETE', '/api/groups')
+    def api_delete_group(self, params):
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
             data = json.loads(post_data)
+            group_id = data.get('groupId')
+            
+            if not group_id:
+                self.send_body(400, b'Missing groupId')
+                return
             
+            conn, c = get_db_connection()
+            # Remove members first (or let CASCADE handle if set, but explicit is safer)
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"DELETE FROM line_group_members WHERE group_id = {ph}", (group_id,))
+            c.execute(f"DELETE FROM line_groups WHERE id = {ph}", (group_id,))
+            conn.commit()
+            conn.close()
+            mark_tables_changed('line_groups', 'line_group_members')
+            
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_body(500, str(e).encode())
+
+    @route('DELETE', '/api/operational-options')
+    def api_delete_operational_option(self, params):
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data)
+            option_id = data.get('id')
+
+            if not self.require_master():
+                return
+
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"DELETE FROM operational_options WHERE id = {ph}", (option_id,))
+            conn.commit()
+            conn.close()
+            mark_tables_changed('operational_options')
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    @route('DELETE', '/api/analysis', prefix=True)
+    def api_delete_analysis(self, params):
+        try:
             try:
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                c.execute(f"INSERT INTO line_groups (name, color) VALUES ({ph}, {ph})", (data['name'], data.get('color', '#3b82f6')))
+                analysis_id = int(params.get('id', [0])[0])
+            except (ValueError, TypeError):
+                self.send_error(400, "Invalid ID format")
+                return
+
+            session = self.require_master()
+            if not session:
+                return
+            log.debug("DELETE /api/analysis: analysis_id=%s, user_id=%s", analysis_id, session['user_id'])
+
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+
+            # The attachment file only goes once its last reference does
+            c.execute(f"SELECT filename FROM line_events WHERE id = {ph}", (analysis_id,))
+            row = c.fetchone()
+            if row:
+                file_name = row['filename']
+                log.debug("Found record in line_events, filename=%s", file_name)
+                released = attachment_store.release(c, file_name)
+                c.execute(f"DELETE FROM line_events WHERE id = {ph}", (analysis_id,))
                 conn.commit()
                 conn.close()
+                attachment_store.collect([released])
+                mark_tables_changed('line_events', 'attachments')
                 
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": True}).encode())
-            except Exception as e:
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-            return
+                self.send_json(200, {"success": True})
+            else:
+                log.debug("Record with id %s not found in line_events", analysis_id)
+                conn.close()
+                self.send_body(404, b'Event not found')
+        except Exception as e:
+            log.exception("Error handling %s: %s", self.path, e)
+            self.send_error(500, str(e))
+
+    @route('DELETE', '/api/line-events', prefix=True)
+    def api_delete_line_event(self, params):
+        try:
+            event_id = int(params.get('id', [0])[0])
+
+            if not self.require_master():
+                return
+
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+
+            # The attachment file only goes once its last reference does
+            c.execute(f"SELECT filename FROM line_events WHERE id = {ph}", (event_id,))
+            row = c.fetchone()
+            released = attachment_store.release(c, row['filename']) if row else None
+            
+            c.execute(f"DELETE FROM line_events WHERE id = {ph}", (event_id,))
+            conn.commit()
+            conn.close()
+            attachment_store.collect([released])
+            mark_tables_changed('line_events', 'attachments')
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    @route('POST', '/api/operational-options')
+    def api_save_operational_option(self, params):
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            post_data = self.rfile.read(content_length).decode('utf-8')
+            data = json.loads(post_data)
+            
+            type_opt = data.get('type')
+            label = data.get('label')
+            opt_id = data.get('id') # If present, it's an EDIT
+
+            if not self.require_master():
+                return
+
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+
+            if opt_id:
+                c.execute(f"UPDATE operational_options SET label = {ph} WHERE id = {ph}", (label, opt_id))
+            else:
+                c.execute(f"INSERT INTO operational_options (type, label) VALUES ({ph}, {ph})", (type_opt, label))
+            
+            conn.commit()
+            conn.close()
+            mark_tables_changed('operational_options')
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    @route('POST', '/api/mirror/refresh')
+    def api_refresh_mirror(self, params):
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+
+            if not read_mirror:
+                self.send_error(404, "Read mirror disabled (set READ_MIRROR=1 with DATABASE_URL)")
+                return
 
-        elif self.path == '/api/groups/members':
+            if not self.require_master():
+                return
+
+            # Full re-copy: also picks up writes made outside this server (migrations, manual SQL)
+            tables = [t for t in data.get('tables', list(ReadMirror.TABLES)) if t in ReadMirror.TABLES]
+            read_mirror.request_sync(tables)
+
+            self.send_json(202, {"success": True, "queued": tables})
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    def clear_scope(self, data):
+        """
+        bus_lines scope of a clear-data request: start/end ('YYYY-MM-DD'), lines (list or
+        comma-separated), group_id and companies. Sends 400 and returns None if invalid.
+        """
+        def values(name):
+            raw = data.get(name) or []
+            return [str(v).strip() for v in (raw.split(',') if isinstance(raw, str) else raw) if str(v).strip()]
+
+        start, end = data.get('start') or None, data.get('end') or None
+        for value in (start, end):
+            if value and not re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+                self.send_json(400, {"error": "start/end devem estar no formato YYYY-MM-DD"})
+                return None
+        if start and end and start > end:
+            self.send_json(400, {"error": "start deve ser anterior a end"})
+            return None
+        lines = [code for code in (pad_line_code(v) for v in values('lines')) if code]
+        if data.get('group_id'):
+            group = group_index.get(data['group_id'])
+            lines.extend(group["lines"] if group else [])
+        if (values('lines') or data.get('group_id')) and not lines:
+            # An empty line list must never widen into "every line"
+            self.send_json(400, {"error": "Nenhuma linha encontrada para o filtro informado"})
+            return None
+        companies = sorted({normalize_text(v) for v in values('companies')})
+        return {"start": start, "end": end, "lines": sorted(set(lines)) or None, "companies": companies or None}
+
+    @route('POST', '/api/clear-data', prefix=True)
+    def api_clear_data(self, params):
+        """
+        Clears the selected targets. predicted/realized accept an optional scope (see
+        clear_scope) and are cleared in batches by clear_bus_lines; the rest are whole tables.
+        """
+        try:
             content_length = int(self.headers.get('Content-Length', 0))
             post_data = self.rfile.read(content_length).decode('utf-8')
             data = json.loads(post_data)
+            targets = data.get('targets', [])  # List of strings: 'actions', 'predicted', 'realized', 'groups', 'distribution'
             
-            try:
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                
-                if data['action'] == 'add':
-                    c.execute(f"INSERT INTO line_group_members (group_id, line_code) VALUES ({ph}, {ph}) ON CONFLICT DO NOTHING", (data['groupId'], pad_line_code(data['lineCode'])))
-                elif data['action'] == 'remove':
-                    c.execute(f"DELETE FROM line_group_members WHERE group_id = {ph} AND line_code = {ph}", (data['groupId'], pad_line_code(data['lineCode'])))
-                    
-                conn.commit()
-                conn.close()
-                
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": True}).encode())
-            except Exception as e:
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-            return
+            # Security: Only MASTER can wipe
+            if not self.require_master():
+                return
 
-        elif self.path == '/api/login':
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length).decode('utf-8')
-            creds = json.loads(post_data)
+            scope = self.clear_scope(data)
+            if scope is None:
+                return
+
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+
+            changed = set()
+            if 'actions' in targets:
+                c.execute("DELETE FROM line_events")
+                c.execute("DELETE FROM attachments")
+                c.execute("DELETE FROM attachment_texts")
+                c.execute("DELETE FROM occurrences")
+                changed.update(['line_events', 'attachments', 'attachment_texts', 'occurrences'])
             
+            if 'groups' in targets:
+                c.execute("DELETE FROM line_groups")
+                # Cascade should handle members if ON DELETE CASCADE is set, but let's be safe
+                c.execute("DELETE FROM line_group_members")
+                changed.update(['line_groups', 'line_group_members'])
+            
+            if 'distribution' in targets and 'groups' not in targets:
+                # If wiping distribution but keeping groups
+                c.execute("DELETE FROM line_group_members")
+                changed.add('line_group_members')
+
+            conn.commit()
+            conn.close()
+            if 'actions' in targets:
+                attachment_store.collect(os.listdir(UPLOAD_DIR))
+            mark_tables_changed(*changed)
+
+            result = {"success": True, "message": "Dados limpos com sucesso"}
+            if 'predicted' in targets or 'realized' in targets:
+                result["bus_lines"] = clear_bus_lines('predicted' in targets, 'realized' in targets, **scope)
+            self.send_json(200, result)
+        except Exception as e:
+            log.exception("Error handling %s: %s", self.path, e)
+            self.send_error(500, str(e))
+
+    @route('POST', '/api/import-csv')
+    def api_import_csv(self, params):
+        self.handle_import(self.rfile, is_predicted=False)
+
+    @route('POST', '/api/import-predicted')
+    def api_import_predicted(self, params):
+        self.handle_import(self.rfile, is_predicted=True)
+
+    @route('POST', '/api/groups')
+    def api_create_group(self, params):
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length).decode('utf-8')
+        data = json.loads(post_data)
+        
+        try:
             conn, c = get_db_connection()
             ph = "%s" if DATABASE_URL else "?"
-            c.execute(f"SELECT * FROM users WHERE username = {ph} AND password = {ph}", (creds['username'], creds['password']))
-            user = c.fetchone()
+            c.execute(f"INSERT INTO line_groups (name, color) VALUES ({ph}, {ph})", (data['name'], data.get('color', '#3b82f6')))
+            conn.commit()
             conn.close()
+            mark_tables_changed('line_groups')
             
-            if user:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": True, "user": {"id": user['id'], "username": user['username'], "role": user['role']}}).encode())
-            else:
-                self.send_response(401)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Invalid credentials"}).encode())
-            return
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
 
-        elif self.path == '/api/line-events':
-            try:
-                content_length = int(self.headers.get('Content-Length', 0))
-                body = self.rfile.read(content_length)
+    @route('POST', '/api/groups/members')
+    def api_update_group_members(self, params):
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length).decode('utf-8')
+        data = json.loads(post_data)
+        
+        try:
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+            
+            if data['action'] == 'add':
+                c.execute(f"INSERT INTO line_group_members (group_id, line_code) VALUES ({ph}, {ph}) ON CONFLICT DO NOTHING", (data['groupId'], pad_line_code(data['lineCode'])))
+            elif data['action'] == 'remove':
+                c.execute(f"DELETE FROM line_group_members WHERE group_id = {ph} AND line_code = {ph}", (data['groupId'], pad_line_code(data['lineCode'])))
                 
-                headers_raw = "".join(f"{k}: {v}\r\n" for k, v in self.headers.items()).encode('iso-8859-1')
-                msg = email.parser.BytesParser(policy=email.policy.default).parsebytes(headers_raw + b"\r\n" + body)
+            conn.commit()
+            conn.close()
+            mark_tables_changed('line_group_members')
+            
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
 
-                form_data = {}
-                file_item = None
-                
-                if msg.is_multipart():
-                    for part in msg.iter_parts():
-                        cdisp = part.get('Content-Disposition', '')
-                        name = None
-                        if 'name="' in cdisp:
-                            name = cdisp.split('name="')[1].split('"')[0]
-                        
-                        filename = part.get_filename()
-                        
-                        if filename:
-                            file_item = {
-                                'filename': filename,
-                                'payload': part.get_payload(decode=True)
-                            }
-                        elif name:
-                            form_data[name] = part.get_payload(decode=True).decode('utf-8', errors='ignore').strip()
-
-                event_id = form_data.get('id')
-                line_code_raw = form_data.get('line_code')
-                line_code = pad_line_code(line_code_raw) if line_code_raw else None
-                event_type = form_data.get('type')
-                fact = form_data.get('fact')
-                analysis_conclusion = form_data.get('analysis_conclusion')
-                action_taken = form_data.get('action_taken')
-                cause = form_data.get('cause')
-                analyst = form_data.get('analyst')
-                imp_date = form_data.get('implementation_date')
-                created_at = form_data.get('created_at')
-                author_id = form_data.get('author_id')
-
-                internal_name = None
-                orig_name = None
-
-                if file_item and file_item['filename']:
-                    orig_name = file_item['filename']
-                    ext = os.path.splitext(orig_name)[1]
-                    internal_name = f"{uuid.uuid4()}{ext}"
-                    target_path = os.path.join(UPLOAD_DIR, internal_name)
-                    with open(target_path, 'wb') as f:
-                        f.write(file_item['payload'])
+    @route('POST', '/api/login')
+    def api_login(self, params):
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length).decode('utf-8')
+        creds = json.loads(post_data)
+        
+        conn, c = get_db_connection()
+        ph = "%s" if DATABASE_URL else "?"
+        c.execute(f"SELECT * FROM users WHERE username = {ph} AND password = {ph}", (creds['username'], creds['password']))
+        user = c.fetchone()
+        conn.close()
+        
+        if user:
+            token, session = session_store.create(user)
+            self.send_json(200, {"success": True, "token": token, "expiresAt": int(session['expires']),
+                                 "user": {"id": user['id'], "username": user['username'], "role": user['role']}})
+        else:
+            self.send_json(401, {"success": False, "message": "Invalid credentials"})
 
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
+    @route('POST', '/api/logout')
+    def api_logout(self, params):
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and token.strip():
+            session_store.revoke(token.strip())
+        self.send_json(200, {"success": True})
 
-                if event_id:
-                    # Update Existing
-                    update_sql = f"""UPDATE line_events SET 
-                                 line_code={ph}, type={ph}, fact={ph}, analysis_conclusion={ph}, action_taken={ph}, cause={ph}, 
-                                 analyst={ph}, implementation_date={ph}"""
-                    params = [line_code, event_type, fact, analysis_conclusion, action_taken, cause, analyst, imp_date]
-                    
-                    if created_at:
-                        update_sql += f", created_at={ph}"
-                        params.append(created_at)
-                    
-                    if internal_name:
-                        update_sql += f", filename={ph}, original_filename={ph}"
-                        params.extend([internal_name, orig_name])
-                    
-                    update_sql += f" WHERE id={ph}"
-                    params.append(event_id)
-                    c.execute(update_sql, params)
-                else:
-                    # Insert New
-                    if created_at:
-                        c.execute(f"""INSERT INTO line_events 
-                                     (line_code, type, fact, analysis_conclusion, action_taken, cause, analyst, implementation_date, filename, original_filename, author_id, created_at)
-                                     VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})""",
-                                  (line_code, event_type, fact, analysis_conclusion, action_taken, cause, analyst, imp_date, internal_name, orig_name, author_id, created_at))
-                    else:
-                        c.execute(f"""INSERT INTO line_events 
-                                     (line_code, type, fact, analysis_conclusion, action_taken, cause, analyst, implementation_date, filename, original_filename, author_id)
-                                     VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})""",
-                                  (line_code, event_type, fact, analysis_conclusion, action_taken, cause, analyst, imp_date, internal_name, orig_name, author_id))
+    @route('POST', '/api/line-events')
+    def api_save_line_event(self, params):
+        try:
+            content_type = self.headers.get('Content-Type', '')
+            form_data = {}
+            file_item = None
 
-                conn.commit()
-                conn.close()
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": True}).encode())
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                self.send_error(500, str(e))
-            return
+            if content_type.lower().startswith('multipart/'):
+                if not isinstance(self.rfile, RequestBody):
+                    self.send_error(411, "Content-Length required")
+                    return
 
+                # Attachments stream into the store while being hashed
+                parser = MultipartParser(self.rfile, content_type, MAX_UPLOAD_BYTES, MAX_FORM_FIELD_BYTES, attachment_store.open_incoming)
+                try:
+                    form_data, files = parser.parse()
+                except (UploadTooLarge, MultipartError) as e:
+                    for item in parser.files:
+                        attachment_store.discard(item["file"])
+                    self.close_connection = True
+                    self.send_json(413 if isinstance(e, UploadTooLarge) else 400, {"error": str(e)})
+                    return
+                for item in files:
+                    item["file"].close()
+                # As before, the last file part wins
+                for item in files[:-1]:
+                    attachment_store.discard(item["file"])
+                if files:
+                    file_item = files[-1]
+                    if not file_item['filename']:
+                        attachment_store.discard(file_item["file"])
+                        file_item = None
+
+            event_id = form_data.get('id')
+            line_code_raw = form_data.get('line_code')
+            line_code = pad_line_code(line_code_raw) if line_code_raw else None
+            event_type = form_data.get('type')
+            fact = form_data.get('fact')
+            analysis_conclusion = form_data.get('analysis_conclusion')
+            action_taken = form_data.get('action_taken')
+            cause = form_data.get('cause')
+            analyst = form_data.get('analyst')
+            imp_date = form_data.get('implementation_date')
+            created_at = form_data.get('created_at')
+            author_id = form_data.get('author_id')
+
+            internal_name = None
+            orig_name = None
+            released = []
 
-        elif self.path == '/api/line-actions':
-            try:
-                content_length = int(self.headers.get('Content-Length', 0))
-                post_data = self.rfile.read(content_length).decode('utf-8')
-                data = json.loads(post_data)
-                
-                line_code = data.get('line_code')
-                comment = data.get('comment')
-                imp_date = data.get('implementation_date')
-                author_id = data.get('author_id')
-                analyst = data.get('analyst', '')
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+
+            if file_item:
+                orig_name = file_item['filename']
+                internal_name = attachment_store.reference(c, file_item['file'])
+                if event_id:
+                    # The replaced attachment loses this event's reference
+                    c.execute(f"SELECT filename FROM line_events WHERE id = {ph}", (event_id,))
+                    old = c.fetchone()
+                    if old and old['filename']:
+                        released.append(attachment_store.release(c, old['filename']))
+
+            if event_id:
+                # Update Existing
+                update_sql = f"""UPDATE line_events SET 
+                             line_code={ph}, type={ph}, fact={ph}, analysis_conclusion={ph}, action_taken={ph}, cause={ph}, 
+                             analyst={ph}, implementation_date={ph}"""
+                params = [line_code, event_type, fact, analysis_conclusion, action_taken, cause, analyst, imp_date]
                 
-                if not line_code or not comment:
-                    self.send_error(400, "Missing data")
-                    return
+                if created_at:
+                    update_sql += f", created_at={ph}"
+                    params.append(created_at)
                 
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                c.execute(f"INSERT INTO line_events (line_code, fact, implementation_date, author_id, analyst, type) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, 'ACTION')", 
-                          (line_code, comment, imp_date, author_id, analyst))
-                conn.commit()
-                conn.close()
+                if internal_name:
+                    update_sql += f", filename={ph}, original_filename={ph}"
+                    params.extend([internal_name, orig_name])
                 
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": True}).encode())
-            except Exception as e:
-                self.send_error(500, str(e))
-            return
+                update_sql += f" WHERE id={ph}"
+                params.append(event_id)
+                c.execute(update_sql, params)
+            else:
+                # Insert New
+                if created_at:
+                    c.execute(f"""INSERT INTO line_events 
+                                 (line_code, type, fact, analysis_conclusion, action_taken, cause, analyst, implementation_date, filename, original_filename, author_id, created_at)
+                                 VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})""",
+                              (line_code, event_type, fact, analysis_conclusion, action_taken, cause, analyst, imp_date, internal_name, orig_name, author_id, created_at))
+                else:
+                    c.execute(f"""INSERT INTO line_events 
+                                 (line_code, type, fact, analysis_conclusion, action_taken, cause, analyst, implementation_date, filename, original_filename, author_id)
+                                 VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})""",
+                              (line_code, event_type, fact, analysis_conclusion, action_taken, cause, analyst, imp_date, internal_name, orig_name, author_id))
+
+            conn.commit()
+            conn.close()
+            if file_item:
+                attachment_store.settle(file_item['file'])
+                search_index.notify()
+            attachment_store.collect(released)
+            mark_tables_changed('line_events', 'attachments')
+            
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            log.exception("Error handling %s: %s", self.path, e)
+            if file_item:
+                attachment_store.discard(file_item['file']) # no-op once settled
+            self.send_error(500, str(e))
 
-        super().do_POST()
+    @route('POST', '/api/line-actions')
+    def api_create_line_action(self, params):
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            post_data = self.rfile.read(content_length).decode('utf-8')
+            data = json.loads(post_data)
+            
+            line_code = data.get('line_code')
+            comment = data.get('comment')
+            imp_date = data.get('implementation_date')
+            author_id = data.get('author_id')
+            analyst = data.get('analyst', '')
+            
+            if not line_code or not comment:
+                self.send_error(400, "Missing data")
+                return
+            
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"INSERT INTO line_events (line_code, fact, implementation_date, author_id, analyst, type) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, 'ACTION')", 
+                      (line_code, comment, imp_date, author_id, analyst))
+            conn.commit()
+            conn.close()
+            mark_tables_changed('line_events')
+            
+            self.send_json(200, {"success": True})
+        except Exception as e:
+            self.send_error(500, str(e))
 
     def handle_import(self, rfile, is_predicted=False):
-        print(f"Received Import Request (Predicted={is_predicted})")
+        log.info("Received Import Request (Predicted=%s)", is_predicted)
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             if content_length == 0:
@@ -789,169 +4809,361 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
             else:
                 self.process_csv_stream(text_stream)
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"message": "Import successful"}).encode())
+            self.send_json(200, {"message": "Import successful"})
             
         except Exception as e:
-            print(f"Error importing: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error importing: %s", e)
             try:
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
+                self.send_json(500, {"error": str(e)})
             except: pass
 
-    def do_GET(self):
-        import sys
-        from urllib.parse import urlparse, parse_qs
-        
-        parsed_url = urlparse(self.path)
-        path = parsed_url.path
-        params = parse_qs(parsed_url.query)
-        
-        print(f"DEBUG: INCOMING GET REQUEST Path='{path}'", file=sys.stderr)
-        
-        if path == '/api/operational-options':
-            try:
-                conn, c = get_db_connection()
-                c.execute("SELECT * FROM operational_options")
-                rows = c.fetchall()
-                data = [dict(row) for row in rows]
-                conn.close()
+    @route('GET', '/api/stats')
+    def api_stats(self, params):
+        stats = {"query_cache": query_cache.stats(), "db_pool": db_pool.stats()}
+        if hasattr(self.server, 'stats'):
+            stats["server"] = self.server.stats()
+        stats["admission"] = {heavy_admission.name: heavy_admission.stats()}
+        stats["sql"] = sql_monitor.stats()
+        stats["static"] = static_assets.stats()
+        stats["sessions"] = session_store.stats()
+        stats["groups"] = {"rebuilds": group_index.rebuilds}
+        stats["search"] = search_index.stats()
+        stats["exports"] = export_engine.stats()
+        stats["archive"] = line_archive.stats()
+        stats["partitions"] = bus_line_partitions.stats()
+        stats["line_stats"] = line_stats.stats()
+        stats["export_cache"] = export_cache.stats()
+        if read_mirror:
+            stats["read_mirror"] = read_mirror.stats()
+        self.send_json(200, stats)
+
+    @route('GET', '/metrics')
+    def api_metrics(self, params):
+        self.send_body(200, "\n".join(render_metrics(self.server)) + "\n", 'text/plain; version=0.0.4; charset=utf-8')
+
+    @route('GET', '/api/profiles')
+    def api_profiles(self, params):
+        try:
+            if not self.require_master():
+                return
+
+            name = params.get('name', [None])[0]
+            if name:
+                path = profile_store.path_for(name)
+                if not path:
+                    self.send_error(404, "Profile not found")
+                    return
+                with open(path, 'rb') as f:
+                    data = f.read()
                 self.send_response(200)
-                self.send_header('Content-type', 'application/json')
+                self.send_header('Content-type', 'application/octet-stream')
+                self.send_header('Content-Disposition', f'attachment; filename="{name}"')
+                self.send_header('Content-Length', str(len(data)))
                 self.end_headers()
-                self.wfile.write(json.dumps(data).encode())
-            except Exception as e:
-                self.send_error(500, str(e))
-            return
+                self.wfile.write(data)
+                return
 
+            limit = int(params.get('limit', [20])[0])
+            self.send_json(200, profile_store.list(limit))
+        except Exception as e:
+            self.send_error(500, str(e))
 
-        if path == '/api/groups':
-            try:
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                
-                # Fetch Groups
-                c.execute("SELECT * FROM line_groups")
-                groups = [dict(row) for row in c.fetchall()]
-                
-                # Fetch Members
-                for g in groups:
-                    c.execute(f"SELECT line_code FROM line_group_members WHERE group_id = {ph}", (g['id'],))
-                    g['lines'] = [row['line_code'] for row in c.fetchall()]
-                
+    @route('GET', '/api/operational-options')
+    def api_operational_options(self, params):
+        try:
+            def load_options():
+                conn, c = get_read_connection('operational_options')
+                c.execute("SELECT * FROM operational_options")
+                rows = c.fetchall()
                 conn.close()
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(groups).encode())
-            except Exception as e:
-                self.send_response(500)
-                self.wfile.write(str(e).encode())
-            return
+                return [dict(row) for row in rows]
 
-        if path == '/api/analysis/download':
-            try:
-                analysis_id = params.get('id', [None])[0]
-                
-                if not analysis_id:
-                    self.send_error(400, "Missing ID")
-                    return
+            data = query_cache.get_or_load('operational-options', {}, ('operational_options',), load_options)
+            self.send_json(200, data)
+        except Exception as e:
+            self.send_error(500, str(e))
 
-                conn, c = get_db_connection()
-                ph = "%s" if DATABASE_URL else "?"
-                c.execute(f"SELECT filename, original_filename FROM line_events WHERE id = {ph}", (analysis_id,))
-                row = c.fetchone()
-                conn.close()
+    @route('GET', '/api/groups')
+    def api_groups(self, params):
+        try:
+            self.send_json(200, group_index.groups())
+        except Exception as e:
+            self.send_body(500, str(e).encode())
+
+    @route('GET', '/api/analysis/download')
+    def api_download_analysis(self, params):
+        try:
+            analysis_id = params.get('id', [None])[0]
+            
+            if not analysis_id:
+                self.send_error(400, "Missing ID")
+                return
+
+            conn, c = get_db_connection()
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"SELECT filename, original_filename FROM line_events WHERE id = {ph}", (analysis_id,))
+            row = c.fetchone()
+            conn.close()
+
+            if not row:
+                self.send_error(404, "Analysis not found")
+                return
 
-                if not row:
-                    self.send_error(404, "Analysis not found")
+            if not row['filename']:
+                self.send_error(404, "No attachment")
+                return
+            try:
+                f = open(attachment_store.path(row['filename']), 'rb')
+            except FileNotFoundError:
+                self.send_error(404, "File missing on disk")
+                return
+
+            with f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                etag = attachment_store.etag(row['filename'], st)
+                self._cache_headers_set = True
+                if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Cache-Control', 'private, no-cache')
+                    self.end_headers()
                     return
 
-                file_path = os.path.join(UPLOAD_DIR, row['filename'])
-                if not os.path.exists(file_path):
-                    self.send_error(404, "File missing on disk")
+                # If-Range: only honour the range while the client's copy is still current
+                if_range = self.headers.get('If-Range')
+                try:
+                    byte_range = parse_byte_range(self.headers.get('Range'), size) if not if_range or if_range.strip() == etag else None
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
                     return
 
-                self.send_response(200)
+                start, end = byte_range or (0, size - 1)
+                length = end - start + 1 if size else 0
+                self.send_response(206 if byte_range else 200)
                 self.send_header('Content-type', 'application/octet-stream')
                 self.send_header('Content-Disposition', f'attachment; filename="{row["original_filename"]}"')
+                self.send_header('Content-Length', str(length))
+                if byte_range:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'private, no-cache')
                 self.end_headers()
-                
-                with open(file_path, 'rb') as f:
-                    shutil.copyfileobj(f, self.wfile)
-            except Exception as e:
-                self.send_error(500, str(e))
-            return
+                self.send_file_body(f, length, start)
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    @route('GET', '/api/line-events')
+    def api_line_events(self, params):
+        """
+        Events, each with group_id / group_name.
+        - id=N: that single event (404 if missing)
+        - filters: line_code, group_id, type, cause (one of the comma-separated causes), analyst, start+end
+        - limit=N switches to pages: {"items": [...], "next_cursor": ...}, ordered by
+          sort (an EVENT_SORTS key, default 'recent') and dir, with keyset paging via cursor=
+        Without limit the whole filtered list is returned in the legacy order.
+        """
+        try:
+            first = lambda name: (params.get(name, [None])[0] or None)
+            event_id = first('id')
+            if event_id is not None:
+                self.send_line_event(event_id)
+                return
 
-        if path == '/api/line-events':
+            line_code = first('line_code')
+            group_id = first('group_id')
+            event_type = first('type')
+            cause = first('cause')
+            analyst = first('analyst')
+            start = first('start')
+            end = first('end')
+            if not (start and end):
+                start = end = None
+
+            paged = first('limit') is not None
+            sort = first('sort') or 'recent'
+            direction = (first('dir') or 'desc').lower()
             try:
-                line_code = params.get('line_code', [None])[0]
-                start = params.get('start', [None])[0]
-                end = params.get('end', [None])[0]
-                
+                limit = min(max(int(first('limit') or EVENTS_PAGE_DEFAULT), 1), EVENTS_PAGE_MAX)
+                after = decode_cursor(first('cursor')) if first('cursor') else None
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            if sort not in EVENT_SORTS or direction not in ('asc', 'desc'):
+                self.send_json(400, {"error": f"sort must be one of {sorted(EVENT_SORTS)} and dir asc/desc"})
+                return
+            if after is not None and (not isinstance(after, list) or len(after) != 4 or after[:2] != [sort, direction]):
+                self.send_json(400, {"error": "cursor does not match sort"})
+                return
+
+            lines = None
+            if group_id:
+                group = group_index.get(group_id)
+                lines = group["lines"] if group else []
+                if not lines:
+                    self.send_json(200, {"items": [], "next_cursor": None} if paged else [])
+                    return
+
+            def load_events():
                 conn, c = get_db_connection()
                 ph = "%s" if DATABASE_URL else "?"
+                key = EVENT_SORTS[sort]
                 
-                query = "SELECT * FROM line_events WHERE 1=1"
+                query = f"SELECT e.*, {key} AS sort_key FROM line_events e WHERE 1=1"
                 sql_params = []
                 
                 if line_code:
-                    query += f" AND line_code = {ph}"
+                    query += f" AND e.line_code = {ph}"
                     sql_params.append(line_code)
+
+                if lines is not None:
+                    query += f" AND e.line_code IN ({','.join([ph] * len(lines))})"
+                    sql_params.extend(lines)
+
+                if event_type:
+                    query += f" AND e.type = {ph}"
+                    sql_params.append(event_type)
+
+                if cause:
+                    # cause holds the selected labels joined with ', '
+                    query += f" AND (', ' || e.cause || ', ') LIKE {ph} ESCAPE '\\'"
+                    sql_params.append(f"%, {like_escape(cause)}, %")
+
+                if analyst:
+                    query += f" AND LOWER(e.analyst) = LOWER({ph})"
+                    sql_params.append(analyst)
                 
                 if start and end:
-                    query += f" AND (implementation_date BETWEEN {ph} AND {ph} OR implementation_date IS NULL OR implementation_date = '')"
+                    query += f" AND (e.implementation_date BETWEEN {ph} AND {ph} OR e.implementation_date IS NULL OR e.implementation_date = '')"
                     sql_params.extend([start, end])
-                
-                query += " ORDER BY CASE WHEN implementation_date IS NULL OR implementation_date = '' THEN 1 ELSE 0 END DESC, COALESCE(NULLIF(implementation_date, ''), CAST(created_at AS TEXT)) DESC, created_at DESC"
+
+                if not paged:
+                    query += " ORDER BY CASE WHEN e.implementation_date IS NULL OR e.implementation_date = '' THEN 1 ELSE 0 END DESC, COALESCE(NULLIF(e.implementation_date, ''), CAST(e.created_at AS TEXT)) DESC, e.created_at DESC, e.id DESC"
+                else:
+                    op = '<' if direction == 'desc' else '>'
+                    if after is not None:
+                        query += f" AND ({key} {op} {ph} OR ({key} = {ph} AND e.id {op} {ph}))"
+                        sql_params.extend([after[2], after[2], after[3]])
+                    query += f" ORDER BY sort_key {direction.upper()}, e.id {direction.upper()} LIMIT {limit + 1}"
                 
                 c.execute(query, sql_params)
-                rows = c.fetchall()
+                rows = [dict(row) for row in c.fetchall()]
                 conn.close()
-                
-                data = [dict(row) for row in rows]
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(data, default=str).encode())
-            except Exception as e:
-                self.send_error(500, str(e))
-            return
 
-        if path == '/api/action-impact':
+                next_cursor = None
+                if paged and len(rows) > limit:
+                    rows = rows[:limit]
+                    next_cursor = encode_cursor([sort, direction, rows[-1]['sort_key'], rows[-1]['id']])
+                for row in rows:
+                    del row['sort_key']
+                group_index.annotate(rows)
+                return {"items": rows, "next_cursor": next_cursor} if paged else rows
+
+            cache_params = {"line_code": line_code, "group_id": group_id, "type": event_type, "cause": cause,
+                            "analyst": analyst, "start": start, "end": end}
+            if paged:
+                cache_params.update({"sort": sort, "dir": direction, "limit": limit, "after": after})
+            data = query_cache.get_or_load('line-events', cache_params, ('line_events',) + GroupIndex.TABLES, load_events)
+            self.send_json(200, data)
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    @route('GET', '/api/search')
+    def api_search(self, params):
+        """
+        Ranked full-text search over event fields and attachment text: ?q=words[&limit=N].
+        Each result is the event (with group_id / group_name) plus score and matched_in.
+        """
+        try:
+            q = (params.get('q', [''])[0] or '').strip()
             try:
-                line_code_raw = params.get('line_code', [None])[0]
-                line_code = pad_line_code(line_code_raw) if line_code_raw else None
-                base_date_str = params.get('base_date', [None])[0] # YYYY-MM-DD
-                window = int(params.get('window', [7])[0])
+                limit = min(max(int(params.get('limit', [50])[0]), 1), EVENTS_PAGE_MAX)
+            except ValueError:
+                self.send_json(400, {"error": "Invalid limit"})
+                return
+            if not search_index.terms(q):
+                self.send_json(200, [])
+                return
 
-                if not line_code or not base_date_str:
-                    self.send_error(400, "Missing parameters")
-                    return
+            def load_results():
+                hits = search_index.search(q, limit)
+                if not hits:
+                    return []
+                conn, c = get_db_connection()
+                ph = "%s" if DATABASE_URL else "?"
+                c.execute(f"SELECT * FROM line_events WHERE id IN ({','.join([ph] * len(hits))})", [h[0] for h in hits])
+                events = {row['id']: dict(row) for row in c.fetchall()}
+                conn.close()
 
-                base_date = datetime.strptime(base_date_str, '%Y-%m-%d')
-                
-                shift_days = ((window + 6) // 7) * 7
-                before_start_dt = base_date - timedelta(days=shift_days)
-                before_start = before_start_dt.strftime('%Y-%m-%d')
-                after_start = base_date.strftime('%Y-%m-%d')
+                results = []
+                for event_id, score, in_event, in_attachment in hits:
+                    event = events.get(event_id)
+                    if event:
+                        event['score'] = score
+                        event['matched_in'] = [where for where, hit in (('event', in_event), ('attachment', in_attachment)) if hit]
+                        results.append(event)
+                return group_index.annotate(results)
+
+            cache_params = {"q": ' '.join(search_index.terms(q)), "limit": limit}
+            data = query_cache.get_or_load('search', cache_params, ('line_events', 'attachment_texts') + GroupIndex.TABLES, load_results)
+            self.send_json(200, data)
+        except Exception as e:
+            log.exception("Error handling %s: %s", self.path, e)
+            self.send_error(500, str(e))
 
-                conn, c = get_db_connection()
+    def send_line_event(self, event_id):
+        try:
+            event_id = int(event_id)
+        except ValueError:
+            self.send_json(400, {"error": "Invalid ID format"})
+            return
+        conn, c = get_db_connection()
+        try:
+            ph = "%s" if DATABASE_URL else "?"
+            c.execute(f"SELECT * FROM line_events WHERE id = {ph}", (event_id,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+        if not row:
+            self.send_json(404, {"error": "Event not found"})
+            return
+        self.send_json(200, group_index.annotate([dict(row)])[0])
+
+    @route('GET', '/api/action-impact')
+    def api_action_impact(self, params):
+        try:
+            line_code_raw = params.get('line_code', [None])[0]
+            line_code = pad_line_code(line_code_raw) if line_code_raw else None
+            base_date_str = params.get('base_date', [None])[0] # YYYY-MM-DD
+            window = int(params.get('window', [7])[0])
+
+            if not line_code or not base_date_str:
+                self.send_error(400, "Missing parameters")
+                return
+
+            base_date = datetime.strptime(base_date_str, '%Y-%m-%d')
+            
+            shift_days = ((window + 6) // 7) * 7
+            before_start_dt = base_date - timedelta(days=shift_days)
+            before_start = before_start_dt.strftime('%Y-%m-%d')
+            after_start = base_date.strftime('%Y-%m-%d')
+
+            def load_impact():
+                conn, c = get_read_connection('bus_lines')
                 ph = "%s" if DATABASE_URL else "?"
 
                 def get_daily_stats(start_date, num_days):
                     dates = [(datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(num_days)]
+                    archived = line_archive.daily_realized(dates[0], dates[-1], line_code) if dates else {}
                     data = []
                     for dt in dates:
                         c.execute(f"SELECT realized_passengers FROM bus_lines WHERE line_code = {ph} AND date = {ph}", (line_code, dt))
                         row = c.fetchone()
-                        val = row['realized_passengers'] if row else 0
+                        val = row['realized_passengers'] if row else archived.get(dt, 0)
                         data.append({"date": dt, "val": val})
                     return data
 
@@ -962,7 +5174,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 avg_before = sum(d['val'] for d in before_data) / window if window > 0 else 0
                 avg_after = sum(d['val'] for d in after_data) / window if window > 0 else 0
 
-                impact_data = {
+                return {
                     "before": before_data,
                     "after": after_data,
                     "avg_before": avg_before,
@@ -970,66 +5182,68 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                     "window": window
                 }
 
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(impact_data).encode())
-            except Exception as e:
-                traceback.print_exc()
-                self.send_error(500, str(e))
-            return
+            impact_data = query_cache.get_or_load('action-impact', {"line_code": line_code, "base_date": after_start, "window": window}, ('bus_lines',), load_impact)
 
-        if path == '/api/available-lines':
-            try:
-                conn, c = get_db_connection()
+            self.send_json(200, impact_data)
+        except Exception as e:
+            log.exception("Error handling %s: %s", self.path, e)
+            self.send_error(500, str(e))
+
+    @route('GET', '/api/available-lines')
+    def api_available_lines(self, params):
+        try:
+            def load_available_lines():
+                conn, c = get_read_connection('bus_lines')
                 c.execute("SELECT DISTINCT line_code FROM bus_lines ORDER BY line_code")
                 lines = [row[0] for row in c.fetchall()]
                 conn.close()
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(lines).encode())
-            except Exception as e:
-                self.send_response(500)
-                self.wfile.write(str(e).encode())
-            return
+                archived = line_archive.line_codes()
+                return sorted(set(lines) | archived) if archived else lines
 
-        if path == '/api/debug-data':
-            try:
-                conn, c = get_db_connection()
-                c.execute("SELECT date, line_code FROM bus_lines LIMIT 20")
-                rows = c.fetchall()
-                conn.close()
-                
-                debug_info = {
-                    "sample_data": [dict(row) for row in rows],
-                    "message": "Check the format of the 'date' field. Should be YYYY-MM-DD"
-                }
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(debug_info, default=str).encode())
-            except Exception as e:
-                self.send_response(500)
-                self.wfile.write(str(e).encode())
-            return
+            lines = query_cache.get_or_load('available-lines', {}, ('bus_lines',), load_available_lines)
+            self.send_json(200, lines)
+        except Exception as e:
+            self.send_body(500, str(e).encode())
 
-        if path == '/api/lines':
-            try:
-                start_raw = params.get('start', [None])[0]
-                end_raw = params.get('end', [None])[0]
-                
-                # Support multiple lines: ?line_code=8000&line_code=8001 OR ?line_code=8000,8001
-                line_code_params = params.get('line_code', [])
-                target_codes = []
-                for p in line_code_params:
-                    if p:
-                        for part in p.split(','):
-                            padded = pad_line_code(part.strip())
-                            if padded: target_codes.append(padded)
+    @route('GET', '/api/debug-data')
+    def api_debug_data(self, params):
+        try:
+            conn, c = get_db_connection()
+            c.execute("SELECT date, line_code FROM bus_lines LIMIT 20")
+            rows = c.fetchall()
+            conn.close()
+            
+            debug_info = {
+                "sample_data": [dict(row) for row in rows],
+                "message": "Check the format of the 'date' field. Should be YYYY-MM-DD"
+            }
+            
+            self.send_json(200, debug_info)
+        except Exception as e:
+            self.send_body(500, str(e).encode())
 
-                conn, c = get_db_connection()
+    @route('GET', '/api/lines')
+    def api_lines(self, params):
+        try:
+            start_raw = params.get('start', [None])[0]
+            end_raw = params.get('end', [None])[0]
+            
+            # Support multiple lines: ?line_code=8000&line_code=8001 OR ?line_code=8000,8001
+            line_code_params = params.get('line_code', [])
+            target_codes = []
+            for p in line_code_params:
+                if p:
+                    for part in p.split(','):
+                        padded = pad_line_code(part.strip())
+                        if padded: target_codes.append(padded)
+
+            has_start = start_raw is not None and start_raw != '' and start_raw != 'undefined'
+            has_end = end_raw is not None and end_raw != '' and end_raw != 'undefined'
+            # Line order doesn't change the result set, so sort it for a stable cache key
+            target_codes = sorted(set(target_codes))
+
+            def load_lines():
+                conn, c = get_read_connection('bus_lines')
                 ph = "%s" if DATABASE_URL else "?"
                 
                 query = "SELECT * FROM bus_lines WHERE 1=1"
@@ -1040,9 +5254,6 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                     query += f" AND line_code IN ({placeholders})"
                     args.extend(target_codes)
 
-                has_start = start_raw is not None and start_raw != '' and start_raw != 'undefined'
-                has_end = end_raw is not None and end_raw != '' and end_raw != 'undefined'
-
                 if has_start and has_end:
                     query += f" AND date >= {ph} AND date <= {ph}"
                     args.extend([start_raw, end_raw])
@@ -1052,38 +5263,96 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 c.execute(query, args)
                 rows = c.fetchall()
                 conn.close()
-                
                 data = [dict(row) for row in rows]
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(data).encode())
-            except Exception as e:
-                print(f"DEBUG: ERROR in do_GET: {e}", file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
-            return
 
-        if path == '/api/export-group':
-            self.handle_export_group(params)
-            return
+                archived = line_archive.read(start_raw if has_start and has_end else None,
+                                             end_raw if has_start and has_end else None, target_codes)
+                if archived:
+                    data += archived
+                    data.sort(key=lambda r: r['line_code'])
+                    data.sort(key=lambda r: r['date'], reverse=True)
+                return data
 
-        if path == '/api/export-actions':
-            self.handle_export_actions(params)
-            return
+            cache_params = {
+                "lines": target_codes,
+                "start": start_raw if (has_start and has_end) else None,
+                "end": end_raw if (has_start and has_end) else None
+            }
+            data = query_cache.get_or_load('lines', cache_params, ('bus_lines',), load_lines)
+            self.send_json(200, data)
+        except Exception as e:
+            log.exception("ERROR in /api/lines: %s", e)
+            self.send_json(500, {"error": str(e)})
 
-        if path == '/api/global-actions-impact':
-            self.handle_global_actions_impact()
-            return
+    @route('GET', '/api/line-stats')
+    def api_line_stats(self, params):
+        """Summary figures of one line for the detail view, overall and per weekday (see LineStats)."""
+        try:
+            line_code = pad_line_code(params.get('line_code', [''])[0].strip())
+            if not line_code:
+                self.send_json(400, {"error": "line_code é obrigatório"})
+                return
+            start = params.get('start', [None])[0] or None
+            end = params.get('end', [None])[0] or None
+            for value in (start, end):
+                if value and not re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+                    self.send_json(400, {"error": "start/end devem estar no formato YYYY-MM-DD"})
+                    return
+            data = query_cache.get_or_load('line-stats', {"line": line_code, "start": start, "end": end},
+                                           ('line_stats', 'bus_lines'), lambda: line_stats.summary(line_code, start, end))
+            self.send_json(200, data)
+        except Exception as e:
+            log.exception("ERROR in /api/line-stats: %s", e)
+            self.send_json(500, {"error": str(e)})
 
-        if path == '/api/system-impact':
-            self.handle_system_impact()
+    def send_file_body(self, f, size, offset=0):
+        """Sends size bytes of an open file from offset as the response body, zero-copy where the connection allows it."""
+        if size <= 0:
+            return
+        loop_sendfile = getattr(self._conn_wfile, 'sendfile', None)
+        sock = getattr(self, 'connection', None)
+        if loop_sendfile:
+            loop_sendfile(f, offset, size) # asyncio front end
+        elif isinstance(sock, socket.socket):
+            sock.sendfile(f, offset, size)
+        else:
+            f.seek(offset)
+            remaining = size
+            while remaining:
+                chunk = f.read(min(remaining, 64 * 1024))
+                if not chunk:
+                    break
+                self._conn_wfile.write(chunk)
+                remaining -= len(chunk)
+        self.wfile.count += size
+
+    def serve_static(self, path):
+        entry, immutable = static_assets.lookup(path)
+        if entry:
+            self._cache_headers_set = True
+            cache_control = StaticAssets.IMMUTABLE if immutable else 'no-cache'
+            if entry["etag"] in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', entry["etag"])
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-type', entry["content_type"])
+            self.send_header('Content-Length', str(entry["size"]))
+            self.send_header('ETag', entry["etag"])
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+            if entry["data"] is not None:
+                self.wfile.write(entry["data"])
+            else:
+                with open(entry["path"], 'rb') as f:
+                    self.send_file_body(f, entry["size"])
             return
 
-        # Serve static files from 'static' directory if not an API route
+        # Not in the pipeline: serve from the 'static' directory the old way
         if path == '/' or path == '':
             full_path = 'static/index.html'
         elif path.startswith('/static/'):
@@ -1099,9 +5368,8 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         super().do_GET()
 
 
-
     def process_csv_stream(self, text_stream):
-        print("Processing CSV Stream...")
+        log.info("Processing CSV Stream...")
         
         # Read header line
         header_line = text_stream.readline()
@@ -1110,14 +5378,14 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 
         # Detect delimiter
         delimiter = ';' if ';' in header_line else ','
-        print(f"Detected Delimiter: '{delimiter}'")
+        log.info("Detected Delimiter: '%s'", delimiter)
         
         # Parse headers
         fieldnames = next(csv.reader([header_line], delimiter=delimiter))
         
         # Normalize headers
         normalized_headers = {h.strip().lower(): i for i, h in enumerate(fieldnames)}
-        print(f"DEBUG: Normalized Headers Detected: {normalized_headers}")
+        log.debug("Normalized Headers Detected: %s", normalized_headers)
         
         # Heuristics
         idx_date = next((i for h, i in normalized_headers.items() if any(k in h for k in ['datadebito', 'data', 'date', 'dia', 'periodo'])), None)
@@ -1127,7 +5395,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         if idx_pass is None:
             idx_pass = next((i for h, i in normalized_headers.items() if any(k in h for k in ['passageiros', 'qtd', 'passengers', 'val'])), None)
         idx_company = next((i for h, i in normalized_headers.items() if any(k in h for k in ['empresa', 'company', 'operadora', 'nome'])), None)
-        print(f"DEBUG: Column Indices -> Date: {idx_date}, Line: {idx_line}, Pass: {idx_pass}, Company: {idx_company}")
+        log.debug("Column Indices -> Date: %s, Line: %s, Pass: %s, Company: %s", idx_date, idx_line, idx_pass, idx_company)
 
         if idx_date is None or idx_line is None:
              raise ValueError(f"Essential Columns (Date/Line) not found.")
@@ -1141,25 +5409,23 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         # Cache date parsing
         date_cache = {}
         
-        print("Starting aggregation...")
+        log.info("Starting aggregation...")
         iterator = iter(reader)
         skipped_900_count = 0
         
-        print("Starting aggregation (Robust Loop)...")
+        log.debug("Starting aggregation (Robust Loop)...")
         while True:
             try:
                 row = next(iterator)
             except StopIteration:
                 break
             except Exception as e:
-                print(f"CSV Read Error at row {count+1}: {e}")
-                import traceback
-                traceback.print_exc()
+                log.exception("CSV Read Error at row %s: %s", count + 1, e)
                 continue
 
             if not row: continue
             count += 1
-            if count % 500000 == 0: print(f"Processed {count} rows...")
+            if count % 500000 == 0: log.info("Processed %s rows...", count)
             
             try:
                 date_str = row[idx_date].strip()
@@ -1180,14 +5446,14 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 if line_str == '900':
                     skipped_900_count += 1
                     if skipped_900_count % 1000 == 0:
-                        print(f"DEBUG: Skipped {skipped_900_count} occurrences of line '900' so far...", flush=True)
+                        log.debug("Skipped %s occurrences of line '900' so far...", skipped_900_count)
                     continue
 
                 # Fix specific typo/encoding mismatch for Maintenance line
                 # User repo: Realized='MANUTENÃÃO' vs Predicted='MNUTENÇÃO'
                 # DEBUGGING: Print what we see to catch the exact variation
                 if 'MANUTEN' in line_str or 'MNUTEN' in line_str or 'ÃÃO' in line_str:
-                     print(f"DEBUG: Found Line potential match: '{line_str}'", flush=True)
+                     log.debug("Found Line potential match: '%s'", line_str)
 
                 if line_str == 'MANUTENÃÃO' or 'MANUTEN' in line_str: 
                     line_str = 'MNUTENÇÃO'
@@ -1243,7 +5509,11 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 # print(f"Row processing error: {e}") 
                 continue
 
-        print(f"Aggregation finished. {count} rows -> {len(aggregated)} stats. (Skipped 900: {skipped_900_count})")
+        log.info("Aggregation finished. %s rows -> %s stats. (Skipped 900: %s)", count, len(aggregated), skipped_900_count)
+
+        # An archived month is moved back into bus_lines before it is written to, and every month needs its partition
+        line_archive.restore_dates({date for (date, _, _) in aggregated})
+        bus_line_partitions.ensure({date for (date, _, _) in aggregated})
 
         # Bulk Upsert
         conn, c = get_db_connection()
@@ -1254,7 +5524,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
             for (date, line, comp), info in aggregated.items()
         ]
         
-        print("Writing to database...")
+        log.info("Writing to database...")
         try:
             # PostgreSQL syntax: ON CONFLICT (col1, col2) DO UPDATE...
             # SQLite syntax: same (if version matches)
@@ -1273,29 +5543,31 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 c.executemany(upsert_query.replace('%s', '?'), data_to_insert)
             
             conn.commit()
-            print("Database transaction committed.")
+            mark_tables_changed('bus_lines', dates={date for (date, _, _) in aggregated})
+            log.info("Database transaction committed.")
         except Exception as e:
             conn.rollback()
-            print(f"DB Error: {e}")
+            log.error("DB Error: %s", e)
             raise e
         finally:
             conn.close()
+        line_stats.refresh({date for (date, _, _) in aggregated}, {line for (_, line, _) in aggregated})
 
     # ... process_csv_stream ...
 
     def process_predicted_stream(self, text_stream):
-        print("Processing Predicted Stream...")
+        log.info("Processing Predicted Stream...")
         header_line = text_stream.readline()
         if not header_line: raise ValueError("Empty CSV")
         
         # Improved Delimiter Detection
         delimiter = ';' if ';' in header_line else ','
-        print(f"Detected Delimiter: '{delimiter}'")
+        log.info("Detected Delimiter: '%s'", delimiter)
         
         fieldnames = next(csv.reader([header_line], delimiter=delimiter))
-        print(f"Headers Found: {fieldnames}")
+        log.info("Headers Found: %s", fieldnames)
         normalized_headers = {h.strip().lower(): i for i, h in enumerate(fieldnames)}
-        print(f"DEBUG (Predicted): Normalized Headers Detected: {normalized_headers}")
+        log.debug("(Predicted) Normalized Headers Detected: %s", normalized_headers)
         
         # Heuristics for Predicted - Extended
         idx_date = next((i for h, i in normalized_headers.items() if any(k in h for k in ['período', 'periodo', 'data', 'date', 'dia', 'dt_'])), None)
@@ -1324,7 +5596,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         aggregated = {}
         date_cache = {}
         
-        print(f"Starting Scan (Predicted) using delimiter '{delimiter}'...")
+        log.info("Starting Scan (Predicted) using delimiter '%s'...", delimiter)
         
         for row in reader:
             if not row: continue
@@ -1333,7 +5605,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 sample_rows.append(row)
             
             count += 1
-            if count % 50000 == 0: print(f"Proc {count}...")
+            if count % 50000 == 0: log.info("Proc %s...", count)
             
             # Sum every column for debug
             for i, cell in enumerate(row):
@@ -1367,7 +5639,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                     # If components are more than the total, we should probably use comp_sum!
                     audit_fail_count += 1
                     if audit_fail_count < 100:
-                         print(f"AUDIT WARNING: Row {count} - Components ({comp_sum}) > Total ({val}). Using components.")
+                         log.warning("AUDIT WARNING: Row %s - Components (%s) > Total (%s). Using components.", count, comp_sum, val)
                     val = comp_sum
                 
                 raw_total_sum += val
@@ -1410,7 +5682,7 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
             except Exception as e:
                 skipped_count += 1
                 if skipped_count < 10:
-                    print(f"Predicted Row Error row {count}: {e}")
+                    log.warning("Predicted Row Error row %s: %s", count, e)
                 continue
         
         agg_total_sum = sum(info['pass'] for info in aggregated.values())
@@ -1427,11 +5699,13 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         for r in sample_rows:
             debug_msg += f"{r}\n"
             
-        print(debug_msg)
+        log.debug(debug_msg)
         with open("import_debug.log", "w", encoding="utf-8") as f:
             f.write(debug_msg)
         
-        print(f"Pred Agg Finished. {len(aggregated)} records starting DB sync...")
+        log.info("Pred Agg Finished. %s records starting DB sync...", len(aggregated))
+        line_archive.restore_dates({date for (date, _, _) in aggregated})
+        bus_line_partitions.ensure({date for (date, _, _) in aggregated})
         
         conn, c = get_db_connection()
         ph = "%s" if DATABASE_URL else "?"
@@ -1456,194 +5730,327 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 c.executemany(upsert_query.replace('%s', '?'), data_to_insert)
                 
             conn.commit()
-            print(f"DB Updated (Predicted). {len(data_to_insert)} records processed.")
+            mark_tables_changed('bus_lines', dates={date for (date, _, _) in aggregated})
+            log.info("DB Updated (Predicted). %s records processed.", len(data_to_insert))
         except Exception as e:
             conn.rollback()
             raise e
         finally:
             conn.close()
+        line_stats.refresh({date for (date, _, _) in aggregated}, {line for (_, line, _) in aggregated})
 
-    def handle_export_group(self, params):
-        group_id = params.get('group_id', [None])[0]
-        start = params.get('start', [None])[0]
-        end = params.get('end', [None])[0]
-        
-        if not all([group_id, start, end]):
-            self.send_error(400, "Parâmetros ausentes")
-            return
-
+    def send_export(self, name, params):
+        """Serves an export from the export cache, or streams it while saving a copy into the cache."""
         try:
-            conn, c = get_db_connection()
-            ph = "%s" if DATABASE_URL else "?"
-            
-            # 1. Get lines in group
-            c.execute(f"SELECT line_code FROM line_group_members WHERE group_id = {ph}", (group_id,))
-            lines = [r[0] for r in c.fetchall()]
-            
-            if not lines:
-                self.send_error(404, "Bloco vazio ou não encontrado")
-                conn.close()
-                return
-
-            # 2. Get data for these lines/dates
-            placeholders = ','.join([ph] * len(lines))
-            query = f"""
-                SELECT date, line_code, SUM(predicted_passengers), SUM(realized_passengers)
-                FROM bus_lines 
-                WHERE line_code IN ({placeholders}) 
-                  AND date BETWEEN {ph} AND {ph}
-                GROUP BY date, line_code
-                ORDER BY date ASC, line_code ASC
-            """
-            c.execute(query, lines + [start, end])
-            rows = c.fetchall()
-            
-            # Get group name for filename
-            c.execute(f"SELECT name FROM line_groups WHERE id = {ph}", (group_id,))
-            group_name_row = c.fetchone()
-            group_name = group_name_row[0] if group_name_row else "bloco"
-            
-            conn.close()
-
-            if not rows:
-                self.send_error(404, "Nenhum dado encontrado para este período")
+            plan = EXPORT_PLANS[name](params)
+            key = export_cache.key(plan)
+            found = export_cache.lookup(key)
+            if found:
+                self.send_cached_export(key, *found)
                 return
-
-            # 3. Process with pandas
-            df = pd.DataFrame(rows, columns=['date', 'LINHA', 'PREVISTO', 'REALIZADO'])
-            
-            # 4. Create Excel in memory
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                # Group by date - each date gets a sheet
-                for date, group_df in df.groupby('date'):
-                    sheet_name = str(date)
-                    sheet_df = group_df.copy()
-                    
-                    # Round values for clean Excel
-                    sheet_df['PREVISTO'] = sheet_df['PREVISTO'].round(0)
-                    sheet_df['REALIZADO'] = sheet_df['REALIZADO'].round(0)
-                    
-                    # Sort by line code for readability
-                    sheet_df = sheet_df.drop(columns=['date']).sort_values('LINHA')
-                    sheet_df.to_excel(writer, sheet_name=sheet_name, index=False)
-            
-            excel_data = output.getvalue()
-
-            # 5. Send response
+            write = plan["produce"]()
+            entry = export_cache.open_entry(key) if export_cache.enabled else None
+            try:
+                export_engine.send(self, plan["filename"], plan["format"], write, plan["label"], copy=entry,
+                                   complete=(lambda: export_cache.commit(key, entry, plan)) if entry else None)
+            except BaseException:
+                if entry and not entry.closed:
+                    export_cache.discard(entry)
+                raise
+        except ExportError as e:
+            self.send_error(e.status, e.message)
+        except Exception as e:
+            log.exception("Export Error (%s): %s", name, e)
+            if self._status is None:
+                self.send_body(500, f"Erro ao gerar exportação: {str(e)}".encode(), 'text/plain')
+
+    def send_cached_export(self, key, path, meta):
+        etag = f'"{key}"'
+        self._cache_headers_set = True
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'private, no-cache')
+            self.end_headers()
+            return
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
             self.send_response(200)
-            self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            self.send_header('Content-Disposition', f'attachment; filename="Export_{group_name}_{start}_{end}.xlsx"')
-            self.send_header('Content-Length', len(excel_data))
+            self.send_header('Content-Type', ExportEngine.FORMATS[meta["format"]][0])
+            self.send_header('Content-Disposition', f'attachment; filename="{meta["filename"]}"')
+            self.send_header('Content-Length', str(size))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'private, no-cache')
+            self.send_header('X-Export-Cache', 'HIT')
             self.end_headers()
-            self.wfile.write(excel_data)
+            self.send_file_body(f, size)
 
-        except Exception as e:
-            print(f"Excel Export Error: {e}")
-            import traceback
-            traceback.print_exc()
-            self.send_response(500)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(f"Erro ao gerar Excel: {str(e)}".encode())
+    @route('GET', '/api/export-group')
+    def handle_export_group(self, params):
+        self.send_export('group', params)
 
+    @route('GET', '/api/export-actions')
     def handle_export_actions(self, params):
-        start = params.get('start', [None])[0]
-        end = params.get('end', [None])[0]
-        
-        if not start or not end:
-            self.send_error(400, "Período não selecionado")
-            return
+        self.send_export('actions', params)
 
+    @route('GET', '/api/archive')
+    def api_archive_list(self, params):
+        if not self.require_master():
+            return
+        self.send_json(200, {"available": line_archive.available, "months": line_archive.describe()})
+
+    @route('POST', '/api/archive')
+    def api_archive(self, params):
+        """
+        Moves closed months of bus_lines into the Parquet archive (MASTER only).
+        Body: {"before": "YYYY-MM"} archives every month before it; without it, all but the
+        last ARCHIVE_KEEP_MONTHS closed months. The current month is never archived.
+        """
+        if not self.require_master():
+            return
+        if not line_archive.available:
+            self.send_json(503, {"error": "O arquivo Parquet requer o pacote pyarrow"})
+            return
+        content_length = int(self.headers.get('Content-Length', 0))
         try:
-            conn, c = get_db_connection()
-            ph = "%s" if DATABASE_URL else "?"
-            
-            # Query joined data
-            query = f"""
-                SELECT 
-                    e.created_at, 
-                    e.implementation_date, 
-                    g.name as group_name,
-                    e.line_code, 
-                    e.fact, 
-                    e.cause, 
-                    e.action_taken, 
-                    e.analysis_conclusion, 
-                    e.analyst
-                FROM line_events e
-                LEFT JOIN line_group_members m ON e.line_code = m.line_code
-                LEFT JOIN line_groups g ON m.group_id = g.id
-                WHERE (e.implementation_date BETWEEN {ph} AND {ph} OR e.implementation_date IS NULL OR e.implementation_date = '')
-                ORDER BY CASE WHEN e.implementation_date IS NULL OR e.implementation_date = '' THEN 1 ELSE 0 END DESC, COALESCE(NULLIF(e.implementation_date, ''), CAST(e.created_at AS TEXT)) DESC, e.created_at DESC
-            """
-            c.execute(query, (start, end))
-            rows = c.fetchall()
-            conn.close()
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            today = datetime.now()
+            current = f"{today.year:04d}-{today.month:02d}"
+            keep_from = today.year * 12 + today.month - 1 - ARCHIVE_KEEP_MONTHS
+            before = data.get('before') or f"{keep_from // 12:04d}-{keep_from % 12 + 1:02d}"
+            if not re.fullmatch(r'\d{4}-\d{2}', before):
+                self.send_json(400, {"error": "before deve estar no formato YYYY-MM"})
+                return
+            before = min(before, current)
+            archived = []
+            for month in line_archive.live_months(before):
+                year, month_number = line_archive.month_of(month)
+                if (year, month_number) in line_archive.months():
+                    continue # Left over by an import that ran while it was being restored
+                archived.append({"month": month, "rows": line_archive.archive_month(year, month_number)})
+            self.send_json(200, {"success": True, "before": before, "archived": archived})
+        except (ValueError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            log.exception("Archive Error: %s", e)
+            self.send_json(500, {"error": str(e)})
 
-            if not rows:
-                self.send_error(404, "Nenhuma ação encontrada para este período")
+    @route('POST', '/api/archive/restore')
+    def api_archive_restore(self, params):
+        """Moves one archived month back into bus_lines (MASTER only). Body: {"month": "YYYY-MM"}."""
+        if not self.require_master():
+            return
+        if not line_archive.available:
+            self.send_json(503, {"error": "O arquivo Parquet requer o pacote pyarrow"})
+            return
+        content_length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            month = data.get('month') or ''
+            if not re.fullmatch(r'\d{4}-\d{2}', month):
+                self.send_json(400, {"error": "month deve estar no formato YYYY-MM"})
                 return
+            rows = line_archive.restore_month(*line_archive.month_of(month))
+            self.send_json(200, {"success": True, "month": month, "rows": rows})
+        except (ValueError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            log.exception("Archive Restore Error: %s", e)
+            self.send_json(500, {"error": str(e)})
 
-            # Column names in Portuguese for the Excel
-            cols = [
-                'DATA CADASTRO', 'DATA AÇÃO', 'GRUPO', 'LINHA', 
-                'FATO', 'CAUSA', 'AÇÃO', 'ANÁLISE', 'NOME'
-            ]
-            
-            # Clean data (format dates and sanitize strings)
-            clean_rows = []
-            for r in rows:
-                row_list = list(r)
-                for i in range(len(row_list)):
-                    if i in [0, 1]:
-                        # Format created_at and implementation_date to DD/MM/YYYY if they look like YYYY-MM-DD
-                        if row_list[i] and '-' in str(row_list[i]):
-                            parts = str(row_list[i]).split(' ')[0].split('-')
-                            if len(parts) == 3:
-                                row_list[i] = f"{parts[2]}/{parts[1]}/{parts[0]}"
-                    elif isinstance(row_list[i], str):
-                        # Sanitize strings to remove newlines, multiple spaces
-                        row_list[i] = ' '.join(row_list[i].split())
-                clean_rows.append(row_list)
+    @route('GET', '/api/partitions')
+    def api_partitions(self, params):
+        if not self.require_master():
+            return
+        if not bus_line_partitions.enabled:
+            self.send_json(200, {"enabled": False, "partitions": []})
+            return
+        self.send_json(200, {"enabled": True, "partitions": bus_line_partitions.describe()})
+
+    @route('POST', '/api/partitions/detach')
+    def api_detach_partition(self, params):
+        """
+        Detaches one month of bus_lines (MASTER only). Body: {"month": "YYYY-MM", "drop": false}.
+        The rows leave every view at once; without drop they stay in <partition>_detached.
+        """
+        if not self.require_master():
+            return
+        if not bus_line_partitions.enabled:
+            self.send_json(400, {"error": "bus_lines não é particionada (apenas PostgreSQL, após a migração)"})
+            return
+        content_length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            month = data.get('month') or ''
+            if not re.fullmatch(r'\d{4}-\d{2}', month):
+                self.send_json(400, {"error": "month deve estar no formato YYYY-MM"})
+                return
+            bus_line_partitions.detach(*LineArchive.month_of(month), drop=bool(data.get('drop')))
+            self.send_json(200, {"success": True, "month": month, "dropped": bool(data.get('drop'))})
+        except (ValueError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            log.exception("Partition Detach Error: %s", e)
+            self.send_json(500, {"error": str(e)})
+
+    @route('GET', '/api/export-lines')
+    def handle_export_lines(self, params):
+        """
+        Raw bus_lines rows for BI tools, live and archived, streamed in (date, id) order from a
+        server-side cursor merged with the Parquet archive one month at a time, so memory stays
+        flat however large the range.
+        - format=csv (default, comma-separated, no BOM) or ndjson
+        - gzip-compressed (Content-Encoding) when the client accepts it, unless gzip=0
+        - Filters: start/end, line_code and company (repeated or comma-separated) and
+          group_id (the group's lines are added to line_code)
+        - Every row carries its id and date: after a dropped connection, repeat the request with
+          after=<last id received> (and after_date=<its date>, else looked up) to continue where it stopped
+        - 409 when the range reaches archived months and pyarrow is not installed
+        """
+        def values(name):
+            return [v.strip() for p in params.get(name, []) for v in p.split(',') if v.strip()]
 
-            df = pd.DataFrame(clean_rows, columns=cols)
-            
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, sheet_name='Ações', index=False)
-                
-                # Auto-adjust column widths
-                worksheet = writer.sheets['Ações']
-                for idx, col in enumerate(df.columns):
-                    series = df[col]
-                    max_len = max((
-                        series.astype(str).map(len).max(),
-                        len(str(series.name))
-                    )) + 2
-                    worksheet.column_dimensions[chr(65 + idx)].width = min(max_len, 50)
-
-            excel_data = output.getvalue()
+        try:
+            fmt = export_options(params, ('rows',), formats=('csv', 'ndjson'))[0]
+            after = params.get('after', [None])[0]
+            after = int(after) if after else None
+        except ExportError as e:
+            self.send_error(e.status, e.message)
+            return
+        except ValueError:
+            self.send_error(400, "after deve ser o id da última linha recebida")
+            return
+        after_date = params.get('after_date', [None])[0]
+        if after_date and not re.fullmatch(r'\d{4}-\d{2}-\d{2}', after_date):
+            self.send_error(400, "after_date deve estar no formato YYYY-MM-DD")
+            return
 
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            self.send_header('Content-Disposition', f'attachment; filename="Export_Acoes_{start}_a_{end}.xlsx"')
-            self.send_header('Content-Length', len(excel_data))
-            self.end_headers()
-            self.wfile.write(excel_data)
+        ph = "%s" if DATABASE_URL else "?"
+        if after is not None and not after_date:
+            # Older clients resume with the id alone: find the row's date (live or archived)
+            conn, c = get_db_connection()
+            try:
+                c.execute(f"SELECT date FROM bus_lines WHERE id = {ph}", (after,))
+                row = c.fetchone()
+            finally:
+                conn.close()
+            after_date = str(row[0])[:10] if row else line_archive.date_of(after)
+            if not after_date:
+                self.send_error(400, "after não encontrado; informe também after_date (data da última linha recebida)")
+                return
+        where, args = [], []
+        lines = [code for code in (pad_line_code(v) for v in values('line_code')) if code]
+        group_ids = values('group_id')
+        for group_id in group_ids:
+            group = group_index.get(group_id)
+            if not group:
+                self.send_error(404, f"Bloco não encontrado: {group_id}")
+                return
+            lines.extend(group["lines"])
+        if values('line_code') or group_ids:
+            lines = sorted(set(lines))
+            if lines:
+                where.append(f"line_code IN ({','.join([ph] * len(lines))})")
+                args.extend(lines)
+            else:
+                where.append("1 = 0") # Only empty groups were asked for
+        companies = sorted({normalize_text(v) for v in values('company')})
+        if companies:
+            where.append(f"company IN ({','.join([ph] * len(companies))})")
+            args.extend(companies)
+        start = params.get('start', [None])[0]
+        end = params.get('end', [None])[0]
+        if start:
+            where.append(f"date >= {ph}")
+            args.append(start)
+        if end:
+            where.append(f"date <= {ph}")
+            args.append(end)
+        if after is not None:
+            where.append(f"(date > {ph} OR (date = {ph} AND id > {ph}))")
+            args.extend([after_date, after_date, after])
+
+        archived_months = line_archive.months_between(start, end)
+        if after_date:
+            archived_months = [m for m in archived_months if m >= line_archive.month_of(after_date)]
+        if archived_months and pyarrow is None:
+            self.send_error(409, "O período inclui meses arquivados em Parquet, mas o pacote pyarrow não está instalado")
+            return
 
+        columns = LineArchive.COLUMNS
+        sql = f"SELECT {', '.join(columns)} FROM bus_lines WHERE {' AND '.join(where) or '1 = 1'} ORDER BY date, id"
+        filtered_by_line = bool(values('line_code') or group_ids)
+
+        def write(book):
+            book.sheet('bus_lines', columns)
+            live = (tuple(r) for r in iter_query(sql, args))
+            archived = () if filtered_by_line and not lines else line_archive.iter_rows(
+                start, end, lines or None, companies, (after_date, after) if after is not None else None)
+            # A month is either live or archived, so the two streams interleave by month
+            for r in heapq.merge(live, archived, key=lambda r: (str(r[1])[:10], r[0])):
+                book.row(list(r))
+
+        gzip_param = params.get('gzip', [None])[0]
+        compress = gzip_param == '1' or (gzip_param != '0' and 'gzip' in self.headers.get('Accept-Encoding', ''))
+        book_class = functools.partial(CsvBook, delimiter=',', bom=False) if fmt == 'csv' else None
+        try:
+            export_engine.send(self, f"bus_lines_{start or 'inicio'}_{end or 'fim'}.{fmt}", fmt, write, "lines",
+                               book_class=book_class, compress=compress)
         except Exception as e:
-            print(f"Actions Export Error: {e}")
-            import traceback
-            traceback.print_exc()
-            self.send_error(500, str(e))
+            log.exception("Lines Export Error: %s", e)
+            if self._status is None:
+                self.send_body(500, f"Erro ao gerar exportação: {str(e)}".encode(), 'text/plain')
+
+    @route('POST', '/api/export-jobs')
+    def api_create_export_job(self, params):
+        """
+        Builds an export in the background. Body: {"export": "group"|"actions", "params": {...}}
+        with the query parameters of the matching /api/export-* route. Poll GET /api/export-jobs?id=
+        until status is done, then download from download_url.
+        Jobs run on the server and write to disk, so a login session is required.
+        """
+        content_length = int(self.headers.get('Content-Length', 0))
+        if not self.require_session():
+            return
+        try:
+            data = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            name = data.get('export')
+            if name not in EXPORT_PLANS:
+                raise ExportError(400, f"export deve ser {'/'.join(EXPORT_PLANS)}")
+            if not export_cache.enabled:
+                raise ExportError(503, "Cache de exportação desativado")
+            plan = EXPORT_PLANS[name]({k: [str(v)] for k, v in (data.get('params') or {}).items()})
+            state = export_cache.submit(export_cache.key(plan), plan)
+            self.send_json(200 if state["status"] == 'done' else 202, state)
+        except ExportError as e:
+            self.send_json(e.status, {"error": e.message})
+        except (ValueError, AttributeError):
+            self.send_json(400, {"error": "JSON inválido"})
+        except Exception as e:
+            log.exception("Export job error: %s", e)
+            self.send_json(500, {"error": str(e)})
+
+    @route('GET', '/api/export-jobs')
+    def api_export_job_state(self, params):
+        key = params.get('id', [None])[0]
+        state = export_cache.job_state(key) if export_cache.is_key(key) else None
+        if not state:
+            self.send_json(404, {"error": "Exportação não encontrada"})
+            return
+        self.send_json(200, state)
+
+    @route('GET', '/api/export-jobs/download')
+    def api_export_job_download(self, params):
+        key = params.get('id', [None])[0]
+        found = export_cache.lookup(key, count=False) if export_cache.is_key(key) else None
+        if not found:
+            self.send_error(404, "Exportação não encontrada ou expirada")
+            return
+        self.send_cached_export(key, *found)
 
-    def handle_global_actions_impact(self):
+    @route('GET', '/api/global-actions-impact')
+    def handle_global_actions_impact(self, params):
         try:
-            from urllib.parse import urlparse, parse_qs
-            parsed_url = urlparse(self.path)
-            params = parse_qs(parsed_url.query)
-            
             start_filter = params.get('start', [None])[0]
             end_filter = params.get('end', [None])[0]
             
@@ -1659,92 +6066,101 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                             if padded and padded.lower() != 'all':
                                 all_line_codes.append(padded)
             
-            print(f"DEBUG Impact API -> Start: {start_filter}, End: {end_filter}, Lines: {all_line_codes}")
+            log.debug("Impact API -> Start: %s, End: %s, Lines: %s", start_filter, end_filter, all_line_codes)
 
-            conn, c = get_db_connection()
-            ph = "%s" if DATABASE_URL else "?"
+            def load_global_impact():
+                conn, c = get_db_connection()
+                ph = "%s" if DATABASE_URL else "?"
             
-            # 1. Get filtered events (Actions)
-            query = "SELECT * FROM line_events WHERE (type = 'ACTION' OR type = 'BOTH')"
-            args = []
-            if start_filter:
-                query += f" AND implementation_date >= {ph}"
-                args.append(start_filter)
-            if end_filter:
-                query += f" AND implementation_date <= {ph}"
-                args.append(end_filter)
+                # 1. Get filtered events (Actions)
+                query = "SELECT * FROM line_events WHERE (type = 'ACTION' OR type = 'BOTH')"
+                args = []
+                if start_filter:
+                    query += f" AND implementation_date >= {ph}"
+                    args.append(start_filter)
+                if end_filter:
+                    query += f" AND implementation_date <= {ph}"
+                    args.append(end_filter)
             
-            if all_line_codes:
-                placeholders = ','.join([ph] * len(all_line_codes))
-                query += f" AND line_code IN ({placeholders})"
-                args.extend(all_line_codes)
+                if all_line_codes:
+                    placeholders = ','.join([ph] * len(all_line_codes))
+                    query += f" AND line_code IN ({placeholders})"
+                    args.extend(all_line_codes)
             
-            query += " ORDER BY CASE WHEN implementation_date IS NULL OR implementation_date = '' THEN 1 ELSE 0 END DESC, COALESCE(NULLIF(implementation_date, ''), CAST(created_at AS TEXT)) DESC, created_at DESC"
-            c.execute(query, tuple(args))
-            actions = c.fetchall()
+                query += " ORDER BY CASE WHEN implementation_date IS NULL OR implementation_date = '' THEN 1 ELSE 0 END DESC, COALESCE(NULLIF(implementation_date, ''), CAST(created_at AS TEXT)) DESC, created_at DESC"
+                c.execute(query, tuple(args))
+                actions = c.fetchall()
+                conn.close()
+
+                # line_events lives only on the primary; the daily figures can come from the mirror
+                conn, c = get_read_connection('bus_lines')
             
-            results = []
-            window = 7 # 7 days comparison
+                results = []
+                window = 7 # 7 days comparison
             
-            for action in actions:
-                line_code = action['line_code']
-                base_date_str = action['implementation_date']
-                if not base_date_str: continue # Skip actions without date
-                base_date = datetime.strptime(base_date_str, '%Y-%m-%d')
+                for action in actions:
+                    line_code = action['line_code']
+                    base_date_str = action['implementation_date']
+                    if not base_date_str: continue # Skip actions without date
+                    base_date = datetime.strptime(base_date_str, '%Y-%m-%d')
                 
-                # Weekday Alignment (Simplified for global view)
-                shift_days = 7
-                before_start_dt = base_date - timedelta(days=shift_days)
+                    # Weekday Alignment (Simplified for global view)
+                    shift_days = 7
+                    before_start_dt = base_date - timedelta(days=shift_days)
                 
-                def get_avg(start_dt):
-                    vals = []
-                    for i in range(window):
-                        dt = (start_dt + timedelta(days=i)).strftime('%Y-%m-%d')
-                        c.execute(f"SELECT realized_passengers FROM bus_lines WHERE line_code = {ph} AND date = {ph}", (line_code, dt))
-                        row = c.fetchone()
-                        if row: vals.append(row['realized_passengers'])
-                    return sum(vals)/len(vals) if vals else 0
-
-                avg_before = get_avg(before_start_dt)
-                avg_after = get_avg(base_date)
+                    def get_avg(start_dt):
+                        vals = []
+                        archived = line_archive.daily_realized(start_dt.strftime('%Y-%m-%d'), (start_dt + timedelta(days=window - 1)).strftime('%Y-%m-%d'), line_code)
+                        for i in range(window):
+                            dt = (start_dt + timedelta(days=i)).strftime('%Y-%m-%d')
+                            c.execute(f"SELECT realized_passengers FROM bus_lines WHERE line_code = {ph} AND date = {ph}", (line_code, dt))
+                            row = c.fetchone()
+                            if row: vals.append(row['realized_passengers'])
+                            elif dt in archived: vals.append(archived[dt])
+                        return sum(vals)/len(vals) if vals else 0
+
+                    avg_before = get_avg(before_start_dt)
+                    avg_after = get_avg(base_date)
                 
-                diff = avg_after - avg_before
-                percent = (diff / avg_before * 100) if avg_before > 0 else 0
+                    diff = avg_after - avg_before
+                    percent = (diff / avg_before * 100) if avg_before > 0 else 0
                 
-                status = "Estável"
-                if percent > 2: status = "Melhorou"
-                elif percent < -2: status = "Piorou"
-
-                results.append({
-                    "id": action['id'],
-                    "line_code": line_code,
-                    "date": base_date_str,
-                    "action_type": action['type'],
-                    "comment": action['action_taken'] or action['fact'],
-                    "avg_before": round(avg_before, 1),
-                    "avg_after": round(avg_after, 1),
-                    "diff": round(diff, 1),
-                    "percent": round(percent, 1),
-                    "status": status
-                })
+                    status = "Estável"
+                    if percent > 2: status = "Melhorou"
+                    elif percent < -2: status = "Piorou"
+
+                    results.append({
+                        "id": action['id'],
+                        "line_code": line_code,
+                        "date": base_date_str,
+                        "action_type": action['type'],
+                        "comment": action['action_taken'] or action['fact'],
+                        "avg_before": round(avg_before, 1),
+                        "avg_after": round(avg_after, 1),
+                        "diff": round(diff, 1),
+                        "percent": round(percent, 1),
+                        "status": status
+                    })
             
-            conn.close()
+                conn.close()
+                return results
+
+            results = query_cache.get_or_load(
+                'global-actions-impact',
+                {"start": start_filter, "end": end_filter, "lines": sorted(set(all_line_codes))},
+                ('line_events', 'bus_lines'),
+                load_global_impact
+            )
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(results).encode())
+            self.send_json(200, results)
             
         except Exception as e:
-            print(f"Global Impact Error: {e}")
+            log.exception("Global Impact Error: %s", e)
             self.send_error(500, str(e))
 
-    def handle_system_impact(self):
+    @route('GET', '/api/system-impact')
+    def handle_system_impact(self, params):
         try:
-            from urllib.parse import urlparse, parse_qs
-            parsed_url = urlparse(self.path)
-            params = parse_qs(parsed_url.query)
-            
             base_date_str = params.get('base_date', [None])[0]
             window = int(params.get('window', [7])[0])
 
@@ -1757,41 +6173,70 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
             shift_days = ((window + 6) // 7) * 7
             before_start_dt = base_date - timedelta(days=shift_days)
 
-            conn, c = get_db_connection()
-            ph = "%s" if DATABASE_URL else "?"
+            def load_system_impact():
+                conn, c = get_read_connection('bus_lines')
+                ph = "%s" if DATABASE_URL else "?"
 
-            def get_system_daily_stats(start_dt, num_days):
-                data = []
-                for i in range(num_days):
-                    dt = (start_dt + timedelta(days=i)).strftime('%Y-%m-%d')
-                    # Sum realized passengers for ALL lines on this date
-                    c.execute(f"SELECT SUM(realized_passengers) as total FROM bus_lines WHERE date = {ph}", (dt,))
-                    row = c.fetchone()
-                    val = row['total'] if row and row['total'] else 0
-                    data.append({"date": dt, "val": val})
-                return data
+                def get_system_daily_stats(start_dt, num_days):
+                    data = []
+                    archived = line_archive.daily_realized(start_dt.strftime('%Y-%m-%d'), (start_dt + timedelta(days=num_days - 1)).strftime('%Y-%m-%d'))
+                    for i in range(num_days):
+                        dt = (start_dt + timedelta(days=i)).strftime('%Y-%m-%d')
+                        # Sum realized passengers for ALL lines on this date
+                        c.execute(f"SELECT SUM(realized_passengers) as total FROM bus_lines WHERE date = {ph}", (dt,))
+                        row = c.fetchone()
+                        val = row['total'] if row and row['total'] else archived.get(dt, 0)
+                        data.append({"date": dt, "val": val})
+                    return data
 
-            before_data = get_system_daily_stats(before_start_dt, window)
-            after_data = get_system_daily_stats(base_date, window)
-            
-            conn.close()
+                before_data = get_system_daily_stats(before_start_dt, window)
+                after_data = get_system_daily_stats(base_date, window)
+                
+                conn.close()
+
+                avg_before = sum(d['val'] for d in before_data) / window if window > 0 else 0
+                avg_after = sum(d['val'] for d in after_data) / window if window > 0 else 0
 
-            avg_before = sum(d['val'] for d in before_data) / window if window > 0 else 0
-            avg_after = sum(d['val'] for d in after_data) / window if window > 0 else 0
+                return {
+                    "before": before_data,
+                    "after": after_data,
+                    "avg_before": round(avg_before, 1),
+                    "avg_after": round(avg_after, 1)
+                }
 
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                "before": before_data,
-                "after": after_data,
-                "avg_before": round(avg_before, 1),
-                "avg_after": round(avg_after, 1)
-            }).encode())
+            impact_data = query_cache.get_or_load('system-impact', {"base_date": base_date.strftime('%Y-%m-%d'), "window": window}, ('bus_lines',), load_system_impact)
+
+            self.send_json(200, impact_data)
         except Exception as e:
-            print(f"System Impact Error: {e}")
+            log.exception("System Impact Error: %s", e)
             self.send_error(500, str(e))
 
+route_metrics = RouteMetrics(route_labels())
+
+def _gauge_lines(prefix, stats):
+    """Flattens a stats() dict into Prometheus gauges (numbers only, nested dicts joined with '_')."""
+    out = []
+    for key, value in stats.items():
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', f"{prefix}_{key}")
+        if isinstance(value, dict):
+            out += _gauge_lines(name, value)
+        elif isinstance(value, (int, float)):
+            out.append(f"{name} {float(value):g}")
+    return out
+
+def render_metrics(server=None):
+    """Route metrics plus the /api/stats numbers for DB pool, caches, server and admission."""
+    out = route_metrics.render()
+    out += _gauge_lines('query_cache', query_cache.stats())
+    out += _gauge_lines('db_pool', db_pool.stats())
+    out += _gauge_lines('sql', sql_monitor.stats())
+    out += _gauge_lines('admission_' + heavy_admission.name, heavy_admission.stats())
+    if server is not None and hasattr(server, 'stats'):
+        out += _gauge_lines('http_server', {k: v for k, v in server.stats().items() if k != 'pid'})
+    if read_mirror:
+        out += _gauge_lines('read_mirror', read_mirror.stats())
+    return out
+
 def get_local_ip():
     try:
         # Create a temporary socket to find the local IP used for internet access
@@ -1803,21 +6248,342 @@ def get_local_ip():
     except Exception:
         return "localhost"
 
+class _LoopWriter:
+    """
+    File-like wfile for handlers running in an executor thread.
+    Each write is handed to the event loop and waits for drain(), so a slow
+    client throttles the handler instead of piling the response up in memory.
+    """
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def sendfile(self, f, offset=0, count=None):
+        """Zero-copy file body via the loop (os.sendfile on the transport when supported)."""
+        asyncio.run_coroutine_threadsafe(self._loop.sendfile(self._writer.transport, f, offset, count), self._loop).result()
+
+class StreamBridgeMixin:
+    """
+    Runs an unmodified request handler for one request the asyncio front end
+    already read: rfile is the spooled head+body, wfile writes back through the loop.
+    """
+    # The whole body is already spooled locally, so draining it never stalls on the client
+    MAX_DRAIN_BYTES = sys.maxsize
+
+    def setup(self):
+        self.rfile, self.wfile = self.request
+        self.close_connection = True
+
+    def handle(self):
+        self.handle_one_request()
+
+    def handle_expect_100(self):
+        # The front end answered "100 Continue" before reading the body
+        return True
+
+    def finish(self):
+        pass
+
+class AsyncioHTTPServer:
+    """
+    Alternative front end (SERVER_FRONTEND=asyncio) built on asyncio streams.
+    - Idle keep-alive connections and slow uploads cost a coroutine, not a thread
+    - Request heads and bodies are read without blocking; bodies spool to disk past BODY_SPOOL_BYTES
+    - The existing handler then runs in a bounded executor (a separate, smaller one for heavy routes)
+    """
+    MAX_HEAD_BYTES = 64 * 1024
+    BODY_SPOOL_BYTES = 1024 * 1024
+    READ_CHUNK = 64 * 1024
+
+    def __init__(self, server_address, handler_class, workers, queue_size, listen_socket=None):
+        self.server_address = server_address
+        self.listen_socket = listen_socket
+        self.handler_class = type('Bridged' + handler_class.__name__, (StreamBridgeMixin, handler_class), {})
+        self.workers = workers
+        self.max_in_flight = workers + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self.heavy_executor = ThreadPoolExecutor(max_workers=max(1, HEAVY_ROUTE_LIMIT), thread_name_prefix='http-heavy')
+        self.connections = 0
+        self.in_flight = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._loop = None
+        self._stopped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def server_close(self):
+        self.executor.shutdown(wait=False)
+        self.heavy_executor.shutdown(wait=False)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self.listen_socket is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=self.listen_socket, limit=self.MAX_HEAD_BYTES)
+        else:
+            host, port = self.server_address
+            server = await asyncio.start_server(self._handle_connection, host or None, port, reuse_address=True, limit=self.MAX_HEAD_BYTES)
+        async with server:
+            await self._stopped.wait()
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        client_address = writer.get_extra_info('peername') or ('', 0)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+                if not await self._handle_request(head, reader, writer, client_address):
+                    return
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    def _parse_head(head):
+        lines = head.decode('iso-8859-1').split("\r\n")
+        parts = lines[0].split()
+        path = parts[1] if len(parts) > 1 else '/'
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return path, headers
+
+    async def _handle_request(self, head, reader, writer, client_address):
+        """Returns False when the connection must be closed afterwards."""
+        path, headers = self._parse_head(head)
+        keep_open = 'transfer-encoding' not in headers
+        try:
+            body_length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            body_length, keep_open = 0, False
+
+        limit = body_limit_for(path)
+        if limit is not None and body_length > limit:
+            body = json.dumps({"error": f"Arquivo muito grande (limite {limit // (1024 * 1024)} MB)."}).encode()
+            writer.write(b"HTTP/1.1 413 Payload Too Large\r\nContent-Type: application/json\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+            return False
+
+        if body_length > 0 and headers.get('expect', '').lower() == '100-continue':
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        spool = tempfile.SpooledTemporaryFile(max_size=self.BODY_SPOOL_BYTES)
+        try:
+            spool.write(head)
+            remaining = body_length
+            while remaining > 0:
+                try:
+                    chunk = await asyncio.wait_for(reader.read(min(remaining, self.READ_CHUNK)), HTTP_IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, ConnectionError):
+                    return False
+                if not chunk:
+                    return False
+                spool.write(chunk)
+                remaining -= len(chunk)
+            spool.seek(0)
+
+            # Only requests waiting for or holding an executor thread count; slow uploads above don't
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                writer.write(WorkerPoolTCPServer.busy_response())
+                await writer.drain()
+                return False
+            self.accepted += 1
+            self.in_flight += 1
+            try:
+                executor = self.heavy_executor if admission_class_for(path) else self.executor
+                handler = await self._loop.run_in_executor(executor, self._run_handler, spool, writer, client_address)
+            finally:
+                self.in_flight -= 1
+            await writer.drain()
+            return keep_open and handler is not None and not handler.close_connection
+        finally:
+            spool.close()
 
+    def _run_handler(self, spool, writer, client_address):
+        try:
+            return self.handler_class((spool, _LoopWriter(self._loop, writer)), client_address, self)
+        except ConnectionError:
+            return None
+        except Exception:
+            log.exception("Unhandled error in %s", client_address)
+            return None
+
+    def stats(self):
+        return {
+            "frontend": "asyncio",
+            "pid": os.getpid(),
+            "workers": self.workers,
+            "heavy_workers": self.heavy_executor._max_workers,
+            "connections": self.connections,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+def make_http_server(listen_socket=None):
+    server_class = AsyncioHTTPServer if SERVER_FRONTEND == 'asyncio' else WorkerPoolTCPServer
+    return server_class(("", PORT), RequestHandler, SERVER_WORKERS, SERVER_QUEUE_SIZE, listen_socket=listen_socket)
+
+def resolve_process_count(value):
+    if str(value).strip().lower() == 'auto':
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(value))
+    except ValueError:
+        return 1
+
+def serve_worker_process(listen_socket, index):
+    """Body of one pre-forked worker: its own threads, DB pool and mirror sync thread."""
+    setup_logging()
+    if read_mirror:
+        # One worker makes the startup copy; the others see it through the shared sync state
+        read_mirror.start(initial_sync=(index == 0))
+    if index == 0:
+        # Attachment text extraction runs in one worker; uploads in the others are found by its periodic scan
+        search_index.start()
+    with make_http_server(listen_socket) as httpd:
+        try:
+            httpd.serve_forever()
+        finally:
+            db_pool.close_all()
+
+def run_prefork(processes):
+    """
+    Supervisor for multi-process mode (POSIX only).
+    - Binds the listening socket once, then forks N workers that all accept on it
+    - Restarts any worker that dies; SIGTERM/Ctrl+C stops them all
+    """
+    listen_socket = socket.create_server(("", PORT), backlog=max(SERVER_QUEUE_SIZE, 128))
+
+    # Forked children must not inherit live DB sockets, and cross-process state must be shared BEFORE forking
+    db_pool.close_all()
+    table_versions.share()
+    route_metrics.share()
+    if read_mirror:
+        read_mirror.share()
+
+    children = {} # pid -> (worker index, start time)
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve_worker_process(listen_socket, index)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                log.exception("Worker %s crashed", index)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (index, time.time())
+        log.info("Worker %s started (pid %s)", index, pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(processes):
+        spawn(i)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = children.pop(pid, (None, 0))
+        if index is None or stopping:
+            continue
+        log.warning("Worker %s (pid %s) exited with status %s; restarting...", index, pid, status)
+        if time.time() - started < 1:
+            time.sleep(1) # Don't spin if it crashes right at startup
+        spawn(index)
+
+    listen_socket.close()
 
 if __name__ == "__main__":
-    print("--- SERVER VERSION: NETWORK MODE ACTIVATED ---")
+    setup_logging()
+    log.info("--- SERVER VERSION: NETWORK MODE ACTIVATED ---")
     init_db()
+    export_cache.prune() # Files of the previous run can never match again
+    if line_stats.is_empty():
+        line_stats.refresh() # First run with line_stats: build it from the existing data
+
+    processes = resolve_process_count(SERVER_PROCESSES)
+    if processes > 1 and not hasattr(os, 'fork'):
+        log.warning("SERVER_PROCESSES > 1 requires os.fork (Linux/macOS); running a single process.")
+        processes = 1
 
     if not os.path.exists('static'):
         os.makedirs('static')
 
     local_ip = get_local_ip()
-    with ThreadingTCPServer(("", PORT), RequestHandler) as httpd:
-        print("\n" + "="*50)
-        print(f" Servidor rodando na rede local!")
-        print(f" Peça aos seus colegas para acessarem:")
-        print(f" http://{local_ip}:{PORT}")
-        print("="*50 + "\n")
-
-        httpd.serve_forever()
+    banner = ["", "="*50, " Servidor rodando na rede local!", " Peça aos seus colegas para acessarem:", f" http://{local_ip}:{PORT}"]
+    if processes > 1:
+        banner.append(f" Modo multiprocesso: {processes} processos x {SERVER_WORKERS} threads")
+    if SERVER_FRONTEND == 'asyncio':
+        banner.append(f" Front end asyncio: {SERVER_WORKERS} threads para banco/CPU, {HEAVY_ROUTE_LIMIT} para rotas pesadas")
+    banner.append("="*50)
+    log.info("\n".join(banner))
+
+    if read_mirror:
+        log.info("Read mirror enabled: %s (max staleness %ss)", READ_MIRROR_FILE, READ_MIRROR_MAX_STALENESS)
+
+    if processes > 1:
+        run_prefork(processes)
+    else:
+        if read_mirror:
+            read_mirror.start()
+        search_index.start()
+        with make_http_server() as httpd:
+            try:
+                httpd.serve_forever()
+            finally:
+                db_pool.close_all()
@@ -4,9 +4,11 @@ const state = {
     availableLineCodes: [],
     impactSelectedLines: new Set(),
     groups: [],
+    groupByLine: new Map(), // line_code -> group, rebuilt by setGroups()
     selectedGroupId: null,
     lastActions: [],
-    actionsCache: [], // New: Cache for Actions Tab
+    actionsCache: [], // Rows loaded so far in the Actions Tab
+    actionsCursor: null, // Server cursor for the next page (null = all loaded)
     actionsSort: { col: 'implementation_date', dir: 'desc' }, // New: Sort state
     lastEvents: [],
     lastDetailData: [],
@@ -83,7 +85,7 @@ function init() {
         document.getElementById('impact-end-date').valueAsDate = today;
     }
 
-    if (savedUser) {
+    if (savedUser && JSON.parse(savedUser).token) {
         state.user = JSON.parse(savedUser);
         showDashboard();
     } else {
@@ -272,7 +274,7 @@ function setupOperationalSearch() {
 
         if (matches.length > 0) {
             resultsContainer.innerHTML = matches.map(l => {
-                const group = (state.groups || []).find(g => g.lines && g.lines.includes(l.line_code));
+                const group = state.groupByLine.get(l.line_code);
                 const groupBadge = group
                     ? `<span style="font-size:0.65rem;background:rgba(59,130,246,0.15);color:var(--primary-color);border:1px solid rgba(59,130,246,0.3);border-radius:4px;padding:1px 6px;margin-left:6px;">${group.name}</span>`
                     : `<span style="font-size:0.65rem;color:var(--text-muted);margin-left:6px;">Sem grupo</span>`;
@@ -376,6 +378,7 @@ function enterGroupUI(group) {
     if (tableContainer) tableContainer.classList.remove('hidden');
     if (backBtn) backBtn.classList.remove('hidden');
     if (exportBtn) exportBtn.classList.remove('hidden');
+    document.getElementById('export-group-layout')?.classList.remove('hidden');
 
     renderAggregatedTable();
 }
@@ -398,6 +401,7 @@ function exitGroupUI() {
     if (tableContainer) tableContainer.classList.add('hidden');
     if (backBtn) backBtn.classList.add('hidden');
     if (exportBtn) exportBtn.classList.add('hidden');
+    document.getElementById('export-group-layout')?.classList.add('hidden');
 }
 
 // Data Actions
@@ -443,7 +447,11 @@ async function exportGroupToExcel(e) {
     exportBtn.style.opacity = '0.7';
 
     try {
-        const url = `/api/export-group?group_id=${state.selectedGroupId}&start=${start}&end=${end}`;
+        // "csv" is the long (one row per date/line) table; the others are XLSX layouts
+        const choice = document.getElementById('export-group-layout')?.value || 'sheets';
+        const format = choice === 'csv' ? 'csv' : 'xlsx';
+        const layout = choice === 'csv' ? 'sheets' : choice;
+        const url = `/api/export-group?group_id=${state.selectedGroupId}&start=${start}&end=${end}&format=${format}&layout=${layout}`;
         console.log("Exporting group Excel:", url);
         const response = await fetch(url);
 
@@ -456,7 +464,7 @@ async function exportGroupToExcel(e) {
         const downloadUrl = window.URL.createObjectURL(blob);
         const a = document.createElement('a');
         a.href = downloadUrl;
-        a.download = `Export_${groupName}_${start}_${end}.xlsx`;
+        a.download = `Export_${groupName}_${start}_${end}.${format}`;
         document.body.appendChild(a);
         a.click();
         a.remove();
@@ -903,10 +911,17 @@ function showCompanyDetail(companyName) {
     companyDetail.classList.remove('hidden');
 }
 
+// A line belongs to at most one group, so one map answers every "which group?" lookup
+function setGroups(groups) {
+    state.groups = groups;
+    state.groupByLine = new Map();
+    groups.forEach(g => (g.lines || []).forEach(code => state.groupByLine.set(code, g)));
+}
+
 async function fetchGroups() {
     try {
         const res = await fetch('/api/groups');
-        state.groups = await res.json();
+        setGroups(await res.json());
         renderGroups();
         // Only force navigation if NOT already in a detail view (avoid double openLineDetail)
         const currentHash = window.location.hash || '';
@@ -924,17 +939,20 @@ function renderGroups() {
     if (!container) return;
     container.innerHTML = '';
 
+    // Totals per group in one pass over the lines
+    const totals = new Map();
+    state.lines.forEach(line => {
+        const group = state.groupByLine.get(line.line_code);
+        if (!group) return;
+        const t = totals.get(group.id) || { predicted: 0, realized: 0 };
+        t.predicted += (line.predicted_passengers || 0);
+        t.realized += (line.realized_passengers || 0);
+        totals.set(group.id, t);
+    });
+
     state.groups.forEach(group => {
-        // Calculate totals for this group
-        let totalPredicted = 0;
-        let totalRealized = 0;
-
-        state.lines.forEach(line => {
-            if (group.lines.includes(line.line_code)) {
-                totalPredicted += (line.predicted_passengers || 0);
-                totalRealized += (line.realized_passengers || 0);
-            }
-        });
+        const totalPredicted = totals.has(group.id) ? totals.get(group.id).predicted : 0;
+        const totalRealized = totals.has(group.id) ? totals.get(group.id).realized : 0;
 
         const diff = totalRealized - totalPredicted;
         const diffClass = diff < 0 ? 'text-negative' : (diff > 0 ? 'text-positive' : '');
@@ -999,10 +1017,8 @@ function renderDashboardSummary() {
 
     // 1. Map line to group names
     const lineToGroup = {};
-    state.groups.forEach(g => {
-        g.lines.forEach(lineCode => {
-            lineToGroup[lineCode] = g.name;
-        });
+    state.groupByLine.forEach((g, lineCode) => {
+        lineToGroup[lineCode] = g.name;
     });
 
     // 2. Aggregate all data
@@ -1012,7 +1028,7 @@ function renderDashboardSummary() {
     if (state.macroFilterGroupId) {
         const selectedGroup = state.groups.find(g => g.id === state.macroFilterGroupId);
         if (selectedGroup) {
-            dataToAggregate = state.lines.filter(l => selectedGroup.lines.includes(l.line_code));
+            dataToAggregate = state.lines.filter(l => state.groupByLine.get(l.line_code) === selectedGroup);
         }
     }
 
@@ -1092,7 +1108,7 @@ function renderAggregatedTable() {
     if (state.selectedGroupId) {
         const group = state.groups.find(g => g.id === state.selectedGroupId);
         if (group) {
-            filteredData = state.lines.filter(l => group.lines.includes(l.line_code));
+            filteredData = state.lines.filter(l => state.groupByLine.get(l.line_code) === group);
         }
     }
 
@@ -1633,7 +1649,7 @@ function cancelEventEdit() {
 async function deleteEvent(id) {
     if (!confirm('Deseja realmente excluir este registro?')) return;
     try {
-        const res = await fetch(`/api/line-events?id=${id}&userId=${state.user ? state.user.id : 0}`, { method: 'DELETE' });
+        const res = await authFetch(`/api/line-events?id=${id}`, { method: 'DELETE' });
         if (res.ok) await fetchLineEvents(window.currentActionsLine);
         else alert('Erro ao excluir.');
     } catch (err) { alert('Erro de conexão.'); }
@@ -1775,8 +1791,8 @@ function renderSelectionGrid() {
 
     filtered.forEach(code => {
         // Find if this line belongs to ANY group
-        const ownerGroup = state.groups.find(g => g.lines.includes(code));
-        const isSelectedByActive = activeGroup && activeGroup.lines.includes(code);
+        const ownerGroup = state.groupByLine.get(code);
+        const isSelectedByActive = activeGroup && ownerGroup === activeGroup;
         const isTakenByOther = ownerGroup && ownerGroup.id !== editingGroupId;
 
         const item = document.createElement('div');
@@ -1891,10 +1907,10 @@ async function handleClearData() {
     if (!confirm2) return;
 
     try {
-        const res = await fetch('/api/clear-data', {
+        const res = await authFetch('/api/clear-data', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ userId: state.user.id })
+            body: JSON.stringify({})
         });
 
         if (res.ok) {
@@ -2597,10 +2613,15 @@ async function fetchAndRenderLineDetail() {
     try {
         const url = `/api/lines?line_code=${lineCode}&start=${start}&end=${end}`;
         console.log('[DETAIL] Fetching:', url);
-        const res = await fetch(url);
+        // Summary figures come precomputed per weekday; the rows only feed the chart and table
+        const [res, statsRes] = await Promise.all([
+            fetch(url),
+            fetch(`/api/line-stats?line_code=${lineCode}&start=${start}&end=${end}`)
+        ]);
         const data = await res.json();
         console.log('[DETAIL] API returned', data.length, 'rows for', lineCode);
         state.lastDetailData = data;
+        state.lastDetailStats = statsRes.ok ? await statsRes.json() : null;
 
         processAndRenderDetail();
     } catch (err) {
@@ -2629,31 +2650,33 @@ function processAndRenderDetail() {
     // Data is already sorted DESC by date from API, let's sort it ASC for the chart
     const chartData = [...filtered].sort((a, b) => a.date.localeCompare(b.date));
 
-    renderDetailSummary(chartData);
+    renderDetailSummary((state.lastDetailStats || {})[filter]);
     renderDetailChart(chartData);
     renderDetailTable(filtered); // Table stays DESC for recent first
 }
 
-function renderDetailSummary(data) {
-    console.log('[DETAIL] renderDetailSummary with', data.length, 'rows');
-    const total = data.reduce((acc, curr) => acc + (curr.realized_passengers || 0), 0);
-    const avg = data.length > 0 ? (total / data.length) : 0;
+function renderDetailSummary(stats) {
+    // stats: one entry of /api/line-stats ('all' or a weekday), undefined when there is no data
+    const figures = stats || { realized_total: 0, realized_avg: 0, realized_min: null, realized_max: null, ratio: null, trend: null };
+    console.log('[DETAIL] renderDetailSummary with', figures.days || 0, 'days');
 
     const totalEl = document.getElementById('detail-total-realized');
     const avgEl = document.getElementById('detail-avg-daily');
-    if (totalEl) totalEl.innerText = Math.round(total).toLocaleString('pt-BR');
-    if (avgEl) avgEl.innerText = avg.toFixed(1);
+    const rangeEl = document.getElementById('detail-min-max');
+    const ratioEl = document.getElementById('detail-ratio');
+    if (totalEl) totalEl.innerText = Math.round(figures.realized_total).toLocaleString('pt-BR');
+    if (avgEl) avgEl.innerText = figures.realized_avg.toFixed(1);
+    if (rangeEl) {
+        rangeEl.innerText = figures.realized_min === null ? '-'
+            : `${Math.round(figures.realized_min).toLocaleString('pt-BR')} / ${Math.round(figures.realized_max).toLocaleString('pt-BR')}`;
+    }
+    if (ratioEl) ratioEl.innerText = figures.ratio === null ? '-' : `${(figures.ratio * 100).toFixed(1)}%`;
 
-    if (data.length >= 6) {
-        const recent = data.slice(-3).reduce((a, b) => a + (b.realized_passengers || 0), 0);
-        const older = data.slice(-6, -3).reduce((a, b) => a + (b.realized_passengers || 0), 0);
-        const diff = recent - older;
-        const trendEl = document.getElementById('detail-trend');
-        if (trendEl) {
-            if (diff > total * 0.05) { trendEl.innerText = 'CRESCENTE'; trendEl.className = 'value diff-positive'; }
-            else if (diff < -total * 0.05) { trendEl.innerText = 'QUEDA'; trendEl.className = 'value diff-negative'; }
-            else { trendEl.innerText = 'ESTÁVEL'; trendEl.className = 'value'; }
-        }
+    const trendEl = document.getElementById('detail-trend');
+    if (trendEl) {
+        if (figures.trend === 'up') { trendEl.innerText = 'CRESCENTE'; trendEl.className = 'value diff-positive'; }
+        else if (figures.trend === 'down') { trendEl.innerText = 'QUEDA'; trendEl.className = 'value diff-negative'; }
+        else { trendEl.innerText = 'ESTÁVEL'; trendEl.className = 'value'; }
     }
 }
 
@@ -2821,7 +2844,7 @@ async function handleLogin(e) {
         });
         const data = await res.json();
         if (data.success) {
-            state.user = data.user;
+            state.user = { ...data.user, token: data.token };
             localStorage.setItem('bus_user', JSON.stringify(state.user));
             showDashboard();
         } else {
@@ -2831,10 +2854,27 @@ async function handleLogin(e) {
 }
 
 function handleLogout() {
+    if (state.user && state.user.token) {
+        // Best effort: the token is dropped locally either way
+        fetch('/api/logout', { method: 'POST', headers: { 'Authorization': `Bearer ${state.user.token}` }, keepalive: true }).catch(() => {});
+    }
     localStorage.removeItem('bus_user');
     window.location.reload();
 }
 
+// fetch() with the session token; an expired or revoked session sends the user back to login
+async function authFetch(url, options = {}) {
+    const headers = { ...(options.headers || {}) };
+    if (state.user && state.user.token) headers['Authorization'] = `Bearer ${state.user.token}`;
+    const res = await fetch(url, { ...options, headers });
+    if (res.status === 401) {
+        alert('Sua sessão expirou. Faça login novamente.');
+        localStorage.removeItem('bus_user');
+        window.location.reload();
+    }
+    return res;
+}
+
 // End of standard logic
 // --- Impact Action Selector Logic ---
 function populateImpactActionsSelect(actions) {
@@ -3078,72 +3118,48 @@ window.sortActions = function(col) {
             state.actionsSort.dir = 'desc';
         }
     }
-    renderActionsTab(true); // true means use cache
+    renderActionsTab(); // Sorting happens on the server
 };
 
-window.renderActionsTab = async function (useCache = false) {
+const ACTIONS_PAGE_SIZE = 100;
+
+window.renderActionsTab = async function (loadMore = false) {
     const tableBody = document.querySelector('#actions-history-table tbody');
     if (!tableBody) return;
     
-    if (!useCache) {
+    if (!loadMore) {
         tableBody.innerHTML = '<tr><td colspan="10" style="text-align:center;">Carregando...</td></tr>';
     }
 
     const start = document.getElementById('actions-filter-start')?.value;
     const end = document.getElementById('actions-filter-end')?.value;
 
-    try {
-        let events = [];
-        let groups = [];
+    const searchText = document.getElementById('actions-search')?.value.trim();
 
-        if (useCache && state.actionsCache.length > 0) {
-            events = state.actionsCache;
-            // We assume groups are already in state.groups
-            groups = state.groups;
-        } else {
-            let url = '/api/line-events';
-            if (start && end) {
-                url += `?start=${start}&end=${end}`;
-            }
-            const res = await fetch(url);
-            events = await res.json();
-            
-            // Map group name to each event and add originalIndex for sorting reset
-            const groupRes = await fetch('/api/groups');
-            groups = await groupRes.json();
-            
-            events = events.map((event, index) => {
-                const group = groups.find(g => g.lines && g.lines.includes(event.line_code)) || { name: '-' };
-                return { ...event, group_name: group.name, originalIndex: index };
-            });
-            
-            state.actionsCache = events;
+    try {
+        // Filtering, sorting and paging are done by the server; each event already carries group_name
+        const query = new URLSearchParams({ limit: ACTIONS_PAGE_SIZE });
+        if (searchText) query.set('q', searchText);
+        if (start && end) {
+            query.set('start', start);
+            query.set('end', end);
         }
-
-        // Apply sorting
-        let eventsToRender = [...events];
         const { col, dir } = state.actionsSort;
-
         if (col && dir) {
-            const multiplier = dir === 'asc' ? 1 : -1;
-            eventsToRender.sort((a, b) => {
-                let valA = a[col] || '';
-                let valB = b[col] || '';
-
-                if (col === 'implementation_date' || col === 'created_at') {
-                    return (new Date(valA) - new Date(valB)) * multiplier;
-                }
-                
-                if (typeof valA === 'string') {
-                    return valA.localeCompare(valB, undefined, { sensitivity: 'base', numeric: true }) * multiplier;
-                }
-                
-                return (valA < valB ? -1 : valA > valB ? 1 : 0) * multiplier;
-            });
-        } else {
-            // Restore original order (NONE state)
-            eventsToRender.sort((a, b) => a.originalIndex - b.originalIndex);
+            query.set('sort', col);
+            query.set('dir', dir);
         }
+        if (loadMore && state.actionsCursor) query.set('cursor', state.actionsCursor);
+
+        // A search term switches to the ranked full-text results (one page, best match first)
+        const res = await fetch(searchText ? `/api/search?${query}` : `/api/line-events?${query}`);
+        if (!res.ok) throw new Error(await res.text());
+        const page = searchText ? { items: await res.json(), next_cursor: null } : await res.json();
+        const loaded = page.items.map(event => ({ ...event, group_name: event.group_name || '-' }));
+
+        state.actionsCache = loadMore ? state.actionsCache.concat(loaded) : loaded;
+        state.actionsCursor = page.next_cursor;
+        const events = state.actionsCache;
 
         // Update Sort Icons
         document.querySelectorAll('#actions-history-table th i').forEach(icon => {
@@ -3204,7 +3220,13 @@ window.renderActionsTab = async function (useCache = false) {
                     </td>
                 </tr>
             `;
-        }).join('');
+        }).join('') + (state.actionsCursor ? `
+                <tr>
+                    <td colspan="10" style="text-align:center;">
+                        <button class="btn text-only" onclick="renderActionsTab(true)" style="color: var(--primary-color);">CARREGAR MAIS</button>
+                    </td>
+                </tr>
+            ` : '');
     } catch (err) {
         console.error('Error rendering actions tab:', err);
         tableBody.innerHTML = '<tr><td colspan="10" style="text-align:center; color: #ef4444;">Erro ao carregar dados.</td></tr>';
@@ -3388,12 +3410,15 @@ async function confirmClearData() {
     }
 
     try {
-        const response = await fetch('/api/clear-data', {
+        const response = await authFetch('/api/clear-data', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
-                userId: state.user.id,
-                targets: targets
+                targets: targets,
+                start: document.getElementById('clear-start').value || null,
+                end: document.getElementById('clear-end').value || null,
+                lines: document.getElementById('clear-lines').value,
+                companies: document.getElementById('clear-companies').value
             })
         });
 
@@ -3423,9 +3448,8 @@ async function editActionSimplified(id) {
     try {
         await fetchOperationalOptions(); // Garante opções dinâmicas carregadas
 
-        const res = await fetch('/api/line-events');
-        const events = await res.json();
-        const event = events.find(e => e.id === id);
+        const res = await fetch(`/api/line-events?id=${id}`);
+        const event = res.ok ? await res.json() : null;
 
         if (!event) {
             showNotification('Registro não encontrado.', 'error');
@@ -3501,13 +3525,9 @@ async function editActionSimplified(id) {
         // Trigger line dropdown update manually
         window.updateRegLinesDropdown();
 
-        // Find group that contains this line
-        const groupRes = await fetch('/api/groups');
-        const groups = await groupRes.json();
-        const group = groups.find(g => g.lines && g.lines.includes(event.line_code));
-
-        if (group) {
-            document.getElementById('reg-group').value = group.id;
+        // Group that contains this line (sent with the event)
+        if (event.group_id) {
+            document.getElementById('reg-group').value = event.group_id;
             updateRegLinesDropdown();
             document.getElementById('reg-line').value = event.line_code;
         }
@@ -3526,7 +3546,7 @@ async function deleteActionSimplified(id) {
     if (!confirm('Deseja realmente excluir este registro de ação permanentemente?')) return;
 
     try {
-        const res = await fetch(`/api/line-events?id=${id}&userId=${state.user.id}`, {
+        const res = await authFetch(`/api/line-events?id=${id}`, {
             method: 'DELETE'
         });
 
@@ -3627,10 +3647,10 @@ async function handleAddOption() {
     const type = activeTab.dataset.type;
 
     try {
-        const res = await fetch('/api/operational-options', {
+        const res = await authFetch('/api/operational-options', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ type, label, userId: state.user.id })
+            body: JSON.stringify({ type, label })
         });
 
         if (res.ok) {
@@ -3650,10 +3670,10 @@ async function handleEditOption(id, oldLabel, type) {
     if (!newLabel || newLabel.trim() === oldLabel) return;
 
     try {
-        const res = await fetch('/api/operational-options', {
+        const res = await authFetch('/api/operational-options', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id, label: newLabel.trim(), userId: state.user.id })
+            body: JSON.stringify({ id, label: newLabel.trim() })
         });
 
         if (res.ok) {
@@ -3670,10 +3690,10 @@ async function handleDeleteOption(id, type) {
     if (!confirm('Deseja realmente excluir esta opção?')) return;
 
     try {
-        const res = await fetch('/api/operational-options', {
+        const res = await authFetch('/api/operational-options', {
             method: 'DELETE',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id, userId: state.user.id })
+            body: JSON.stringify({ id })
         });
 
         if (res.ok) {
@@ -0,0 +1,116 @@
+"""
+Shared fixtures. server.py keeps its paths relative to the working directory and reads its
+configuration at import time, so the module is imported from a scratch directory with SQLite.
+"""
+import atexit
+import http.client
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='bus-tests-')
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+
+os.environ['DATABASE_URL'] = ''
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+import server  # noqa: E402
+
+server.init_db()
+
+BUS_LINE_TABLES = ('bus_lines', 'line_stats')
+OTHER_TABLES = ('line_events', 'line_groups', 'line_group_members')
+
+
+@pytest.fixture
+def db():
+    """Empty data tables and archive before each test; yields the server module."""
+    conn, c = server.get_db_connection()
+    try:
+        for table in BUS_LINE_TABLES + OTHER_TABLES:
+            c.execute(f"DELETE FROM {table}")
+        conn.commit()
+    finally:
+        conn.close()
+    shutil.rmtree(server.ARCHIVE_DIR, ignore_errors=True)
+    server.mark_tables_changed(*(BUS_LINE_TABLES + OTHER_TABLES))
+    yield server
+
+
+def insert_bus_lines(rows):
+    """rows: (date, line_code, company, predicted, realized) tuples."""
+    conn, c = server.get_db_connection()
+    try:
+        c.executemany("""
+            INSERT INTO bus_lines (date, line_code, line_name, company, predicted_passengers, realized_passengers)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(d, line, f"Linha {line}", company, p, r) for d, line, company, p, r in rows])
+        conn.commit()
+    finally:
+        conn.close()
+    server.mark_tables_changed('bus_lines', dates={r[0] for r in rows})
+    server.line_stats.refresh({r[0] for r in rows})
+
+
+def bus_lines():
+    """Every live row as (date, line_code, company, predicted, realized), sorted."""
+    conn, c = server.get_db_connection()
+    try:
+        c.execute("SELECT date, line_code, company, predicted_passengers, realized_passengers FROM bus_lines")
+        return sorted(tuple(r) for r in c.fetchall())
+    finally:
+        conn.close()
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.token = None
+
+    def request(self, method, path, body=None, headers=None):
+        """(status, headers, body bytes)."""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        headers = dict(headers or {})
+        if self.token:
+            headers.setdefault('Authorization', f"Bearer {self.token}")
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+            headers.setdefault('Content-Type', 'application/json')
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def json(self, method, path, body=None, headers=None):
+        status, _, data = self.request(method, path, body, headers)
+        return status, json.loads(data or b'null')
+
+    def login_master(self):
+        status, data = self.json('POST', '/api/login', {'username': 'master', 'password': 'admin123'})
+        assert status == 200
+        self.token = data['token']
+        return self
+
+
+@pytest.fixture(scope='session')
+def http_server():
+    httpd = server.WorkerPoolTCPServer(('127.0.0.1', 0), server.RequestHandler, 4, 16)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client(http_server, db):
+    return Client(http_server.server_address[1])
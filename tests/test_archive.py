@@ -0,0 +1,88 @@
+"""Reads that merge live bus_lines with archived Parquet months (user-047)."""
+import json
+
+import pytest
+
+from conftest import insert_bus_lines, server
+
+pytest.importorskip('pyarrow')
+
+COLUMNS = server.LineArchive.COLUMNS
+
+
+@pytest.fixture
+def months(client):
+    rows = []
+    for month in (1, 2, 3):
+        for day in (1, 15, 28):
+            for line, company in (('8000', 'EMP A'), ('8001', 'EMP A'), ('8002', 'EMP B')):
+                rows.append((f"2024-{month:02d}-{day:02d}", line, company, month * 100 + day, month * 10 + day))
+    insert_bus_lines(rows)
+    return rows
+
+
+def lines(client, query):
+    status, rows = client.json('GET', f"/api/lines?{query}")
+    assert status == 200
+    return [{k: r[k] for k in COLUMNS} for r in rows]
+
+
+def export(client, query=''):
+    status, headers, data = client.request('GET', f"/api/export-lines?format=ndjson&gzip=0&{query}")
+    assert status == 200
+    return [json.loads(line) for line in data.decode().splitlines() if line]
+
+
+QUERIES = ['', 'line_code=8001', 'start=2024-01-10&end=2024-02-20', 'line_code=8000,8002&start=2024-02-01&end=2024-03-31']
+
+
+def test_archived_months_read_like_live_ones(client, months):
+    before_lines = {q: lines(client, q) for q in QUERIES}
+    before_export = {q: export(client, q) for q in QUERIES + ['company=emp%20b']}
+    assert all(before_lines.values()) and all(before_export.values())
+
+    assert server.line_archive.archive_month(2024, 1) == 9
+    assert server.line_archive.archive_month(2024, 2) == 9
+    assert server.line_archive.months() == {(2024, 1), (2024, 2)}
+    conn, c = server.get_db_connection()
+    try:
+        c.execute("SELECT COUNT(*) FROM bus_lines")
+        assert c.fetchone()[0] == 9 # Only March is still live
+    finally:
+        conn.close()
+
+    for q in QUERIES:
+        assert lines(client, q) == before_lines[q], q
+    for q in before_export:
+        assert export(client, q) == before_export[q], q
+
+
+def test_export_is_ordered_by_date_then_id_across_tiers(client, months):
+    server.line_archive.archive_month(2024, 2)
+    rows = export(client)
+    keys = [(r['date'], r['id']) for r in rows]
+    assert keys == sorted(keys) and len(rows) == len(months)
+
+
+@pytest.mark.parametrize('with_date', [True, False])
+def test_export_resumes_inside_an_archived_month(client, months, with_date):
+    full = export(client)
+    server.line_archive.archive_month(2024, 1)
+    server.line_archive.archive_month(2024, 2)
+    last = full[4] # Mid-January: archived
+    query = f"after={last['id']}" + (f"&after_date={last['date']}" if with_date else '')
+    assert export(client, query) == full[5:]
+
+
+def test_restored_month_is_live_again(client, months):
+    before = lines(client, '')
+    server.line_archive.archive_month(2024, 1)
+    assert server.line_archive.restore_month(2024, 1) == 9
+    assert server.line_archive.months() == set()
+    assert lines(client, '') == before
+
+
+def test_archiving_twice_is_refused(db, months):
+    server.line_archive.archive_month(2024, 1)
+    with pytest.raises(ValueError):
+        server.line_archive.archive_month(2024, 1)
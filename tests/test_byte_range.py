@@ -0,0 +1,37 @@
+"""parse_byte_range: Range header handling for attachment downloads (user-039)."""
+import pytest
+
+from conftest import server
+
+parse = server.parse_byte_range
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=990-2000', (990, 999)), # End past the file is clamped
+    ('bytes=-100', (900, 999)), # Suffix: last 100 bytes
+    ('bytes=-5000', (0, 999)), # Suffix longer than the file: whole file
+    ('BYTES = 5-5', (5, 5)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', [
+    None, '', 'items=0-10', 'bytes=0-10,20-30', 'bytes=abc', 'bytes=-', 'bytes=5', 'bytes=1-x',
+    'bytes=50-10', # Last before first: ignored, whole file
+])
+def test_ignored_headers_send_the_whole_file(header):
+    assert parse(header, 1000) is None
+
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=1000-', 1000),
+    ('bytes=1000-1200', 1000),
+    ('bytes=-0', 1000),
+    ('bytes=-10', 0),
+])
+def test_unsatisfiable_ranges_raise(header, size):
+    with pytest.raises(ValueError):
+        parse(header, size)
@@ -0,0 +1,148 @@
+"""Scoped, batched clears of bus_lines through clear_bus_lines and /api/clear-data (user-049)."""
+import pytest
+
+from conftest import bus_lines, insert_bus_lines, server
+
+ROWS = [
+    ('2024-01-05', '8000', 'EMP A', 10, 20),
+    ('2024-01-05', '8001', 'EMP B', 11, 0),
+    ('2024-01-20', '8000', 'EMP A', 12, 22),
+    ('2024-02-05', '8000', 'EMP A', 13, 23),
+    ('2024-02-05', '8001', 'EMP B', 0, 24),
+    ('2024-02-10', '8002', 'EMP B', 15, 25),
+]
+
+
+@pytest.fixture
+def rows(db):
+    insert_bus_lines(ROWS)
+    return ROWS
+
+
+def test_predicted_only_in_a_date_range(rows):
+    report = server.clear_bus_lines(True, False, start='2024-01-01', end='2024-01-31', batch=2)
+    # 8001 on 01-05 had no realized value left, so the row goes instead of being zeroed
+    assert report["deleted"] == 1 and report["updated"] == 2
+    assert bus_lines() == [
+        ('2024-01-05', '8000', 'EMP A', 0, 20),
+        ('2024-01-20', '8000', 'EMP A', 0, 22),
+        ('2024-02-05', '8000', 'EMP A', 13, 23),
+        ('2024-02-05', '8001', 'EMP B', 0, 24),
+        ('2024-02-10', '8002', 'EMP B', 15, 25),
+    ]
+
+
+def test_realized_only_of_some_lines(rows):
+    report = server.clear_bus_lines(False, True, lines=['8000'], batch=1)
+    assert report["deleted"] == 0 and report["updated"] == 3
+    assert [r[4] for r in bus_lines() if r[1] == '8000'] == [0, 0, 0]
+    assert [r[4] for r in bus_lines() if r[1] != '8000'] == [0, 24, 25]
+
+
+def test_both_values_of_one_company(rows):
+    report = server.clear_bus_lines(True, True, companies=['EMP B'], batch=2)
+    assert report["deleted"] == 3 and report["updated"] == 0
+    assert {r[2] for r in bus_lines()} == {'EMP A'}
+
+
+def test_clear_refreshes_cached_reads_and_stats(client, rows):
+    path = '/api/lines?line_code=8000&start=2024-01-01&end=2024-12-31'
+    status, before = client.json('GET', path)
+    assert sorted(r['predicted_passengers'] for r in before) == [10, 12, 13]
+
+    server.clear_bus_lines(True, False, start='2024-01-01', end='2024-01-31')
+    status, after = client.json('GET', path)
+    assert sorted(r['predicted_passengers'] for r in after) == [0, 0, 13]
+
+
+def test_endpoint_applies_the_scope(client, rows):
+    client.login_master()
+    status, data = client.json('POST', '/api/clear-data', {
+        'targets': ['realized'], 'lines': '8000', 'start': '2024-02-01', 'end': '2024-02-28'})
+    assert status == 200 and data['bus_lines']['updated'] == 1
+    assert ('2024-02-05', '8000', 'EMP A', 13, 0) in bus_lines()
+    assert ('2024-01-20', '8000', 'EMP A', 12, 22) in bus_lines()
+
+
+@pytest.mark.parametrize('body', [
+    {'targets': ['predicted'], 'group_id': 999999}, # Unknown group: no lines
+    {'targets': ['predicted'], 'start': '01/02/2024'},
+    {'targets': ['predicted'], 'start': '2024-03-01', 'end': '2024-02-01'},
+])
+def test_endpoint_rejects_scopes_that_would_widen(client, rows, body):
+    client.login_master()
+    status, _ = client.json('POST', '/api/clear-data', body)
+    assert status == 400
+    assert bus_lines() == sorted(rows)
+
+
+def test_endpoint_rejects_an_empty_group(client, rows):
+    client.login_master()
+    status, _ = client.json('POST', '/api/groups', {'name': 'Vazio'})
+    assert status == 200
+    group_id = server.group_index.groups()[0]['id']
+    status, _ = client.json('POST', '/api/clear-data', {'targets': ['predicted', 'realized'], 'group_id': group_id})
+    assert status == 400
+    assert bus_lines() == sorted(rows)
+
+
+def test_endpoint_requires_master(client, rows):
+    status, _ = client.json('POST', '/api/clear-data', {'targets': ['predicted', 'realized']})
+    assert status in (401, 403)
+    assert bus_lines() == sorted(rows)
+
+
+@pytest.fixture
+def archived(rows):
+    pytest.importorskip('pyarrow')
+    server.line_archive.archive_month(2024, 1)
+    server.line_archive.archive_month(2024, 2)
+    return server.line_archive.months()
+
+
+def archived_rows():
+    return sorted((r['date'], r['line_code'], r['company'], r['predicted_passengers'], r['realized_passengers'])
+                  for r in server.line_archive.read())
+
+
+def test_predicted_only_clear_keeps_months_archived(archived):
+    report = server.clear_bus_lines(True, False)
+    assert server.line_archive.months() == archived
+    assert bus_lines() == []
+    assert report["deleted"] == 1 and report["updated"] == 4
+    assert archived_rows() == [
+        ('2024-01-05', '8000', 'EMP A', 0, 20),
+        ('2024-01-20', '8000', 'EMP A', 0, 22),
+        ('2024-02-05', '8000', 'EMP A', 0, 23),
+        ('2024-02-05', '8001', 'EMP B', 0, 24),
+        ('2024-02-10', '8002', 'EMP B', 0, 25),
+    ]
+
+
+def test_scoped_clear_touches_only_matching_archived_rows(archived):
+    report = server.clear_bus_lines(True, True, start='2024-01-01', end='2024-02-07', lines=['8001'])
+    assert report["deleted"] == 2 and report["archive_dropped"] == []
+    assert server.line_archive.months() == archived
+    assert [r for r in archived_rows() if r[1] == '8001'] == []
+    assert len(archived_rows()) == len(ROWS) - 2
+
+
+def test_clearing_every_row_of_an_archived_month_removes_its_file(archived):
+    server.clear_bus_lines(False, True, companies=['EMP A'], start='2024-01-01', end='2024-01-31')
+    server.clear_bus_lines(True, False, start='2024-01-01', end='2024-01-31')
+    assert server.line_archive.months() == {(2024, 2)}
+
+
+def test_whole_month_clear_still_drops_the_file(archived):
+    report = server.clear_bus_lines(True, True, start='2024-01-01', end='2024-01-31')
+    assert report["archive_dropped"] == ['2024-01']
+    assert server.line_archive.months() == {(2024, 2)}
+
+
+def test_archived_clear_refreshes_reads(client, archived):
+    path = '/api/lines?line_code=8000&start=2024-01-01&end=2024-02-28'
+    status, before = client.json('GET', path)
+    assert sorted(r['realized_passengers'] for r in before) == [20, 22, 23]
+    server.clear_bus_lines(False, True, lines=['8000'], start='2024-01-10', end='2024-02-28')
+    status, after = client.json('GET', path)
+    assert sorted(r['realized_passengers'] for r in after) == [0, 0, 20]
@@ -0,0 +1,69 @@
+"""Keyset paging of /api/line-events when many rows share a sort key (user-042)."""
+import pytest
+
+from conftest import server
+
+
+def insert_events(rows):
+    """rows: (line_code, type, implementation_date); returns the new ids."""
+    conn, c = server.get_db_connection()
+    try:
+        for line_code, event_type, date in rows:
+            c.execute("INSERT INTO line_events (line_code, type, implementation_date, created_at) VALUES (?, ?, ?, ?)",
+                      (line_code, event_type, date, '2024-01-01 08:00:00'))
+        conn.commit()
+        c.execute("SELECT id FROM line_events ORDER BY id")
+        ids = [r[0] for r in c.fetchall()]
+    finally:
+        conn.close()
+    server.mark_tables_changed('line_events')
+    return ids
+
+
+def pages(client, query):
+    items, cursor, count = [], None, 0
+    while True:
+        path = f"/api/line-events?{query}" + (f"&cursor={cursor}" if cursor else "")
+        status, page = client.json('GET', path)
+        assert status == 200
+        items += page['items']
+        count += 1
+        cursor = page['next_cursor']
+        if not cursor:
+            return items, count
+
+
+@pytest.fixture
+def events(client):
+    # Eleven rows on two type values and one shared date: ties on every sort key below
+    rows = [('8000', 'A' if i % 3 else 'B', '2024-02-01') for i in range(11)]
+    return insert_events(rows)
+
+
+@pytest.mark.parametrize('sort', ['type', 'implementation_date', 'created_at', 'recent'])
+@pytest.mark.parametrize('direction', ['asc', 'desc'])
+def test_pages_cover_ties_exactly_once(client, events, sort, direction):
+    items, count = pages(client, f"limit=2&sort={sort}&dir={direction}")
+    ids = [e['id'] for e in items]
+    assert sorted(ids) == sorted(events) and len(set(ids)) == len(ids)
+    assert count == 6
+
+    status, full = client.json('GET', f"/api/line-events?limit=500&sort={sort}&dir={direction}")
+    assert ids == [e['id'] for e in full['items']] and full['next_cursor'] is None
+
+
+def test_equal_keys_fall_back_to_id_order(client, events):
+    items, _ = pages(client, "limit=3&sort=type&dir=asc")
+    keys = [(e['type'], e['id']) for e in items]
+    assert keys == sorted(keys)
+    items, _ = pages(client, "limit=3&sort=type&dir=desc")
+    keys = [(e['type'], e['id']) for e in items]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_cursor_from_another_sort_is_rejected(client, events):
+    status, page = client.json('GET', "/api/line-events?limit=2&sort=type&dir=asc")
+    status, _ = client.json('GET', f"/api/line-events?limit=2&sort=fact&dir=asc&cursor={page['next_cursor']}")
+    assert status == 400
+    status, _ = client.json('GET', "/api/line-events?limit=2&cursor=not-a-cursor")
+    assert status == 400
@@ -0,0 +1,80 @@
+"""MultipartParser: delimiters and headers split across reads (user-038)."""
+import io
+
+import pytest
+
+from conftest import server
+
+BOUNDARY = 'XyZzy42'
+CONTENT_TYPE = f'multipart/form-data; boundary={BOUNDARY}'
+PAYLOAD = b"line one\r\n--XyZzy4 almost a boundary\r\n" + bytes(range(256)) * 3
+
+
+def body(*parts):
+    out = b""
+    for headers, data in parts:
+        out += f"--{BOUNDARY}\r\n{headers}\r\n\r\n".encode() + data + b"\r\n"
+    return out + f"--{BOUNDARY}--\r\n".encode()
+
+
+class TrickleReader:
+    """Returns at most step bytes per read, whatever was asked for."""
+    def __init__(self, data, step):
+        self._f = io.BytesIO(data)
+        self.step = step
+
+    def read(self, n=-1):
+        return self._f.read(min(n, self.step) if n >= 0 else self.step)
+
+
+def parse(data, step, max_bytes=10 ** 6, max_field_bytes=1024):
+    opened = []
+
+    def open_file(filename):
+        opened.append(io.BytesIO())
+        return opened[-1]
+
+    parser = server.MultipartParser(TrickleReader(data, step), CONTENT_TYPE, max_bytes, max_field_bytes, open_file)
+    fields, files = parser.parse()
+    return fields, [(f['name'], f['filename'], f['size'], f['file'].getvalue()) for f in files]
+
+
+FORM = body(
+    ('Content-Disposition: form-data; name="line_code"', b"8000"),
+    ('Content-Disposition: form-data; name="attachment"; filename="relatorio.pdf"\r\nContent-Type: application/pdf', PAYLOAD),
+    ('Content-Disposition: form-data; name="fact"', "Atraso na saída".encode()),
+)
+
+
+@pytest.mark.parametrize('step', list(range(1, len(BOUNDARY) + 8)) + [64, 4096])
+def test_boundary_split_at_every_offset(step):
+    fields, files = parse(FORM, step)
+    assert fields == {'line_code': '8000', 'fact': 'Atraso na saída'}
+    assert len(files) == 1
+    name, _, size, data = files[0]
+    assert name == 'attachment' and size == len(PAYLOAD) and data == PAYLOAD
+
+
+def test_empty_file_part():
+    fields, files = parse(body(('Content-Disposition: form-data; name="a"; filename="x.txt"', b"")), 3)
+    assert fields == {} and files[0][2:] == (0, b"")
+
+
+def test_truncated_body_is_an_error():
+    with pytest.raises(server.MultipartError):
+        parse(FORM[:-20], 7)
+
+
+def test_body_over_max_bytes():
+    with pytest.raises(server.UploadTooLarge):
+        parse(FORM, 64, max_bytes=len(FORM) // 2)
+
+
+def test_text_field_over_limit():
+    with pytest.raises(server.UploadTooLarge):
+        parse(body(('Content-Disposition: form-data; name="fact"', b"x" * 100)), 5, max_field_bytes=99)
+
+
+def test_missing_boundary():
+    with pytest.raises(server.MultipartError):
+        server.MultipartParser(io.BytesIO(b""), 'multipart/form-data', 100, 100, None)
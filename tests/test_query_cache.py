@@ -0,0 +1,67 @@
+"""QueryCache: LRU behaviour and invalidation by table writes (user-026)."""
+from conftest import insert_bus_lines, server
+
+
+def test_hit_until_a_dependency_changes():
+    versions = {'a': 0, 'b': 0}
+    cache = server.QueryCache(8, lambda tables: tuple(versions[t] for t in tables))
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return len(loads)
+
+    assert cache.get_or_load('x', {'p': 1}, ('a',), loader) == 1
+    assert cache.get_or_load('x', {'p': 1}, ('a',), loader) == 1
+    versions['b'] += 1 # Unrelated table
+    assert cache.get_or_load('x', {'p': 1}, ('a',), loader) == 1
+    versions['a'] += 1
+    assert cache.get_or_load('x', {'p': 1}, ('a',), loader) == 2
+    assert cache.hits == 2 and cache.misses == 2
+
+
+def test_params_are_part_of_the_key_in_any_order():
+    cache = server.QueryCache(8, lambda tables: ())
+    assert cache.get_or_load('x', {'a': 1, 'b': 2}, (), lambda: 'first') == 'first'
+    assert cache.get_or_load('x', {'b': 2, 'a': 1}, (), lambda: 'second') == 'first'
+    assert cache.get_or_load('x', {'a': 2, 'b': 2}, (), lambda: 'third') == 'third'
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = server.QueryCache(2, lambda tables: ())
+    cache.get_or_load('x', 1, (), lambda: 1)
+    cache.get_or_load('x', 2, (), lambda: 2)
+    cache.get_or_load('x', 1, (), lambda: 'reloaded') # Touch 1, so 2 is the oldest
+    cache.get_or_load('x', 3, (), lambda: 3)
+    assert cache.get_or_load('x', 1, (), lambda: 'reloaded') == 1
+    assert cache.get_or_load('x', 2, (), lambda: 'reloaded') == 'reloaded'
+    assert cache.evictions == 2
+
+
+def test_write_during_load_leaves_the_entry_stale():
+    versions = {'a': 0}
+    cache = server.QueryCache(8, lambda tables: tuple(versions[t] for t in tables))
+
+    def loader():
+        versions['a'] += 1 # A write lands while the query runs
+        return 'old'
+
+    assert cache.get_or_load('x', None, ('a',), loader) == 'old'
+    assert cache.get_or_load('x', None, ('a',), lambda: 'new') == 'new'
+
+
+def test_disabled_cache_always_loads():
+    cache = server.QueryCache(0, lambda tables: ())
+    assert cache.get_or_load('x', None, (), lambda: 1) == 1
+    assert cache.get_or_load('x', None, (), lambda: 2) == 2
+
+
+def test_mark_tables_changed_invalidates_cached_reads(client):
+    insert_bus_lines([('2024-01-01', '8000', 'EMP A', 10, 20)])
+    path = '/api/lines?line_code=8000&start=2024-01-01&end=2024-01-31'
+    status, rows = client.json('GET', path)
+    assert status == 200 and [r['realized_passengers'] for r in rows] == [20]
+
+    insert_bus_lines([('2024-01-02', '8000', 'EMP A', 10, 30)]) # Bumps bus_lines
+    status, rows = client.json('GET', path)
+    assert sorted(r['realized_passengers'] for r in rows) == [20, 30]